@@ -16,23 +16,85 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
 import collections
+import collections.abc
+import concurrent.futures
 import datetime
+import hashlib
+import importlib
 import io
+import itertools
+import json
 import os.path
 import re
+import sys
+import threading
+import time
 import traceback
 import urllib.parse
 
-import bs4  # Beautiful Soup 4
-import requests
 import yaml
 
 
+class LazyModule(object):
+    '''Stands in for a module, only importing it when one of its attributes is
+    first used'''
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, name):
+        self.__name = name
+        self.__module = None
+
+    def __getattr__(self, attribute):
+        if self.__module is None:
+            self.__module = importlib.import_module(self.__name)
+        return getattr(self.__module, attribute)
+
+
+# Beautiful Soup (with lxml) and requests take longer to import than a quick
+# run of the one-shot scripts spends doing anything else (e.g. a --check-only
+# run finding nothing has changed), so they are only imported once a page is
+# actually fetched or parsed
+bs4 = LazyModule('bs4')  # Beautiful Soup 4
+requests = LazyModule('requests')
+
 COMMENTS = 0
 REPLIES = 1
 UNREAD_NOTES = 2
 DEVIATIONS = 3
 
+# Message Center views of each message type, given an offset and count. Views
+# are paged through MESSAGES_PAGE_SIZE items at a time (the real limit is >101
+# and <150), up to MESSAGES_MAX_PAGES pages per poll. The first page is always
+# the full 100 message window, which is kept as the state - a smaller window
+# would let messages already seen move back into it (e.g. when newer ones are
+# deleted) and be reported as new again
+MESSAGE_CENTER_VIEWS = {COMMENTS: 'fb_comments:%d:%d:f',
+                        REPLIES: 'fb_replies:%d:%d:f',
+                        UNREAD_NOTES: 'notes_unread:%d:%d:f',
+                        DEVIATIONS: 'devwatch:%d:%d:f:tg=deviations'}
+MESSAGES_PAGE_SIZE = 100
+MESSAGES_MAX_PAGES = 10
+
+# Notes in a page of a note folder listing
+NOTES_PAGE_SIZE = 25
+
+# The site accessed by default - see DeviantArtService
+DEVIANTART_URL = 'https://www.deviantart.com'
+
+# Request fields that vary per session/account and so don't identify a request
+# in a response corpus
+CORPUS_IGNORED_FIELDS = {'ui', 't', 'username', 'password', 'validate_token',
+                         'validate_key', 'remember_me'}
+
+# Shared by all deviations without folders (see Deviation)
+NO_FOLDERS = ()
+
+# Request records are numbered across all services, and fetch_concurrently
+# notes the current attempt in this per-thread context
+request_IDs = itertools.count(1)
+request_context = threading.local()
+
 
 # pylint: disable=too-many-lines
 
@@ -53,6 +115,10 @@ class AccountState(object):
         self.old_replies = self.old_replies_count = None
         self.old_unread_notes = self.old_unread_notes_count = None
 
+        # Whether there is any previous state (e.g. the Message Center having
+        # been empty), rather than this being the first run
+        self.has_previous_state = False
+
         # Loading previous state
         self.__load_state()
 
@@ -92,6 +158,7 @@ class AccountState(object):
                                    traceback.format_exc()))
 
             # Configuring state
+            self.has_previous_state = True
             self.comments = state.get('comments', [])
             self.comments_count = state.get('commentsCount', 0)
             self.deviations = state.get('deviations', [])
@@ -139,6 +206,70 @@ class AccountState(object):
             raise Exception('Unable to save state into YAML document '
                             '(\'%s\'):\n\n%s\n\n%s\n'
                             % (self.state_file_path, e, traceback.format_exc()))
+        self.has_previous_state = True
+
+
+class SentNotesState(object):
+    '''Maintains the sent notes not yet read by their recipient, for the unread
+    sent notes checker. Only what is needed to report on a note is kept -
+    unread_notes is a dictionary of note ID -> (title, recipient, timestamp),
+    and newest_note_ID is that of the newest sent note seen (None before the
+    first poll). missing_note_IDs are the unread notes not found in the last
+    poll, which are only taken as deleted when missing again in the next'''
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, state_file_path):
+        self.state_file_path = os.path.expanduser(state_file_path)
+        self.newest_note_ID = None
+        self.unread_notes = {}
+        self.missing_note_IDs = set()
+
+        # Loading previous state
+        self.__load_state()
+
+
+    def __load_state(self):
+        if not os.path.exists(self.state_file_path):
+            return
+
+        try:
+            with io.open(self.state_file_path, 'r') as state_file:
+                state = yaml.load(state_file, yaml.CLoader)
+            self.newest_note_ID = state['newest_note_ID']
+            self.unread_notes = {note_ID: tuple(details) for note_ID, details
+                                 in state['unread_notes'].items()}
+            self.missing_note_IDs = set(state.get('missing_note_IDs', []))
+        except Exception as e:
+            raise Exception('Unable to load state from YAML document '
+                            '(\'%s\'):\n\n%s\n\n%s\n'
+                            % (self.state_file_path, e,
+                               traceback.format_exc()))
+
+
+    def save_state(self):
+        '''Save internal state to the configured state file - the new state is
+        written alongside then moved into place, so an interrupted save leaves
+        the previous state intact'''
+
+        try:
+            cache_directory = os.path.dirname(self.state_file_path)
+            if not os.path.exists(cache_directory):
+                os.makedirs(cache_directory)
+
+            # Note details are saved as lists to keep the document plain YAML
+            state = {'newest_note_ID': self.newest_note_ID,
+                     'unread_notes': {note_ID: list(details) for
+                                      note_ID, details
+                                      in self.unread_notes.items()},
+                     'missing_note_IDs': sorted(self.missing_note_IDs)}
+            with io.open(self.state_file_path + '.new', 'w') as state_file:
+                yaml.dump(state, state_file, yaml.CDumper)
+            os.replace(self.state_file_path + '.new', self.state_file_path)
+        except Exception as e:
+            raise Exception('Unable to save state into YAML document '
+                            '(\'%s\'):\n\n%s\n\n%s\n'
+                            % (self.state_file_path, e, traceback.format_exc()))
 
 
 # Getting new-style class
@@ -147,31 +278,164 @@ class DeviantArtService(object):
 
     # pylint: disable=too-many-instance-attributes
 
-    def __init__(self, username, password):
-        self.__difi_url = 'https://www.deviantart.com/global/difi.php'
+    # pylint: disable=too-many-arguments
+
+    # request_limiter is an optional semaphore (e.g. threading.BoundedSemaphore)
+    # held for the duration of every request - sharing one between cloned
+    # services gives concurrent workers a global request budget
+    # base_URL allows a different site to be used, e.g. a local replay server
+    # (see devart_replay), and when record_directory is set, every response is
+    # saved there as a corpus that can later be replayed
+    # instrumentation is a list of Instrumentation objects (see
+    # instrumentation_from_config) to be told about every request made
+    def __init__(self, username, password, request_limiter=None, base_URL=None,
+                 record_directory=None, instrumentation=None):
+        self.__base_url = (base_URL or DEVIANTART_URL).rstrip('/')
+        self.__difi_url = self.__base_url + '/global/difi.php'
         self.__inbox_id = None
         self.__username = username
+        self.__account_name = None
         self.__password = password
         self.__r = self.__s = None
         self.__last_content = None
+        self.__request_record = None
         self.logged_in = False
+        self.request_limiter = request_limiter
+        self.record_directory = record_directory
+        self.instrumentation = list(instrumentation or [])
+
+
+    def __get(self, URL, **kwargs):
+        return self.__request('GET', URL, **kwargs)
+
+
+    def __post(self, URL, **kwargs):
+        return self.__request('POST', URL, **kwargs)
+
+
+    def __finish_request(self, bytes_received=None):
+
+        # The last request's record is complete once its response has been
+        # parsed - streamed responses are only complete once downloaded, so
+        # their transfer time and size is filled in here
+        record = self.__request_record
+        self.__request_record = None
+        if record is None or not self.instrumentation:
+            return
+        if record.stream:
+            record.network_time = time.perf_counter() - record.network_start
+            if bytes_received is not None:
+                record.bytes_received = bytes_received
+        for instrumentation in self.instrumentation:
+            instrumentation.request_finished(record)
+
+
+    def __parse(self, function, *args):
+
+        # Parsing of the last request's response goes through here so that the
+        # time taken is recorded against the request
+        record = self.__request_record
+        start = time.time()
+        perf_start = time.perf_counter()
+        try:
+            return function(*args)
+        except Exception as e:
+            if record is not None:
+                record.error = summarise_error(e)
+                self.__finish_request()
+            raise
+        finally:
+            if record is not None:
+                record.parse_spans.append((start, time.perf_counter() -
+                                           perf_start))
+
+
+    def __request(self, method, URL, **kwargs):
+
+        # Any previous request must be finished with by now
+        self.__finish_request()
+
+        record = RequestRecord(method, URL, kwargs.get('params'),
+                               kwargs.get('data'), bool(kwargs.get('stream')))
+        try:
+
+            # All requests go through here so that any shared request budget is
+            # honoured
+            if self.request_limiter is None:
+                record.network_start = time.perf_counter()
+                response = self.__s.request(method, URL, **kwargs)
+            else:
+                with self.request_limiter:
+                    record.network_start = time.perf_counter()
+                    record.queue_time = (record.network_start -
+                                         record.queue_start)
+                    response = self.__s.request(method, URL, **kwargs)
+            record.network_time = time.perf_counter() - record.network_start
+
+        except Exception as e:
+            record.network_time = time.perf_counter() - record.queue_start
+            record.error = summarise_error(e)
+            self.__request_record = record
+            self.__finish_request()
+            raise
+
+        record.status = response.status_code
+        if not record.stream:
+            record.bytes_received = len(response.content)
+        if response.status_code >= 400:
+            record.error = 'HTTP %s' % response.status_code
+        self.__request_record = record
+
+        # Recording the response if desired - streamed responses (file
+        # downloads) are not recorded as that would mean reading them into
+        # memory
+        if self.record_directory and not record.stream:
+            record_response(self.record_directory,
+                            corpus_key(method, URL, kwargs.get('params'),
+                                       kwargs.get('data')),
+                            response.content)
+
+        # Failed requests won't be parsed
+        if record.error:
+            self.__finish_request()
+
+        return response
+
+
+    def clone(self):
+        '''Return a new service reusing this service's login, request limiter
+        and instrumentation but with its own HTTP session - a service keeps
+        per-request state, so each thread must use its own clone'''
+
+        # Ensure I am logged in first
+        if not self.logged_in:
+            raise Exception('Please login before calling clone')
+
+        service = DeviantArtService(self.__username, self.__password,
+                                    self.request_limiter, self.__base_url,
+                                    self.record_directory, self.instrumentation)
+        service.__s = requests.Session()
+        service.__s.cookies.update(self.__s.cookies)
+        service.__inbox_id = self.__inbox_id
+        service.__account_name = self.__account_name
+        service.logged_in = True
+        return service
 
 
     def __fetch_inbox_id(self):
 
         # Obtain inbox folder ID from message center
         try:
-            difi_url = 'https://www.deviantart.com/global/difi.php'
             payload = {'c[]': 'MessageCenter;get_folders',
                        't': 'json'}
-            self.__r = self.__s.post(difi_url, params=payload, timeout=60)
+            self.__r = self.__post(self.__difi_url, params=payload, timeout=60)
             self.__r.raise_for_status()
         except Exception as e:
             raise Exception('Unable to get inbox folder ID:\n\n%s\n\n%s\n'
                             % (e, traceback.format_exc()))
 
         # Making sure difi response is valid
-        response = self.__r.json()
+        response = self.__parse(self.__r.json)
         if not validate_difi_response(response, 0):
             raise Exception('The DiFi page request for the inbox folder ID '
                             'succeeded but the DiFi request failed:\n\n%s\n'
@@ -182,6 +446,7 @@ class DeviantArtService(object):
             if folder['is_inbox']:
                 self.__inbox_id = folder['folderid']
                 break
+        self.__finish_request()
 
         # Erroring if the inbox has not been found
         if self.__inbox_id is None:
@@ -189,6 +454,139 @@ class DeviantArtService(object):
                             'folders:\n\n%s\n' % response)
 
 
+    def __fetch_message_views(self, views):
+
+        # Fetching the passed (messages type, offset) pages of Message Center
+        # views in one DiFi request, returning their results
+        try:
+            payload = {'c[]': ['MessageCenter;get_views;%s,oq:%s'
+                               % (self.__inbox_id,
+                                  MESSAGE_CENTER_VIEWS[messages_type]
+                                  % (offset, MESSAGES_PAGE_SIZE))
+                               for messages_type, offset in views],
+                       't': 'json'}
+            self.__r = self.__post(self.__difi_url, params=payload,
+                                   timeout=60)
+            self.__r.raise_for_status()
+
+        except Exception as e:
+            raise Exception('Unable to get number of unread notes, deviations'
+                            ' etc:\n\n%s\n\n%s\n' % (e,
+                                                     traceback.format_exc()))
+
+        # Making sure difi response and all contained calls are valid
+        response = self.__parse(self.__r.json)
+        if not validate_difi_response(response, range(len(views))):
+            raise Exception('The DiFi page request to get number of unread '
+                            'notes, deviations etc succeeded but the DiFi '
+                            'request failed:\n\n%s\n' % response)
+        self.__finish_request()
+        return [call['response']['content'][0]['result']
+                for call in response['DiFi']['response']['calls']]
+
+
+    def __fetch_remaining_message_hits(self, messages_type, result,
+                                       known_IDs):
+
+        # Each view is newest first, so a view is paged through until it
+        # reaches a message already seen - this way nothing is lost when lots
+        # of messages arrive between polls. After an empty previous state every
+        # message is new, so the view is paged through to the end. known_IDs is
+        # None on the first run, where only the first page is taken as there is
+        # nothing to compare against
+        hits = list(result['hits'])
+        if known_IDs is None:
+            return hits
+        page_hits = hits
+        offset = 0
+        while (len(page_hits) == MESSAGES_PAGE_SIZE and
+               offset + MESSAGES_PAGE_SIZE < result['count'] and
+               offset < MESSAGES_PAGE_SIZE * (MESSAGES_MAX_PAGES - 1) and
+               not any(message_hit_ID(messages_type, hit) in known_IDs
+                       for hit in page_hits)):
+            offset += MESSAGES_PAGE_SIZE
+            page_hits = self.__fetch_message_views([(messages_type,
+                                                     offset)])[0]['hits']
+            hits += page_hits
+        return hits
+
+
+    def __update_messages(self, state, messages_type, result):
+
+        # Fetching and saving the new state of one type of message, first
+        # copying current messages state to 'old' fields. Note that replies are
+        # basically comments so the class is reused
+        def known_IDs(messages):
+            return ({message.ID for message in messages}
+                    if state.has_previous_state else None)
+
+        if messages_type == COMMENTS:
+            hits = self.__fetch_remaining_message_hits(
+                COMMENTS, result, known_IDs(state.comments))
+            state.old_comments = state.comments[:]
+            state.old_comments_count = state.comments_count
+            state.comments = [Comment(message_hit_ID(COMMENTS, hit),
+                                      extract_text(hit['title'], True),
+                                      extract_text(hit['who'], True),
+                                      int(hit['ts']), hit['url'],
+                                      extract_text(hit['body']))
+                              for hit in hits]
+            state.comments_count = result['count']
+
+        elif messages_type == REPLIES:
+            hits = self.__fetch_remaining_message_hits(
+                REPLIES, result, known_IDs(state.replies))
+            state.old_replies = state.replies[:]
+            state.old_replies_count = state.replies_count
+            state.replies = [Comment(message_hit_ID(REPLIES, hit),
+                                     extract_text(hit['title'], True),
+                                     extract_text(hit['who'], True),
+                                     int(hit['ts']), hit['url'],
+                                     extract_text(hit['body']))
+                             for hit in hits]
+            state.replies_count = result['count']
+
+        elif messages_type == UNREAD_NOTES:
+
+            # Special processing needs to be done for notes to fetch the text -
+            # this is only done for notes not already known
+            known_unread_notes = {note.ID: note for note in state.unread_notes}
+            hits = self.__fetch_remaining_message_hits(
+                UNREAD_NOTES, result, known_IDs(state.unread_notes))
+            state.old_unread_notes = state.unread_notes[:]
+            state.old_unread_notes_count = state.unread_notes_count
+            state.unread_notes = []
+            for hit in hits:
+                note_ID = message_hit_ID(UNREAD_NOTES, hit)
+                if note_ID in known_unread_notes:
+                    state.unread_notes.append(known_unread_notes[note_ID])
+                    continue
+
+                note_title = extract_text(hit['title'], True)
+                try:
+                    state.unread_notes.append(
+                        self.get_note_in_folder('unread', note_ID))
+                except Exception as e:
+                    raise Exception('Unable to get text of unread note ID '
+                                    '\'%s\', title \'%s\':\n\n%s\n\n%s\n'
+                                    % (note_ID, note_title, e,
+                                       traceback.format_exc()))
+            state.unread_notes_count = len(state.unread_notes)
+
+        elif messages_type == DEVIATIONS:
+            hits = self.__fetch_remaining_message_hits(
+                DEVIATIONS, result, known_IDs(state.deviations))
+            state.old_deviations = state.deviations[:]
+            state.old_deviations_count = state.deviations_count
+            state.deviations = [Deviation(message_hit_ID(DEVIATIONS, hit),
+                                          extract_text(hit['title'], True),
+                                          hit['url'],
+                                          extract_text(hit['username'], True),
+                                          int(hit['ts']))
+                                for hit in hits]
+            state.deviations_count = result['count']
+
+
     def get_all_deviations(self, username, deviation_offset):
         '''Fetch the IDs, titles, links and folders associated with all
         deviations via the gallery page -> All link, with the offset allowing
@@ -200,15 +598,12 @@ class DeviantArtService(object):
 
         try:
 
-            # Determining gallery URL
-            gallery_url = 'https://%s.deviantart.com/gallery/' % username
-
-            # The catpath parameter is the 'all' selector
-            params = {'catpath': '/', 'offset': deviation_offset}
-
             # I don't yet know of any DiFi way to do this that actually works,
             # so just fetching the pages as usual
-            self.__r = self.__s.get(gallery_url, params=params, timeout=60)
+            gallery_url, params = gallery_page_request(self.__base_url,
+                                                       username,
+                                                       deviation_offset)
+            self.__r = self.__get(gallery_url, params=params, timeout=60)
             self.__r.raise_for_status()
 
         except Exception as e:
@@ -217,88 +612,15 @@ class DeviantArtService(object):
                             % (deviation_offset, e, traceback.format_exc()))
 
         # Parsing page
-        self.__last_content = bs4.BeautifulSoup(self.__r.content, 'lxml')
-
-        # Locating the main stream div (it turns out that classes like 'tt-a'
-        # are also used outside of the deviations listing)
-        div_deviations = (self.__last_content.
-                          select_one('div#gmi-ResourceStream'))
-        if div_deviations is None:
-            raise Exception('Unable to locate the main div containing the '
-                            'deviations in the gallery page - HTML:\n\n%s\n'
-                            % self.__last_content)
-
-        known_deviation_folders = {}
-        deviations = []
-        for deviation_span in div_deviations.select('span.thumb'):
-
-            # Fetching the deviation link and validating
-            if 'href' not in deviation_span.attrs:
-                raise Exception('Unable to fetch the href from the following '
-                                'deviation span:\n\n%s\n\nProblem occurred '
-                                'while fetching all deviations from '
-                                'offset \'%s\''
-                                % deviation_span, deviation_offset)
-
-            deviation_URL = deviation_span.attrs['href']
-
-            # Fetching deviation ID
-            if 'data-deviationid' not in deviation_span.attrs:
-                raise Exception('Unable to fetch the deviation ID from the '
-                                'following deviation span:\n\n%s\n\nProblem '
-                                'occurred while fetching all deviations from '
-                                'offset \'%s\''
-                                % deviation_span, deviation_offset)
-
-            deviation_ID = deviation_span.attrs['data-deviationid']
-
-            # Fetching deviation title and validating
-            title_span = deviation_span.select_one('span.title')
-            if title_span is None:
-                raise Exception('Unable to locate the title span for deviation '
-                                'ID \'%s\' from the following deviation span:\n'
-                                '\n%s\n\nProblem occurred while fetching all '
-                                'deviations from offset \'%s\''
-                                % (deviation_ID, deviation_span,
-                                   deviation_offset))
-
-            deviation_title = title_span.text
-
-            # Fetching deviation folders involved and validating (being
-            # associated with no folders is perfectly acceptable)
-            # 16.02.17: dA appears to have redone the HTML here such that folders
-            # are no longer available via deviation records in the main gallery
-            # bit (they aren't available in the deviation's page either)... so
-            # this effectively kills off folder recording for now
-            folder_link_tags = deviation_span.select('span.gallections a')
-            deviation_folders = []
-            for folder_link_tag in folder_link_tags:
-                folder_URL = folder_link_tag.attrs['href']
-                folder_title = folder_link_tag.text
-
-                # Caching deviation folders so that you don't have to fetch the
-                # folder page every time to get the description
-                if folder_title in known_deviation_folders:
-
-                    # Folder has already been fetched - using current data
-                    deviation_folders.append(known_deviation_folders[folder_title])
-
-                else:
-
-                    # Folder is new - fetching full information from its page (
-                    # description isn't available otherwise)
-                    deviation_folder = self.get_deviation_folder(folder_URL)
-                    deviation_folders.append(deviation_folder)
-
-                    # Adding to cache
-                    known_deviation_folders[folder_title] = deviation_folder
-
-            # All deviation detail fetched, constructing
-            deviations.append(Deviation(deviation_ID, deviation_title,
-                                        deviation_URL, username,
-                                        folders=deviation_folders))
-
-        return deviations
+        self.__last_content = self.__parse(bs4.BeautifulSoup,
+                                            self.__r.content, 'lxml')
+
+        # New deviation folders' pages are fetched while going through the
+        # thumbs, so the gallery page's request is finished with here
+        self.__finish_request()
+        return parse_gallery_page(self.__last_content, username,
+                                  deviation_offset,
+                                  self.get_deviation_folder)
 
 
     def get_deviation(self, deviation_URL):
@@ -309,7 +631,7 @@ class DeviantArtService(object):
 
             # I don't yet know of any DiFi way to do this that actually works,
             # so just fetching the pages as usual
-            self.__r = self.__s.get(deviation_URL, timeout=60)
+            self.__r = self.__get(deviation_URL, timeout=60)
             self.__r.raise_for_status()
 
         except Exception as e:
@@ -318,7 +640,8 @@ class DeviantArtService(object):
                             % (deviation_URL, e, traceback.format_exc()))
 
         # Parsing page
-        self.__last_content = bs4.BeautifulSoup(self.__r.content, 'lxml')
+        self.__last_content = self.__parse(bs4.BeautifulSoup,
+                                            self.__r.content, 'lxml')
 
         # Determining deviation ID
         try:
@@ -360,6 +683,14 @@ class DeviantArtService(object):
         # genuinely don't have a description - in this case the div.text tag
         # is not present
         description_div_tag = self.__last_content.select_one('div.text')
+
+        # Fingerprinting the relevant region of the page so that edits can be
+        # detected cheaply later - this must happen before the description is
+        # converted to text, as that modifies the tag
+        deviation_fingerprint = fingerprint(title_link_tag, username_link_tag,
+                                            timestamp_span_tag,
+                                            description_div_tag)
+
         if description_div_tag is None:
             deviation_description = ''
         else:
@@ -367,12 +698,70 @@ class DeviantArtService(object):
             # Turn deviantART post into sensible text
             deviation_description = deviantart_post_to_text(description_div_tag)
 
+        # Determining the link to the deviation's file - the original file when
+        # downloads are allowed, otherwise the full-size image. Deviations like
+        # literature have no file, which is recorded as an empty link
+        download_link_tag = self.__last_content.select_one('a.dev-page-download')
+        image_tag = self.__last_content.select_one('img.dev-content-full')
+        if download_link_tag is not None and 'href' in download_link_tag.attrs:
+            file_URL = download_link_tag.attrs['href']
+        elif image_tag is not None and 'src' in image_tag.attrs:
+            file_URL = image_tag.attrs['src']
+        else:
+            file_URL = ''
+
         # Can't get at folder information here, seems only the gallery pages
         # show this
 
         # All deviation detail fetched, constructing
+        self.__finish_request()
         return Deviation(deviation_ID, deviation_title, deviation_URL, username,
-                         timestamp, deviation_description)
+                         timestamp, deviation_description,
+                         fingerprint=deviation_fingerprint, file_URL=file_URL)
+
+
+    def download_file(self, file_URL, file_path, chunk_size=65536):
+        '''Download the file at the passed URL to file_path, streaming it to
+        disk in chunks. If file_path already exists it is treated as a partial
+        download, and the download is resumed from where it left off'''
+
+        # Ensure I am logged in first - original files need this
+        if not self.logged_in:
+            raise Exception('Please login before calling download_file')
+
+        offset = os.path.getsize(file_path) if os.path.exists(file_path) else 0
+        bytes_received = 0
+        try:
+
+            # Requesting just the remainder of a partial download
+            headers = {'Range': 'bytes=%d-' % offset} if offset else {}
+            self.__r = self.__get(file_URL, headers=headers, stream=True,
+                                  timeout=60)
+
+            # The range being unsatisfiable means the partial download is
+            # actually complete
+            if offset and self.__r.status_code == 416:
+                return
+            self.__r.raise_for_status()
+
+            # Servers that don't support ranges send the whole file again, so
+            # starting from scratch in that case
+            mode = 'ab' if offset and self.__r.status_code == 206 else 'wb'
+            with io.open(file_path, mode) as downloaded_file:
+                for chunk in self.__r.iter_content(chunk_size):
+                    downloaded_file.write(chunk)
+                    bytes_received += len(chunk)
+
+        except Exception as e:
+            raise Exception('Unable to download the file at \'%s\' to \'%s\' '
+                            '(from offset %d):\n\n%s\n\n%s\n'
+                            % (file_URL, file_path, offset, e,
+                               traceback.format_exc()))
+
+        finally:
+            if self.__r is not None:
+                self.__r.close()
+            self.__finish_request(bytes_received)
 
 
     def get_deviation_folder(self, deviation_folder_URL):
@@ -382,7 +771,7 @@ class DeviantArtService(object):
 
             # I don't yet know of any DiFi way to do this that actually works,
             # so just fetching the pages as usual
-            self.__r = self.__s.get(deviation_folder_URL, timeout=60)
+            self.__r = self.__get(deviation_folder_URL, timeout=60)
             self.__r.raise_for_status()
 
         except Exception as e:
@@ -391,7 +780,8 @@ class DeviantArtService(object):
                             % (deviation_folder_URL, e, traceback.format_exc()))
 
         # Parsing page
-        self.__last_content = bs4.BeautifulSoup(self.__r.content, 'lxml')
+        self.__last_content = self.__parse(bs4.BeautifulSoup,
+                                            self.__r.content, 'lxml')
 
         # Determining deviation folder ID
         match = re.match(r'^.+/([0-9]+)/.+$', deviation_folder_URL)
@@ -420,13 +810,16 @@ class DeviantArtService(object):
                             % (deviation_folder_URL, self.__last_content))
         deviation_folder_description = folder_description_div.text
 
+        self.__finish_request()
         return DeviationFolder(deviation_folder_ID, deviation_folder_title,
                                deviation_folder_description,
                                deviation_folder_URL)
 
 
-    def get_messages(self, state):
-        '''Fetch new messages from deviantART'''
+    def get_messages(self, state, messages_types=None):
+        '''Fetch new messages from deviantART - when a list of messages_types
+        (COMMENTS etc) is passed, only those types are fetched and the rest of
+        the state is left as it was'''
 
         # Ensure I am logged in first
         if not self.logged_in:
@@ -436,90 +829,21 @@ class DeviantArtService(object):
         if self.__inbox_id is None:
             self.__fetch_inbox_id()
 
-        # Fetch relevant unread notes, deviations etc
-        try:
-
-            # 100 is a limit for number of things returned - real limit is
-            # >101 and <150
-            payload = {'c[]': ['MessageCenter;get_views;' +
-                               str(self.__inbox_id) + ',oq:fb_comments:0:100:f',
-                               'MessageCenter;get_views;' +
-                               str(self.__inbox_id) + ',oq:fb_replies:0:100:f',
-                               'MessageCenter;get_views;' +
-                               str(self.__inbox_id) + ',oq:notes_unread:0:100:f',  # pylint: disable=line-too-long
-                               'MessageCenter;get_views;' +
-                               str(self.__inbox_id) + ',oq:devwatch:0:100:f:'
-                               'tg=deviations'],
-                       't': 'json'}
-            self.__r = self.__s.post(self.__difi_url, params=payload,
-                                     timeout=60)
-            self.__r.raise_for_status()
-
-        except Exception as e:
-            raise Exception('Unable to get number of unread notes, deviations'
-                            ' etc:\n\n%s\n\n%s\n' % (e,
-                                                     traceback.format_exc()))
-
-        # Making sure difi response and all contained calls are valid - remember
-        # that the range is generating 0-3 and stopping at 4 (so it is correctly
-        # generating a 4-call range)
-        response = self.__r.json()
-        if not validate_difi_response(response, range(4)):
-            raise Exception('The DiFi page request to get number of unread '
-                            'notes, deviations etc succeeded but the DiFi '
-                            'request failed:\n\n%s\n' % response)
-
-        # Copying current messages state to 'old' fields
-        state.old_comments = state.comments[:]
-        state.old_comments_count = state.comments_count
-        state.old_replies = state.replies[:]
-        state.old_replies_count = state.replies_count
-        state.old_unread_notes = state.unread_notes[:]
-        state.old_unread_notes_count = state.unread_notes_count
-        state.old_deviations = state.deviations[:]
-        state.old_deviations_count = state.deviations_count
-
-        # Fetching and saving new message state. Note that replies are
-        # basically comments so the class is reused
-        state.comments = [Comment(int(hit['msgid']),
-                                 extract_text(hit['title'], True),
-                                 extract_text(hit['who'], True),
-                                 int(hit['ts']), hit['url'],
-                                 extract_text(hit['body']))
-                         for hit in response['DiFi']['response']['calls'][COMMENTS]['response']['content'][0]['result']['hits']]  # pylint: disable=line-too-long
-        state.comments_count = response['DiFi']['response']['calls'][COMMENTS]['response']['content'][0]['result']['count']  # pylint: disable=line-too-long
-        state.replies = [Comment(int(hit['msgid']),
-                                extract_text(hit['title'], True),
-                                extract_text(hit['who'], True),
-                                int(hit['ts']), hit['url'],
-                                extract_text(hit['body']))
-                        for hit in response['DiFi']['response']['calls'][REPLIES]['response']['content'][0]['result']['hits']]  # pylint: disable=line-too-long
-        state.replies_count = response['DiFi']['response']['calls'][REPLIES]['response']['content'][0]['result']['count']  # pylint: disable=line-too-long
-
-        # Special processing needs to be done for notes to fetch the text
-        state.unread_notes = []
-        for hit in response['DiFi']['response']['calls'][UNREAD_NOTES]['response']['content'][0]['result']['hits']:  # pylint: disable=line-too-long
-            note_ID = int(hit['msgid'])
-            note_title = extract_text(hit['title'], True)
-            try:
-                state.unread_notes.append(self.get_note_in_folder('unread',
-                                                                  note_ID))
-            except Exception as e:
-                raise Exception('Unable to get text of unread note ID \'%s\', '
-                                'title \'%s\':\n\n%s\n\n%s\n'
-                                % (note_ID, note_title, e,
-                                   traceback.format_exc()))
-        state.unread_notes_count = len(state.unread_notes)
-
-        # Deviation IDs come through in a mangled form - the msgid has the
-        # the structure '<number>:<deviation ID>', no idea what the number is
-        state.deviations = [Deviation(hit['msgid'].split(':')[1],
-                                     extract_text(hit['title'], True),
-                                     hit['url'],
-                                     extract_text(hit['username'], True),
-                                     int(hit['ts']))
-                           for hit in response['DiFi']['response']['calls'][DEVIATIONS]['response']['content'][0]['result']['hits']]  # pylint: disable=line-too-long
-        state.deviations_count = response['DiFi']['response']['calls'][DEVIATIONS]['response']['content'][0]['result']['count']  # pylint: disable=line-too-long
+        if messages_types is None:
+            messages_types = [COMMENTS, REPLIES, UNREAD_NOTES, DEVIATIONS]
+        messages_types = sorted(set(messages_types))
+        for messages_type in messages_types:
+            if messages_type not in MESSAGE_CENTER_VIEWS:
+                raise Exception('get_messages was called with an invalid '
+                                'messages_type (%s)' % messages_type)
+
+        # Fetch the first page of the relevant unread notes, deviations etc in
+        # one go, then anything further per type
+        results = self.__fetch_message_views([(messages_type, 0)
+                                              for messages_type
+                                              in messages_types])
+        for messages_type, result in zip(messages_types, results):
+            self.__update_messages(state, messages_type, result)
         state.save_state()
 
 
@@ -556,8 +880,8 @@ class DeviantArtService(object):
         # DiFi doesn't appear to provide a way to get a list of folders, so just
         # fetching and parsing the notes page
         try:
-            notifications_url = 'http://www.deviantart.com/notifications/notes'
-            self.__r = self.__s.get(notifications_url, timeout=60)
+            notifications_url = self.__base_url + '/notifications/notes'
+            self.__r = self.__get(notifications_url, timeout=60)
             self.__r.raise_for_status()
 
         except Exception as e:
@@ -565,48 +889,16 @@ class DeviantArtService(object):
                             '\n' % (e, traceback.format_exc()))
 
         # Parsing page
-        self.__last_content = bs4.BeautifulSoup(self.__r.content, 'lxml')
-
-        # Determining list of note folders
-        note_folders = []
-        for folder_link in self.__last_content.select('a.folder-link'):
-
-            # Validating link data
-            if 'data-folderid' not in folder_link.attrs:
-                raise Exception('Unable to obtain the folder ID from link tag '
-                                '\'%s\' - failed to generate a list of notes '
-                                'folders in the get_notes_folders call!'
-                                % folder_link)
-            if 'title' not in folder_link.attrs:
-                raise Exception('Unable to obtain the folder title from link tag'
-                                '\'%s\' - failed to generate a list of notes '
-                                'folders in the get_notes_folders call!'
-                                % folder_link)
-
-            # 'rel' is actually the count of contained notes, used as a
-            # sanity check . Note that even though there is only one rel attribute,
-            # Beautiful Soup returns a list?? Also need to remove thousands
-            # separator etc
-            if 'rel' not in folder_link.attrs:
-                raise Exception('Unable to obtain the folder notes count from '
-                                'link tag \'%s\' - failed to generate a list of '
-                                'notes folders in the get_notes_folders call!'
-                                % folder_link)
-            notes_count = int(folder_link.attrs['rel'][0].replace(',', ''))
-
-            note_folder = NoteFolder(folder_link.attrs['data-folderid'],
-                                           folder_link.attrs['title'])
-            note_folder.site_note_count = notes_count
-            note_folders.append(note_folder)
-
+        self.__last_content = self.__parse(bs4.BeautifulSoup,
+                                            self.__r.content, 'lxml')
+        note_folders = self.__parse(parse_note_folders, self.__last_content)
+        self.__finish_request()
         return note_folders
 
 
     def get_note_in_folder(self, folder_ID, note_ID):
         '''Fetch a note from a folder'''
 
-        # pylint: disable=too-many-branches,too-many-locals,too-many-statements
-
         # Dealing with special folder_IDs - remember not to update the folder_ID
         # variable so that you don't permanently corrupt it
         prepared_folder_ID = format_note_folder_id(folder_ID)
@@ -620,7 +912,7 @@ class DeviantArtService(object):
                            % (prepared_folder_ID, note_ID)],
                      'ui': urllib.parse.unquote(self.__s.cookies['userinfo']),
                      't': 'json'}
-            self.__r = self.__s.post(self.__difi_url, data=data, timeout=60)
+            self.__r = self.__post(self.__difi_url, data=data, timeout=60)
             self.__r.raise_for_status()
 
         except Exception as e:
@@ -630,7 +922,7 @@ class DeviantArtService(object):
                                traceback.format_exc()))
 
         # Making sure difi response and all contained calls are valid
-        response = self.__r.json()
+        response = self.__parse(self.__r.json)
         if not validate_difi_response(response, range(1)):
             raise Exception('The DiFi page request to fetch note ID \'%s\' from'
                             ' folder ID \'%s\' succeeded but the DiFi request '
@@ -638,197 +930,43 @@ class DeviantArtService(object):
                             % (note_ID, folder_ID, response))
 
         # Actual note data is returned in HTML
-        html_data = bs4.BeautifulSoup(response['DiFi']['response']['calls'][0]['response']['content']['body'], 'lxml')  # pylint: disable=line-too-long
-
-        # Fetching note title and validating
-        note_span = html_data.select_one('span.mcb-title')
-        if not note_span:
-            raise Exception('Unable to obtain note title from the following note'
-                            ' HTML:\n\n%s\n\nProblem occurred while fetching '
-                            'note ID \'%s\' from folder ID \'%s\''
-                            % (html_data.text, note_ID, folder_ID))
-        note_title = note_span.text
-
-        # Fetching sender details and validating
-        sender_span = html_data.select_one('span.mcb-from')
-        if not sender_span:
-            raise Exception('Unable to obtain note sender from the following '
-                            'note HTML:\n\n%s\n\nProblem occurred while fetching'
-                            ' note ID \'%s\' from folder ID \'%s\''
-                            % (html_data.text, note_ID, folder_ID))
-        if 'username' not in sender_span.attrs:
-            raise Exception('Unable to obtain note sender username from the '
-                            'following note HTML:\n\n%s\n\nProblem occurred '
-                            'while fetching note ID \'%s\' from folder ID \'%s\''
-                            % (html_data.text, note_ID, folder_ID))
-        note_sender = sender_span.attrs['username']
-
-        # Fetching recipient details and validating (this has meaning in the
-        # sent folder)
-        recipient_span = html_data.select_one('span.mcb-to')
-        if not recipient_span:
-            raise Exception('Unable to obtain note recipient (recipient span) '
-                            'from the following note HTML:\n\n%s\n\nProblem '
-                            'occurred while fetching note ID \'%s\' from folder'
-                            ' ID \'%s\'' % (html_data.text, note_ID, folder_ID))
-        recipient_link = recipient_span.select_one('a.username')
-        if not recipient_link:
-
-            # pylint: disable=line-too-long
-            # Banned users have their username displayed differently, e.g.:
-            # '<span class="mcb-to">to <span class="username-with-symbol"><span class="banned username">CrimsonColt7</span><span class="user-symbol banned" data-gruser-type="banned" data-quicktip-text="Banned or Deactivated/Closed Account" data-show-tooltip="1"></span></span></span>'
-            recipient_link = recipient_span.select_one('span.username')
-            if not recipient_link:
-                raise Exception('Unable to obtain note recipient (recipient '
-                                'link) from the following note HTML:\n\n%s\n\n'
-                                'Problem occurred while fetching note ID \'%s\''
-                                'from folder ID \'%s\''
-                                % (html_data.text, note_ID, folder_ID))
-        note_recipient = recipient_link.text
-
-        # Fetching timestamp and validating
-        timestamp_span = html_data.select_one('span.mcb-ts')
-        if not timestamp_span:
-            raise Exception('Unable to obtain timestamp span from the '
-                            'following note HTML:\n\n%s\n\nProblem occurred'
-                            ' while fetching note ID \'%s\' from folder ID \'%s\''
-                            % (html_data.text, note_ID, folder_ID))
-        if 'title' not in timestamp_span.attrs:
-            raise Exception('Unable to obtain timestamp \'title\' from the '
-                            'timestamp span from the following note HTML:'
-                            '\n\n%s\n\nProblem occurred while fetching note ID '
-                            '\'%s\' from folder ID \'%s\''
-                            % (html_data.text, note_ID, folder_ID))
-        note_timestamp = timestamp_span.attrs['title']
-
-        # If the timestamp includes 'ago', its not the proper timestamp - after
-        # notes get ~1 week old, deviantART switches the proper timestamp into
-        # the tag text rather than the title attribute
-        if 'ago' in note_timestamp:
-            note_timestamp = timestamp_span.text
-
-        try:
-
-            # Converting the deviantART datetime string into a proper UNIX
-            # timestamp
-            # Example: 'Jun 9, 2014, 11:08:28 PM'
-            note_timestamp = datetime.datetime.strptime(note_timestamp,
-                                                '%b %d, %Y, %I:%M:%S %p')
-            note_timestamp = note_timestamp.timestamp()
-
-        except ValueError as e:
-            raise Exception('Unable to parse timestamp \'%s\' from note ID '
-                            '\'%s\' while fetching note from folder ID \'%s\':'
-                            '\n\n%s\n\n%s\n'
-                            % (note_timestamp, note_ID, folder_ID, e,
-                               traceback.format_exc()))
-
-        # Fetching note HTML and validating
-        div_wraptext = html_data.select_one('.mcb-body.wrap-text')
-        if not div_wraptext:
-            raise Exception('Unable to parse note text from the following note '
-                            'HTML:\n\n%s\n\nProblem occurred while '
-                            'fetching note ID \'%s\' from from folder ID \'%s\''
-                            % (html_data, note_ID, folder_ID))
-
-        # Turn deviantART post into sensible text
-        note_text = deviantart_post_to_text(div_wraptext)
-
-        # Finally instantiating the note
-        note = Note(note_ID, note_title, note_sender, note_recipient,
-                    note_timestamp, note_text, folder_ID)
-
+        note = self.__parse(parse_note, response['DiFi']['response']['calls'][0]['response']['content']['body'],  # pylint: disable=line-too-long
+                            note_ID, folder_ID)
+        self.__finish_request()
         return note
 
 
-    def get_note_ids_in_folder(self, folder_ID):
-        '''Fetch all note IDs in a set from specified folder (one DiFi call per
-        25 notes) - used to audit note IDs stored in the database'''
-
-        # Dealing with special folder_IDs
-        folder_ID = format_note_folder_id(folder_ID)
+    def get_note_previews_in_folder(self, folder_ID):
+        '''Fetch a dictionary of note ID -> note for all notes in the specified
+        folder (one DiFi call per 25 notes), with note being None unless made
+        from its preview (see get_note_previews_in_folder_page)'''
 
-        note_ids = set()
-        offset = 0
+        note_previews = {}
+        note_offset = 0
         while True:
-
-            notes_detected = False
-
-            try:
-
-                # The 'ui' field in the form is actually the 'userinfo' cookie -
-                # its not directly usable via the cookie value, have to urldecode.
-                # This is on top of having the correct login cookies...
-                data = {'c[]': ['"Notes","display_folder",[%s,%s,0]'
-                               % (folder_ID, offset)],
-                         'ui': urllib.parse.unquote(self.__s.cookies['userinfo']),
-                         't': 'json'}
-                self.__r = self.__s.post(self.__difi_url, data=data, timeout=60)
-                self.__r.raise_for_status()
-
-            except Exception as e:
-                raise Exception('Unable to fetch note IDs from offset \'%s\' '
-                                'from folder ID \'%s\':\n\n%s\n\n%s\n'
-                                % (offset, folder_ID, e,
-                                   traceback.format_exc()))
-
-            # Making sure difi response and all contained calls are valid
-            response = self.__r.json()
-            if not validate_difi_response(response, range(1)):
-                raise Exception('The DiFi page request to fetch note IDs from '
-                                'offset \'%s\' from folder ID \'%s\' succeeded '
-                                'but the DiFi request failed:\n\n%s\n'
-                                % (offset, folder_ID, response))
-
-            # Actual note data is returned in HTML
-            html_data = bs4.BeautifulSoup(response['DiFi']['response']['calls'][0]['response']['content']['body'], 'lxml')  # pylint: disable=line-too-long
-
-            for listitem_tag in html_data.select('li.note'):
-
-                notes_detected = True
-
-                # Fetching note details and validating
-                note_details = listitem_tag.select_one('.note-details')
-                if not note_details:
-                    raise Exception('Unable to parse note details from the '
-                                    'following note HTML:\n\n%s\n\nProblem '
-                                    'occurred while fetching note IDs from '
-                                    'offset \'%s\' from folder ID \'%s\''
-                                    % (listitem_tag, offset, folder_ID))
-
-                # Fetching note ID and validating
-                note_details_link = note_details.select_one('span > a')
-                if not note_details_link:
-                    raise Exception('Unable to parse note details link from the '
-                                    ' following note HTML:\n\n%s\n\nProblem '
-                                    'occurred while fetching note IDs from '
-                                    'offset \'%s\' from folder ID \'%s\''
-                                    % (listitem_tag, offset, folder_ID))
-                if 'data-noteid' not in note_details_link.attrs:
-                    raise Exception('Unable to obtain note ID from note details '
-                                    'link from the following note HTML:\n\n%s'
-                                    '\n\nProblem occurred while fetching notes '
-                                    'from offset \'%s\' from folder ID \'%s\''
-                                    % (listitem_tag, offset, folder_ID))
-
-                # Collecting obtained note_ID - note that these IDs are supposed
-                # to be ints, affects set comparisons etc (int !=str)
-                note_ids.add(int(note_details_link.attrs['data-noteid']))
+            page_note_previews = self.get_note_previews_in_folder_page(
+                folder_ID, note_offset)
 
             # Breaking if no notes were returned
-            if not notes_detected:
+            if not page_note_previews:
                 break
+            for note_ID, _, note in page_note_previews:
+                note_previews[note_ID] = note
 
             # Looping - notes are available in 25-note pages
-            offset += 25
+            note_offset += NOTES_PAGE_SIZE
 
-        return note_ids
+        return note_previews
 
 
-    def get_notes_in_folder(self, folder_ID, note_offset):
-        '''Fetch desired notes from specified folder, with the offset allowing
-        you to page through the folder (max 25 notes are returned by
-        deviantART), note data is fetched in separate DiFi calls'''
+    def get_note_previews_in_folder_page(self, folder_ID, note_offset):
+        '''Fetch (note ID, unread, note) for the notes in one page of the
+        specified folder, with the offset allowing you to page through the
+        folder (max 25 notes are returned by deviantART), newest first - in the
+        sent folder, unread means the recipient hasn't read the note yet. note
+        is made from the preview in the listing when that is the whole note
+        (see parse_note_preview), otherwise it is None and the note must be
+        fetched with get_note_in_folder'''
 
         # Dealing with special folder_IDs - remember not to update the folder_ID
         # variable so that you don't permanently corrupt it
@@ -843,7 +981,7 @@ class DeviantArtService(object):
                            % (prepared_folder_ID, note_offset)],
                      'ui': urllib.parse.unquote(self.__s.cookies['userinfo']),
                      't': 'json'}
-            self.__r = self.__s.post(self.__difi_url, data=data, timeout=60)
+            self.__r = self.__post(self.__difi_url, data=data, timeout=60)
             self.__r.raise_for_status()
 
         except Exception as e:
@@ -853,7 +991,7 @@ class DeviantArtService(object):
                                traceback.format_exc()))
 
         # Making sure difi response and all contained calls are valid
-        response = self.__r.json()
+        response = self.__parse(self.__r.json)
         if not validate_difi_response(response, range(1)):
             raise Exception('The DiFi page request to fetch notes from offset '
                             '\'%s\' from folder ID \'%s\' succeeded but the DiFi'
@@ -863,9 +1001,9 @@ class DeviantArtService(object):
         # Actual note data is returned in HTML - note that this is actually a
         # preview (corrupted URLs and linebreaks), so notes must still be fetched
         # individually
-        html_data = bs4.BeautifulSoup(response['DiFi']['response']['calls'][0]['response']['content']['body'], 'lxml')  # pylint: disable=line-too-long
+        html_data = self.__parse(bs4.BeautifulSoup, response['DiFi']['response']['calls'][0]['response']['content']['body'], 'lxml')  # pylint: disable=line-too-long
 
-        notes = []
+        note_previews = []
         for listitem_tag in html_data.select('li.note'):
 
             # Fetching note details and validating
@@ -891,85 +1029,18 @@ class DeviantArtService(object):
                                 ' occurred while fetching notes from offset '
                                 '\'%s\' from folder ID \'%s\''
                                 % (listitem_tag, note_offset, folder_ID))
-            note_ID = note_details_link.attrs['data-noteid']
-
-            # Fetching the note text and metadata separately - it turns out that
-            # at this level you really do just get a preview, which has corrupted
-            # links and collapsed newlines
-            notes.append(self.get_note_in_folder(folder_ID, note_ID))
-
-        return notes
-
-
-    def get_unread_sent_notes(self):
-        '''Fetch up to 25 sent notes (one page's worth) that have not been read
-        by the recipient'''
-
-        try:
-
-            # The 'ui' field in the form is actually the 'userinfo' cookie -
-            # its not directly usable via the cookie value, have to urldecode.
-            # This is on top of having the correct login cookies...
-            data = {'c[]': ['"Notes","display_folder",[%s,%s,0]' % ('2', 0)],
-                     'ui': urllib.parse.unquote(self.__s.cookies['userinfo']),
-                     't': 'json'}
-            self.__r = self.__s.post(self.__difi_url, data=data, timeout=60)
-            self.__r.raise_for_status()
-
-        except Exception as e:
-            raise Exception('Unable to fetch sent notes from offset 0:\n\n'
-                            '%s\n\n%s\n' % (e, traceback.format_exc()))
-
-        # Making sure difi response and all contained calls are valid
-        response = self.__r.json()
-        if not validate_difi_response(response, range(1)):
-            raise Exception('The DiFi page request to fetch notes from offset 0'
-                            ' from folder ID \'%s\' succeeded but the DiFi'
-                            ' request failed:\n\n%s\n' % ('2', response))
-
-        # Actual note data is returned in HTML
-        html_data = bs4.BeautifulSoup(response['DiFi']['response']['calls'][0]['response']['content']['body'], 'lxml')  # pylint: disable=line-too-long
-
-        # Luckily we can select precisely the unread notes here - the
-        # class-based CSS selector here isn't a hierarchy but defines a list
-        # item with both the note and unread classes
-        notes = []
-        for listitem_tag in html_data.select('li.note.unread'):
-
-            # Fetching note details and validating
-            note_details = listitem_tag.select_one('.note-details')
-            if not note_details:
-                raise Exception('Unable to parse note details from the following'
-                                ' note HTML:\n\n%s\n\nProblem occurred while '
-                                'fetching unsent notes from offset 0'
-                                % listitem_tag)
-
-            # Fetching note ID and validating
-            note_details_link = note_details.select_one('span > a')
-            if not note_details_link:
-                raise Exception('Unable to parse note details link from the '
-                                ' following note HTML:\n\n%s\n\nProblem occurred'
-                                ' while fetching unsent notes from offset 0'
-                                % listitem_tag)
-            if 'data-noteid' not in note_details_link.attrs:
-                raise Exception('Unable to obtain note ID from note details link'
-                                ' from the following note HTML:\n\n%s\n\nProblem'
-                                ' occurred while fetching unsent notes from '
-                                'offset 0' % listitem_tag)
-            note_ID = note_details_link.attrs['data-noteid']
-
-            # Fetching the note text and metadata separately - it turns out that
-            # at this level you really do just get a preview, which has corrupted
-            # links and collapsed newlines
-            notes.append(self.get_note_in_folder('2', note_ID))
-
-        return notes
-
 
-    def last_page_content(self):
-        '''The last normal page loaded by requests'''
+            # Note IDs are supposed to be ints, affects comparisons etc. Unread
+            # notes are list items with both the note and unread classes
+            note_ID = int(note_details_link.attrs['data-noteid'])
+            note_previews.append((note_ID,
+                                  'unread' in listitem_tag.get('class', ()),
+                                  parse_note_preview(listitem_tag, note_ID,
+                                                     folder_ID,
+                                                     self.__account_name)))
 
-        return self.__last_content
+        self.__finish_request()
+        return note_previews
 
 
     def login(self):
@@ -979,9 +1050,9 @@ class DeviantArtService(object):
         # dynamic hidden fields. Using a Session object persists cookies and
         # maintains Keep-Alive
         try:
-            login_url = 'https://www.deviantart.com/users/login'
+            login_url = self.__base_url + '/users/login'
             self.__s = requests.Session()
-            self.__r = self.__s.get(login_url, timeout=60)
+            self.__r = self.__get(login_url, timeout=60)
             self.__r.raise_for_status()
 
         except Exception as e:
@@ -989,7 +1060,8 @@ class DeviantArtService(object):
                             '\n' % (e, traceback.format_exc()))
 
         # Parsing page
-        self.__last_content = bs4.BeautifulSoup(self.__r.content, 'lxml')
+        self.__last_content = self.__parse(bs4.BeautifulSoup,
+                                            self.__r.content, 'lxml')
 
         # Locating login form
         login_form = self.__last_content.find('form', id='login')
@@ -1020,7 +1092,7 @@ class DeviantArtService(object):
                        'validate_token': validate_token,
                        'validate_key': validate_key,
                        'remember_me': 1}
-            self.__r = self.__s.post(login_url, data=payload, timeout=60)
+            self.__r = self.__post(login_url, data=payload, timeout=60)
             self.__r.raise_for_status()
 
         except Exception as e:
@@ -1031,21 +1103,49 @@ class DeviantArtService(object):
         self.logged_in = True
 
         # Updating recorded page content
-        self.__last_content = bs4.BeautifulSoup(self.__r.content, 'lxml')
+        self.__last_content = self.__parse(bs4.BeautifulSoup,
+                                            self.__r.content, 'lxml')
+
+        # The account's name as deviantART shows it, which can differ from the
+        # username logged in with (e.g. in case) - notes made from previews
+        # need it to match notes fetched in full
+        self.__account_name = parse_account_name(self.__last_content)
+        self.__finish_request()
+
+
+class Record(object):
+    '''Base of the slotted classes representing things on deviantART - a lot of
+    these are held at once (whole galleries, Message Center state), so they
+    don't carry a __dict__. They are pickled and saved in YAML as a mapping of
+    their fields as before, with fields missing from older saved state set to
+    None'''
+
+    # pylint: disable=too-few-public-methods
+
+    __slots__ = ()
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__}
 
+    def __setstate__(self, state):
+        for name in self.__slots__:
+            setattr(self, name, state.get(name))
 
-class Comment:
+
+class Comment(Record):
     '''Represents a comment or reply (the latter is basically a comment. Replies
     are called 'Feedback Messages' on deviantART'''
 
     # pylint: disable=too-few-public-methods, too-many-arguments
 
+    __slots__ = ('ID', 'title', 'who', 'ts', 'URL', 'body')
+
     def __init__(self, ID, title, who, ts, URL, body):
 
         self.ID = ID
         self.title = title  # This is a description of the page the comment is
                             # on
-        self.who = who
+        self.who = intern_text(who)
         self.ts = ts
         self.URL = URL
         self.body = body
@@ -1067,11 +1167,14 @@ class Comment:
         return not self.__eq__(other)
 
 
-class Deviation:
+class Deviation(Record):
     '''Represents a deviation'''
 
     # pylint: disable=too-few-public-methods,too-many-arguments
 
+    __slots__ = ('ID', 'title', 'URL', 'username', 'ts', 'description',
+                 'fingerprint', 'file_URL', 'folders')
+
     # Optional parameters to allow a for a more sparse Deviation object when
     # representing all deviations through fetching the All gallery
     # (see get_all_deviations) - fetching ts and description here when its not
@@ -1079,8 +1182,11 @@ class Deviation:
     # a gallery for data that wouldn't be used)
     # Folders is a list of DeviationFolders that represent the deviation/gallery
     # folders the deviation is part of
+    # Fingerprint is a hash of the deviation page content and file_URL the link
+    # to the deviation's image/original file ('' when there is none), both only
+    # available when the deviation has been fetched via get_deviation
     def __init__(self, ID, title, URL, username, ts=None, description=None,
-                 folders=None):
+                 folders=None, fingerprint=None, file_URL=None):
 
         # Making sure ID is an int if it is passed in as a string (this is
         # relied on for comparisons, the ID increments over time)
@@ -1093,16 +1199,15 @@ class Deviation:
         self.ID = ID
         self.title = title
         self.URL = URL
-        self.username = username
+        self.username = intern_text(username)
         self.ts = ts
         self.description = description
+        self.fingerprint = fingerprint
+        self.file_URL = file_URL
 
-        # Python can't cope with a list as a default value, so working around
-        # this here
-        if folders is None:
-            self.folders = []
-        else:
-            self.folders = folders
+        # Most deviations are in no folders or aren't fetched with them, so
+        # these share one empty sequence rather than having a list each
+        self.folders = folders or NO_FOLDERS
 
     def __hash__(self, *args, **kwargs):
 
@@ -1126,11 +1231,13 @@ class Deviation:
         return 'Deviation (\'%s\')' % self.title
 
 
-class DeviationFolder:
+class DeviationFolder(Record):
     '''Represents a folder that a deviation is attached to in a user gallery'''
 
     # pylint: disable=too-few-public-methods
 
+    __slots__ = ('ID', 'title', 'description', 'URL')
+
     def __init__(self, ID, title, description, URL):
 
         # Making sure ID is an int if it is passed in as a string (this is
@@ -1167,11 +1274,14 @@ class DeviationFolder:
         return 'DeviationFolder (\'%s\')' % self.title
 
 
-class Note:
+class Note(Record):
     '''Represents a note'''
 
     # pylint: disable=too-few-public-methods,too-many-arguments
 
+    __slots__ = ('ID', 'title', 'sender', 'recipient', 'ts', 'text',
+                 'folder_ID')
+
     # Notes have normally been populated via the MessageCenter view, which
     # doesn't include the note text - however this is now available
     # Rather than a Note, this is more a 'note view', since one Note can be in
@@ -1189,11 +1299,11 @@ class Note:
 
         self.ID = ID
         self.title = title
-        self.sender = sender
-        self.recipient = recipient
+        self.sender = intern_text(sender)
+        self.recipient = intern_text(recipient)
         self.ts = ts
         self.text = text
-        self.folder_ID = folder_ID
+        self.folder_ID = intern_text(folder_ID)
 
 
     def __hash__(self, *args, **kwargs):
@@ -1218,16 +1328,18 @@ class Note:
         return 'Note (\'%s\')' % self.title
 
 
-class NoteFolder:
+class NoteFolder(Record):
     '''Represents a default or custom folder for notes (in reality a view on
     applicable notes in deviantART'''
 
     # pylint: disable=too-few-public-methods
 
+    __slots__ = ('ID', 'title', 'site_note_count')
+
     def __init__(self, ID, title):
 
         # ID is actually text, can be actual strings like 'unread'
-        self.ID = ID
+        self.ID = intern_text(ID)
         self.title = title
 
         # Useful stat to use as a heuristic for unnoticed change detection
@@ -1255,6 +1367,152 @@ class NoteFolder:
         return 'NoteFolder (\'%s\')' % self.title
 
 
+class Instrumentation(object):
+    '''Told about every request DeviantArtService makes once it is finished
+    with - subclass and override request_finished. Cloned services share their
+    instrumentation, so this must be thread-safe'''
+
+    def request_finished(self, record):
+        '''Called with the RequestRecord of a finished request'''
+
+        pass
+
+    def close(self):
+        '''Release any resources held'''
+
+        pass
+
+
+class JSONLinesInstrumentation(Instrumentation):
+    '''Appends each request record to a file as a line of JSON'''
+
+    def __init__(self, file_path):
+        self.file_path = os.path.expanduser(file_path)
+        self.__lock = threading.Lock()
+        try:
+            self.__file = io.open(self.file_path, 'a')
+        except Exception as e:
+            raise Exception('Unable to open request log \'%s\':\n\n%s\n\n%s\n'
+                            % (self.file_path, e, traceback.format_exc()))
+
+    def request_finished(self, record):
+        line = json.dumps(record.to_dict(), sort_keys=True)
+        with self.__lock:
+            self.__file.write(line + '\n')
+            self.__file.flush()
+
+    def close(self):
+        with self.__lock:
+            self.__file.close()
+
+
+class RequestRecord(object):
+    '''What happened during one request made by DeviantArtService - times are
+    in seconds'''
+
+    # pylint: disable=too-many-instance-attributes,too-few-public-methods
+
+    def __init__(self, method, URL, params, data, stream):
+        self.ID = next(request_IDs)
+        self.method = method
+        self.URL = URL
+        self.difi_calls = difi_call_names(params, data)
+        self.stream = stream
+        self.status = None
+        self.bytes_received = 0
+        self.error = None
+
+        # Retries are made by fetch_concurrently
+        self.attempt = getattr(request_context, 'attempt', 0)
+        self.thread_ID = threading.get_ident()
+        self.thread_name = threading.current_thread().name
+
+        # Time waiting for the request limiter, then time until the response
+        # was received (or fully downloaded for streamed responses). Parse spans
+        # are (start, duration) tuples, with the start as a UNIX timestamp
+        self.started = time.time()
+        self.queue_start = self.network_start = time.perf_counter()
+        self.queue_time = self.network_time = 0.0
+        self.parse_spans = []
+
+    @property
+    def parse_time(self):
+        '''Total time spent parsing the response'''
+
+        return sum(duration for _, duration in self.parse_spans)
+
+    def to_dict(self):
+        '''Record as a JSON-serialisable dict'''
+
+        return {'id': self.ID, 'method': self.method, 'url': self.URL,
+                'difi_calls': self.difi_calls, 'status': self.status,
+                'bytes_received': self.bytes_received, 'error': self.error,
+                'attempt': self.attempt, 'thread': self.thread_name,
+                'started': self.started, 'queue_time': self.queue_time,
+                'network_time': self.network_time,
+                'parse_time': self.parse_time}
+
+
+class TraceInstrumentation(Instrumentation):
+    '''Writes each request as spans in the Trace Event Format, so that a run
+    can be viewed on a timeline in chrome://tracing or Perfetto. The file is
+    usable while still being written (the closing bracket is optional)'''
+
+    def __init__(self, file_path):
+        self.file_path = os.path.expanduser(file_path)
+        self.__lock = threading.Lock()
+        self.__named_threads = set()
+        self.__first_event = True
+        try:
+            self.__file = io.open(self.file_path, 'w')
+            self.__file.write('[')
+        except Exception as e:
+            raise Exception('Unable to open request trace \'%s\':\n\n%s\n\n'
+                            '%s\n' % (self.file_path, e,
+                                       traceback.format_exc()))
+
+    def request_finished(self, record):
+
+        def span(name, start, duration, args=None):
+            event = {'name': name, 'cat': 'devart', 'ph': 'X',
+                     'ts': start * 1000000, 'dur': duration * 1000000,
+                     'pid': os.getpid(), 'tid': record.thread_ID}
+            if args:
+                event['args'] = args
+            return event
+
+        # The request span covers the wait for the request limiter and the
+        # network time, with the parsing of the response following it
+        request_name = (', '.join(record.difi_calls) or '%s %s'
+                        % (record.method,
+                           urllib.parse.urlsplit(record.URL).path))
+        events = [span(request_name, record.started,
+                       record.queue_time + record.network_time,
+                       record.to_dict())]
+        if record.queue_time:
+            events.append(span('request limiter wait', record.started,
+                               record.queue_time))
+        events += [span('parse', start, duration)
+                   for start, duration in record.parse_spans]
+
+        with self.__lock:
+            if record.thread_ID not in self.__named_threads:
+                self.__named_threads.add(record.thread_ID)
+                events.insert(0, {'name': 'thread_name', 'ph': 'M',
+                                  'pid': os.getpid(), 'tid': record.thread_ID,
+                                  'args': {'name': record.thread_name}})
+            for event in events:
+                self.__file.write(('\n' if self.__first_event else ',\n') +
+                                  json.dumps(event, sort_keys=True))
+                self.__first_event = False
+            self.__file.flush()
+
+    def close(self):
+        with self.__lock:
+            self.__file.write('\n]\n')
+            self.__file.close()
+
+
 def extract_text(html_text, collapse_lines=False):
     '''Extract lines of text from HTML tags - this honours linebreaks'''
 
@@ -1266,6 +1524,40 @@ def extract_text(html_text, collapse_lines=False):
     return text if not collapse_lines else text.replace('\n', ' ')
 
 
+def corpus_key(method, URL, params=None, data=None):
+    '''Key identifying a request in a recorded response corpus - independent of
+    the site being accessed, session-specific fields and parameter order'''
+
+    split_URL = urllib.parse.urlsplit(URL)
+    path = split_URL.path
+
+    # deviantART serves galleries etc from user subdomains, these are keyed
+    # as if they were served under the main site (as done when the site base
+    # URL has been changed)
+    hostname = split_URL.hostname or ''
+    if (hostname.endswith('.deviantart.com') and
+            hostname != 'www.deviantart.com'):
+        path = '/' + hostname.split('.')[0] + path
+
+    # Flattening query, params and data fields, which may have list values
+    fields = urllib.parse.parse_qsl(split_URL.query)
+    for field_dict in (params, data):
+        for name, value in (field_dict or {}).items():
+            values = value if isinstance(value, list) else [value]
+            fields += [(name, str(field_value)) for field_value in values]
+    fields = sorted(field for field in fields
+                    if field[0] not in CORPUS_IGNORED_FIELDS)
+
+    return '%s %s?%s' % (method.upper(), path, urllib.parse.urlencode(fields))
+
+
+def corpus_response_path(corpus_directory, key):
+    '''Path to the recorded response for the passed corpus key'''
+
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return os.path.join(corpus_directory, digest[:2], digest)
+
+
 def deviantart_post_to_text(div_tag):
     '''Turn deviantART post contained in the passed div tag into sensible text'''
 
@@ -1287,6 +1579,42 @@ def deviantart_post_to_text(div_tag):
     return div_tag.text.strip()
 
 
+def diff_IDs(old_IDs, new_IDs):
+    '''Compare two collections of IDs, returning the sets of IDs added, removed
+    and unchanged. Compare IDs rather than the objects themselves - hashing and
+    comparing plain IDs is done entirely in C rather than via the objects'
+    Python-level __hash__ and __eq__'''
+
+    if not isinstance(old_IDs, (set, frozenset)):
+        old_IDs = set(old_IDs)
+    if not isinstance(new_IDs, (set, frozenset)):
+        new_IDs = set(new_IDs)
+    unchanged_IDs = old_IDs & new_IDs
+    return new_IDs - unchanged_IDs, old_IDs - unchanged_IDs, unchanged_IDs
+
+
+def difi_call_names(params, data):
+    '''Names of the DiFi calls made in a request (e.g. Notes.display_note)'''
+
+    names = []
+    for fields in (params, data):
+        if not fields or 'c[]' not in fields:
+            continue
+        calls = fields['c[]']
+        if isinstance(calls, str):
+            calls = [calls]
+
+        # Calls come as either '"Notes","display_note",[...]' or
+        # 'MessageCenter;get_views;...'
+        for call in calls:
+            if call.startswith('"'):
+                names.append('.'.join(part.strip('"')
+                                      for part in call.split(',')[:2]))
+            else:
+                names.append('.'.join(call.split(';')[:2]))
+    return names
+
+
 def deviation_url_to_id(deviation_URL):
     '''Extract a deviation ID from a deviation URL'''
 
@@ -1297,6 +1625,53 @@ def deviation_url_to_id(deviation_URL):
     return int(match.groups()[0])
 
 
+def fetch_concurrently(fetch, items, workers, retries=2, retry_delay=5):
+    '''Call fetch(item) for each item with a bounded pool of worker threads,
+    yielding (item, result, exception) tuples in the order of the items as soon
+    as each is available (exception is None on success). Failed calls are
+    retried, and the final exception is yielded rather than raised so that one
+    bad item doesn't abort the rest'''
+
+    def fetch_with_retries(item):
+        try:
+            for attempt in range(retries + 1):
+
+                # Letting request records know which attempt this is
+                request_context.attempt = attempt
+                try:
+                    return fetch(item), None
+                except Exception as e:  # pylint: disable=broad-except
+                    if attempt == retries:
+                        return None, e
+
+                # Backing off a little more on each attempt
+                time.sleep(retry_delay * (attempt + 1))
+        finally:
+            request_context.attempt = 0
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+
+        # Only a limited window of fetches is kept in flight, so that results
+        # don't pile up in memory when the consumer is slower than the workers
+        window = collections.deque()
+        for item in items:
+            window.append((item, executor.submit(fetch_with_retries, item)))
+            if len(window) >= workers * 2:
+                item, future = window.popleft()
+                yield (item,) + future.result()
+        while window:
+            item, future = window.popleft()
+            yield (item,) + future.result()
+
+
+def fingerprint(*parts):
+    '''Generate a fingerprint of the passed strings/tags, used to detect
+    changes without having to keep and compare the full content'''
+
+    return hashlib.sha1('\0'.join(str(part) for part in parts)
+                        .encode('utf-8')).hexdigest()
+
+
 def format_note_folder_id(folder_ID):
     '''Dealing with special folder_IDs that are genuinely strings (e.g.
     unread') - these need to be speechmark-delimited for deviantART not to
@@ -1308,24 +1683,409 @@ def format_note_folder_id(folder_ID):
         return folder_ID
 
 
+def gallery_page_request(base_URL, username, deviation_offset):
+    '''URL and parameters of the 'All' gallery page listing a user's deviations
+    from the passed offset'''
+
+    # On deviantART itself galleries are served from the user's subdomain
+    if base_URL.rstrip('/') == DEVIANTART_URL:
+        gallery_URL = 'https://%s.deviantart.com/gallery/' % username
+    else:
+        gallery_URL = '%s/%s/gallery/' % (base_URL.rstrip('/'), username)
+
+    # The catpath parameter is the 'all' selector
+    return gallery_URL, {'catpath': '/', 'offset': deviation_offset}
+
+
 def get_new(state, messages_type):
-    '''Determining what new messages have been fetched'''
+    '''Determining what new messages have been fetched, newest first'''
 
     # Dealing with different message types requested
     if messages_type == COMMENTS:
-        return set(state.comments) - set(state.old_comments)
+        messages, old_messages = state.comments, state.old_comments
     elif messages_type == REPLIES:
-        return set(state.replies) - set(state.old_replies)
+        messages, old_messages = state.replies, state.old_replies
     elif messages_type == UNREAD_NOTES:
-        return set(state.unread_notes) - set(state.old_unread_notes)
+        messages, old_messages = state.unread_notes, state.old_unread_notes
     elif messages_type == DEVIATIONS:
-        return set(state.deviations) - set(state.old_deviations)
+        messages, old_messages = state.deviations, state.old_deviations
     else:
 
         # Invalid messages_type passed
         raise Exception('get_new was called with an invalid messages_type'
                         ' (%s)' % messages_type)
 
+    new_IDs = diff_IDs([message.ID for message in old_messages],
+                       [message.ID for message in messages])[0]
+    return [message for message in messages if message.ID in new_IDs]
+
+
+def instrumentation_from_config(config):
+    '''Create the instrumentation asked for in a script's configuration -
+    request_log is a file to append JSON request records to, request_trace a
+    file to write a Trace Event Format timeline to'''
+
+    instrumentation = []
+    if config.get('request_log'):
+        instrumentation.append(JSONLinesInstrumentation(config['request_log']))
+    if config.get('request_trace'):
+        instrumentation.append(TraceInstrumentation(config['request_trace']))
+    return instrumentation
+
+
+def intern_text(value):
+    '''Interns text repeated across many objects (usernames, folder IDs) so that
+    only one copy is kept - this also turns Beautiful Soup strings into plain
+    ones, which would otherwise keep their whole page alive'''
+
+    if isinstance(value, str):
+        return sys.intern(str(value))
+    return value
+
+
+def message_hit_ID(messages_type, hit):
+    '''ID of a message in a Message Center view's hits'''
+
+    # Deviation IDs come through in a mangled form - the msgid has the
+    # the structure '<number>:<deviation ID>', no idea what the number is
+    if messages_type == DEVIATIONS:
+        return int(hit['msgid'].split(':')[1])
+    return int(hit['msgid'])
+
+
+def parse_account_name(page):
+    '''Extract the logged in account's name from the header of a deviantART
+    page (an already-parsed BeautifulSoup document), or None when it isn't
+    shown'''
+
+    username_span = page.select_one('#oh-menu-deviant .username')
+    if username_span is None or not username_span.text.strip():
+        return None
+    return username_span.text.strip()
+
+
+def parse_gallery_page(page, username, deviation_offset,
+                       fetch_deviation_folder):
+    '''Extract the deviations listed in an 'All' gallery page (HTML or an
+    already-parsed BeautifulSoup document) - fetch_deviation_folder is called
+    with the URL of each newly-seen deviation folder to obtain its details'''
+
+    # pylint: disable=too-many-locals
+
+    if not isinstance(page, bs4.BeautifulSoup):
+        page = bs4.BeautifulSoup(page, 'lxml')
+
+    # Locating the main stream div (it turns out that classes like 'tt-a'
+    # are also used outside of the deviations listing)
+    div_deviations = page.select_one('div#gmi-ResourceStream')
+    if div_deviations is None:
+        raise Exception('Unable to locate the main div containing the '
+                        'deviations in the gallery page - HTML:\n\n%s\n'
+                        % page)
+
+    known_deviation_folders = {}
+    deviations = []
+    for deviation_span in div_deviations.select('span.thumb'):
+
+        # Fetching the deviation link and validating
+        if 'href' not in deviation_span.attrs:
+            raise Exception('Unable to fetch the href from the following '
+                            'deviation span:\n\n%s\n\nProblem occurred '
+                            'while fetching all deviations from '
+                            'offset \'%s\''
+                            % (deviation_span, deviation_offset))
+
+        deviation_URL = deviation_span.attrs['href']
+
+        # Fetching deviation ID
+        if 'data-deviationid' not in deviation_span.attrs:
+            raise Exception('Unable to fetch the deviation ID from the '
+                            'following deviation span:\n\n%s\n\nProblem '
+                            'occurred while fetching all deviations from '
+                            'offset \'%s\''
+                            % (deviation_span, deviation_offset))
+
+        deviation_ID = deviation_span.attrs['data-deviationid']
+
+        # Fetching deviation title and validating
+        title_span = deviation_span.select_one('span.title')
+        if title_span is None:
+            raise Exception('Unable to locate the title span for deviation '
+                            'ID \'%s\' from the following deviation span:\n'
+                            '\n%s\n\nProblem occurred while fetching all '
+                            'deviations from offset \'%s\''
+                            % (deviation_ID, deviation_span,
+                               deviation_offset))
+
+        deviation_title = title_span.text
+
+        # Fetching deviation folders involved and validating (being
+        # associated with no folders is perfectly acceptable)
+        # 16.02.17: dA appears to have redone the HTML here such that folders
+        # are no longer available via deviation records in the main gallery
+        # bit (they aren't available in the deviation's page either)... so
+        # this effectively kills off folder recording for now
+        folder_link_tags = deviation_span.select('span.gallections a')
+        deviation_folders = []
+        for folder_link_tag in folder_link_tags:
+            folder_URL = folder_link_tag.attrs['href']
+            folder_title = folder_link_tag.text
+
+            # Caching deviation folders so that you don't have to fetch the
+            # folder page every time to get the description
+            if folder_title in known_deviation_folders:
+
+                # Folder has already been fetched - using current data
+                deviation_folders.append(known_deviation_folders[folder_title])
+
+            else:
+
+                # Folder is new - fetching full information from its page (
+                # description isn't available otherwise)
+                deviation_folder = fetch_deviation_folder(folder_URL)
+                deviation_folders.append(deviation_folder)
+
+                # Adding to cache
+                known_deviation_folders[folder_title] = deviation_folder
+
+        # All deviation detail fetched, constructing
+        deviations.append(Deviation(deviation_ID, deviation_title,
+                                    deviation_URL, username,
+                                    folders=deviation_folders))
+
+    return deviations
+
+
+def parse_note(html_text, note_ID, folder_ID):
+    '''Extract a note from the HTML DiFi returns when displaying it'''
+
+    # pylint: disable=too-many-branches
+
+    html_data = bs4.BeautifulSoup(html_text, 'lxml')
+
+    # Fetching note title and validating
+    note_span = html_data.select_one('span.mcb-title')
+    if not note_span:
+        raise Exception('Unable to obtain note title from the following note'
+                        ' HTML:\n\n%s\n\nProblem occurred while fetching '
+                        'note ID \'%s\' from folder ID \'%s\''
+                        % (html_data.text, note_ID, folder_ID))
+    note_title = note_span.text
+
+    # Fetching sender details and validating
+    sender_span = html_data.select_one('span.mcb-from')
+    if not sender_span:
+        raise Exception('Unable to obtain note sender from the following '
+                        'note HTML:\n\n%s\n\nProblem occurred while fetching'
+                        ' note ID \'%s\' from folder ID \'%s\''
+                        % (html_data.text, note_ID, folder_ID))
+    if 'username' not in sender_span.attrs:
+        raise Exception('Unable to obtain note sender username from the '
+                        'following note HTML:\n\n%s\n\nProblem occurred '
+                        'while fetching note ID \'%s\' from folder ID \'%s\''
+                        % (html_data.text, note_ID, folder_ID))
+    note_sender = sender_span.attrs['username']
+
+    # Fetching recipient details and validating (this has meaning in the
+    # sent folder)
+    recipient_span = html_data.select_one('span.mcb-to')
+    if not recipient_span:
+        raise Exception('Unable to obtain note recipient (recipient span) '
+                        'from the following note HTML:\n\n%s\n\nProblem '
+                        'occurred while fetching note ID \'%s\' from folder'
+                        ' ID \'%s\'' % (html_data.text, note_ID, folder_ID))
+    recipient_link = recipient_span.select_one('a.username')
+    if not recipient_link:
+
+        # pylint: disable=line-too-long
+        # Banned users have their username displayed differently, e.g.:
+        # '<span class="mcb-to">to <span class="username-with-symbol"><span class="banned username">CrimsonColt7</span><span class="user-symbol banned" data-gruser-type="banned" data-quicktip-text="Banned or Deactivated/Closed Account" data-show-tooltip="1"></span></span></span>'
+        recipient_link = recipient_span.select_one('span.username')
+        if not recipient_link:
+            raise Exception('Unable to obtain note recipient (recipient '
+                            'link) from the following note HTML:\n\n%s\n\n'
+                            'Problem occurred while fetching note ID \'%s\''
+                            'from folder ID \'%s\''
+                            % (html_data.text, note_ID, folder_ID))
+    note_recipient = recipient_link.text
+
+    # Fetching timestamp and validating
+    timestamp_span = html_data.select_one('span.mcb-ts')
+    if not timestamp_span:
+        raise Exception('Unable to obtain timestamp span from the '
+                        'following note HTML:\n\n%s\n\nProblem occurred'
+                        ' while fetching note ID \'%s\' from folder ID \'%s\''
+                        % (html_data.text, note_ID, folder_ID))
+    if 'title' not in timestamp_span.attrs:
+        raise Exception('Unable to obtain timestamp \'title\' from the '
+                        'timestamp span from the following note HTML:'
+                        '\n\n%s\n\nProblem occurred while fetching note ID '
+                        '\'%s\' from folder ID \'%s\''
+                        % (html_data.text, note_ID, folder_ID))
+    note_timestamp = parse_note_timestamp(timestamp_span, note_ID, folder_ID)
+
+    # Fetching note HTML and validating
+    div_wraptext = html_data.select_one('.mcb-body.wrap-text')
+    if not div_wraptext:
+        raise Exception('Unable to parse note text from the following note '
+                        'HTML:\n\n%s\n\nProblem occurred while '
+                        'fetching note ID \'%s\' from from folder ID \'%s\''
+                        % (html_data, note_ID, folder_ID))
+
+    # Turn deviantART post into sensible text
+    note_text = deviantart_post_to_text(div_wraptext)
+
+    # Finally instantiating the note
+    note = Note(note_ID, note_title, note_sender, note_recipient,
+                note_timestamp, note_text, folder_ID)
+
+    return note
+
+
+def parse_note_timestamp(timestamp_span, note_ID, folder_ID):
+    '''Convert the timestamp span of a note (or note preview) into a UNIX
+    timestamp'''
+
+    note_timestamp = timestamp_span.attrs['title']
+
+    # If the timestamp includes 'ago', its not the proper timestamp - after
+    # notes get ~1 week old, deviantART switches the proper timestamp into
+    # the tag text rather than the title attribute
+    if 'ago' in note_timestamp:
+        note_timestamp = timestamp_span.text
+
+    try:
+
+        # Converting the deviantART datetime string into a proper UNIX
+        # timestamp
+        # Example: 'Jun 9, 2014, 11:08:28 PM'
+        note_timestamp = datetime.datetime.strptime(note_timestamp,
+                                                    '%b %d, %Y, %I:%M:%S %p')
+        return note_timestamp.timestamp()
+
+    except ValueError as e:
+        raise Exception('Unable to parse timestamp \'%s\' from note ID '
+                        '\'%s\' while fetching note from folder ID \'%s\':'
+                        '\n\n%s\n\n%s\n'
+                        % (note_timestamp, note_ID, folder_ID, e,
+                           traceback.format_exc()))
+
+
+def parse_note_preview(listitem_tag, note_ID, folder_ID, account_name):
+    '''Make a note from its list item in a note folder listing when the
+    preview shown there is the whole note, otherwise returning None -
+    account_name is the account's name as deviantART shows it (see
+    parse_account_name), the listing only showing the other party of the note,
+    with None meaning the note must be fetched in full. Previews collapse
+    linebreaks, mangle links and cut long notes short with an ellipsis, so
+    only a preview of plain text without any markup or ellipsis is trusted,
+    along with the title, other party and timestamp all being listed'''
+
+    # pylint: disable=too-many-return-statements
+
+    if account_name is None:
+        return None
+    preview_div = listitem_tag.select_one('.note-preview')
+    if preview_div is None or preview_div.find(True) is not None:
+        return None
+    note_text = preview_div.text.strip()
+    if note_text.endswith(('...', '\u2026')):
+        return None
+
+    # The list item shows who the note is from, or in the sent folder, who it
+    # is to
+    title_link = listitem_tag.select_one('.note-details span > a')
+    other_party_link = listitem_tag.select_one('.note-details .sender '
+                                               'a.username, .note-details '
+                                               '.recipient a.username')
+    timestamp_span = listitem_tag.select_one('.note-details .ts[title]')
+    if title_link is None or other_party_link is None or \
+            timestamp_span is None:
+        return None
+    if 'sender' in other_party_link.parent.get('class', ()):
+        note_sender, note_recipient = other_party_link.text, account_name
+    else:
+        note_sender, note_recipient = account_name, other_party_link.text
+
+    try:
+        note_timestamp = parse_note_timestamp(timestamp_span, note_ID,
+                                              folder_ID)
+    except Exception:  # pylint: disable=broad-except
+        return None
+
+    return Note(note_ID, title_link.text, note_sender, note_recipient,
+                note_timestamp, note_text, folder_ID)
+
+
+def parse_note_folders(page):
+    '''Extract the note folders linked to from the notes page (HTML or an
+    already-parsed BeautifulSoup document)'''
+
+    if not isinstance(page, bs4.BeautifulSoup):
+        page = bs4.BeautifulSoup(page, 'lxml')
+
+    # Determining list of note folders
+    note_folders = []
+    for folder_link in page.select('a.folder-link'):
+
+        # Validating link data
+        if 'data-folderid' not in folder_link.attrs:
+            raise Exception('Unable to obtain the folder ID from link tag '
+                            '\'%s\' - failed to generate a list of notes '
+                            'folders in the get_notes_folders call!'
+                            % folder_link)
+        if 'title' not in folder_link.attrs:
+            raise Exception('Unable to obtain the folder title from link tag'
+                            '\'%s\' - failed to generate a list of notes '
+                            'folders in the get_notes_folders call!'
+                            % folder_link)
+
+        # 'rel' is actually the count of contained notes, used as a
+        # sanity check . Note that even though there is only one rel attribute,
+        # Beautiful Soup returns a list?? Also need to remove thousands
+        # separator etc
+        if 'rel' not in folder_link.attrs:
+            raise Exception('Unable to obtain the folder notes count from '
+                            'link tag \'%s\' - failed to generate a list of '
+                            'notes folders in the get_notes_folders call!'
+                            % folder_link)
+        notes_count = int(folder_link.attrs['rel'][0].replace(',', ''))
+
+        note_folder = NoteFolder(folder_link.attrs['data-folderid'],
+                                 folder_link.attrs['title'])
+        note_folder.site_note_count = notes_count
+        note_folders.append(note_folder)
+
+    return note_folders
+
+
+def record_response(corpus_directory, key, content):
+    '''Save the content of a response to the passed corpus directory'''
+
+    response_path = corpus_response_path(corpus_directory, key)
+    try:
+        os.makedirs(os.path.dirname(response_path), exist_ok=True)
+
+        # Writing atomically as concurrent workers may record the same response
+        temporary_path = '%s.%s' % (response_path, threading.get_ident())
+        with io.open(temporary_path, 'wb') as response_file:
+            response_file.write(content)
+        os.replace(temporary_path, response_path)
+
+    except Exception as e:
+        raise Exception('Unable to record response for \'%s\' to \'%s\':'
+                        '\n\n%s\n\n%s\n'
+                        % (key, response_path, e, traceback.format_exc()))
+
+
+def summarise_error(error):
+    '''One-line summary of an exception for request records - the full
+    messages embed whole pages'''
+
+    lines = [line for line in str(error).splitlines() if line.strip()]
+    summary = '%s: %s' % (type(error).__name__, lines[0] if lines else '')
+    return summary[:200]
+
 
 def validate_difi_response(response, call_numbers):
     '''Determining if the overall DiFi page call and all associated function
@@ -1333,7 +2093,7 @@ def validate_difi_response(response, call_numbers):
 
     # Making sure call_numbers is iterable - e.g. just one call number was
     # passed
-    if not isinstance(call_numbers, collections.Sequence):
+    if not isinstance(call_numbers, collections.abc.Sequence):
         call_numbers = [call_numbers]
 
     # Failing if overall call failed
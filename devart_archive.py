@@ -0,0 +1,365 @@
+'''
+Copyright (c) 2017, OmegaPhil - OmegaPhil@startmail.com
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+# Storage of note bodies in the notes archive (see the notes downloader).
+# tbl_note.text holds either the plain text of a note, or when compression or
+# deduplication is configured and actually saves space, an encoded BLOB - both
+# can be mixed in one database, so the storage mode can be changed at any time
+# (and deviantart-notes-migrate.py brings existing notes into line). Readers
+# should use the note_text SQL function that NoteStorage and connect()
+# register, e.g. 'select note_text(text) from tbl_note', or the view_note view -
+# note_text is a Python function, so neither works in other SQLite tools. Both
+# settings are off by default, leaving the text readable by anything
+#
+# Encoded BLOBs start with the codec ('n' for none, 'z' for zlib or 's' for
+# zstd), then 'c' when chunked, otherwise '-' - zstd then has the 4 byte ID of
+# the dictionary used (0 for none). When deduplicating, paragraphs of at least
+# CHUNK_MIN_LENGTH characters (e.g. quoted earlier messages in a long-running
+# conversation) are stored once in tbl_note_chunk - the text is then made up of
+# segments separated by NUL characters, with every other segment being the ID
+# of a chunk
+
+import hashlib
+import importlib
+import re
+import sqlite3
+import traceback
+import zlib
+
+import devart_config
+
+
+STORAGE_MODES = ('plain', 'zlib', 'zstd')
+
+# Paragraphs shorter than this aren't worth storing separately
+CHUNK_MIN_LENGTH = 200
+
+# Compression levels - zstd's default level is already about as good as zlib's
+# best, at a fraction of the cost
+ZLIB_LEVEL = 9
+ZSTD_LEVEL = 3
+
+# Paragraphs are separated by blank lines
+PARAGRAPH_SEPARATOR_REGEX = re.compile(r'(\n[ \t]*\n\s*)')
+
+# The storage settings of the notes downloader's configuration, see
+# devart_config
+CONFIG_SCHEMA = {
+    'note_storage': devart_config.Setting(str, 'plain',
+                                          choices=STORAGE_MODES),
+    'deduplicate_note_text': devart_config.Setting(bool, False)}
+
+
+class NoteStorage(object):
+    '''Encodes note bodies for tbl_note.text as configured (mode is one of
+    STORAGE_MODES, with deduplicate storing long paragraphs once in
+    tbl_note_chunk), and decodes any stored form. The tables needed are
+    created in the passed connection if missing, and note_text is registered
+    with it'''
+
+    def __init__(self, con, mode='plain', deduplicate=False):
+        if mode not in STORAGE_MODES:
+            raise Exception('Note storage mode \'%s\' is invalid - please use '
+                            '%s' % (mode, '/'.join('\'%s\'' % storage_mode
+                                                   for storage_mode
+                                                   in STORAGE_MODES)))
+        self.con = con
+        self.mode = mode
+        self.deduplicate = deduplicate
+        self.__chunk_texts = {}
+        self.__zstd_decompressors = {}
+        self.__zstd_compressor = None
+        self.__zstd_dictionary_ID = 0
+
+        # zstd is optional, only being needed when configured or when reading
+        # notes stored with it
+        self.__zstandard = None
+        if mode == 'zstd':
+            self.__zstandard = import_zstandard()
+
+        con.executescript('''
+            create table if not exists tbl_note_chunk (
+                id integer primary key not null,
+                sha256 text unique not null,
+                text not null);
+            create table if not exists tbl_note_chunks (
+                fk_note_id integer not null references tbl_note
+                    on delete cascade,
+                fk_chunk_id integer not null references tbl_note_chunk,
+                primary key (fk_note_id, fk_chunk_id)
+            ) without rowid;
+            create index if not exists fk_chunk_id
+                on tbl_note_chunks(fk_chunk_id);
+            create table if not exists tbl_note_dictionary (
+                id integer primary key not null,
+                data blob not null);
+
+            /* Notes with their text decoded, for connections with note_text
+             * registered */
+            create view if not exists view_note as
+                select id, title, sender, recipient, timestamp,
+                    note_text(text) as text
+                from tbl_note;
+        ''')
+        con.create_function('note_text', 1, self.decode, deterministic=True)
+
+        # New notes are compressed with the latest dictionary trained on the
+        # archive, if any
+        if mode == 'zstd':
+            dictionary = con.execute('''
+                select id, data
+                from tbl_note_dictionary
+                order by id desc
+                limit 1
+            ''').fetchone()
+            self.__use_zstd_dictionary(*(dictionary or (0, None)))
+
+    def __compress(self, payload):
+        if self.mode == 'zlib':
+            return b'z', zlib.compress(payload, ZLIB_LEVEL)
+        if self.mode == 'zstd':
+            return b's', (self.__zstd_dictionary_ID.to_bytes(4, 'big') +
+                          self.__zstd_compressor.compress(payload))
+        return b'n', payload
+
+    def __decompress(self, codec, data):
+        if codec == b'n':
+            return data
+        if codec == b'z':
+            return zlib.decompress(data)
+        if codec == b's':
+            return self.__get_zstd_decompressor(
+                int.from_bytes(data[:4], 'big')).decompress(data[4:])
+        raise Exception('Unknown note text codec \'%s\'' % codec)
+
+    def __encode(self, text, chunked=False):
+
+        # Text is kept as it is unless encoding actually saves space, which for
+        # short notes it won't - their text then stays readable by anything
+        payload = text.encode('utf-8')
+        codec, data = self.__compress(payload)
+        if not chunked and 2 + len(data) >= len(payload):
+            return text
+        return codec + (b'c' if chunked else b'-') + data
+
+    def __get_zstd_decompressor(self, dictionary_ID):
+        decompressor = self.__zstd_decompressors.get(dictionary_ID)
+        if decompressor is None:
+            if self.__zstandard is None:
+                self.__zstandard = import_zstandard()
+            dictionary = None
+            if dictionary_ID:
+                row = self.con.execute('''
+                    select data
+                    from tbl_note_dictionary
+                    where id = ?
+                ''', (dictionary_ID,)).fetchone()
+                if row is None:
+                    raise Exception('Note text compression dictionary ID %d '
+                                    'is missing' % dictionary_ID)
+                dictionary = self.__zstandard.ZstdCompressionDict(row[0])
+            decompressor = self.__zstandard.ZstdDecompressor(
+                dict_data=dictionary)
+            self.__zstd_decompressors[dictionary_ID] = decompressor
+        return decompressor
+
+    def __get_chunk_text(self, chunk_ID):
+        text = self.__chunk_texts.get(chunk_ID)
+        if text is None:
+            row = self.con.execute('''
+                select text
+                from tbl_note_chunk
+                where id = ?
+            ''', (chunk_ID,)).fetchone()
+            if row is None:
+                raise Exception('Note text chunk ID %d is missing' % chunk_ID)
+            text = self.__chunk_texts[chunk_ID] = self.decode(row[0])
+        return text
+
+    def __record_chunk(self, text):
+        sha256 = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        self.con.execute('''
+            insert or ignore into tbl_note_chunk(sha256, text)
+            values(?, ?)
+        ''', (sha256, self.__encode(text)))
+        return self.con.execute('''
+            select id
+            from tbl_note_chunk
+            where sha256 = ?
+        ''', (sha256,)).fetchone()[0]
+
+    def __use_zstd_dictionary(self, dictionary_ID, data):
+        dictionary = (self.__zstandard.ZstdCompressionDict(data)
+                      if data is not None else None)
+        self.__zstd_compressor = self.__zstandard.ZstdCompressor(
+            level=ZSTD_LEVEL, dict_data=dictionary)
+        self.__zstd_dictionary_ID = dictionary_ID
+
+    def decode(self, value):
+        '''Return the note text of a stored tbl_note.text value'''
+
+        if not isinstance(value, bytes):
+            return value
+        try:
+            text = self.__decompress(value[:1], value[2:]).decode('utf-8')
+            if value[1:2] == b'c':
+                segments = text.split('\0')
+                segments[1::2] = [self.__get_chunk_text(int(chunk_ID))
+                                  for chunk_ID in segments[1::2]]
+                text = ''.join(segments)
+            return text
+        except Exception as e:
+            raise Exception('Unable to decode stored note text:\n\n%s\n\n%s\n'
+                            % (e, traceback.format_exc()))
+
+    def delete_unused_chunks(self):
+        '''Delete chunks no longer used by any note, returning the number
+        deleted'''
+
+        self.__chunk_texts.clear()
+        return self.con.execute('''
+            delete from tbl_note_chunk
+            where not exists (
+                select 1
+                from tbl_note_chunks nc
+                where nc.fk_chunk_id = tbl_note_chunk.id
+            )
+        ''').rowcount
+
+    def encode(self, text):
+        '''Return the value to store in tbl_note.text for the passed note text,
+        and the IDs of the chunks it uses (to be passed to record_chunks once
+        the note is recorded)'''
+
+        # Paragraphs are split out with the separators kept alongside, so the
+        # text is put back together exactly. NUL can't appear in the text
+        # itself, as it separates the segments
+        chunk_IDs = []
+        if self.deduplicate and len(text) >= CHUNK_MIN_LENGTH and \
+                '\0' not in text:
+            segments = ['']
+            for part in PARAGRAPH_SEPARATOR_REGEX.split(text):
+                if len(part) >= CHUNK_MIN_LENGTH and \
+                        not PARAGRAPH_SEPARATOR_REGEX.fullmatch(part):
+                    chunk_IDs.append(self.__record_chunk(part))
+                    segments += [str(chunk_IDs[-1]), '']
+                else:
+                    segments[-1] += part
+            if chunk_IDs:
+                return self.__encode('\0'.join(segments), True), chunk_IDs
+        return self.__encode(text), chunk_IDs
+
+    def recode_chunks(self, batch_size=1000):
+        '''Store every chunk as currently configured (see recode_note)'''
+
+        chunk_ID = 0
+        while True:
+            chunks = self.con.execute('''
+                select id, text
+                from tbl_note_chunk
+                where id > ?
+                order by id
+                limit ?
+            ''', (chunk_ID, batch_size)).fetchall()
+            if not chunks:
+                return
+            for chunk_ID, value in chunks:
+                self.con.execute('''
+                    update tbl_note_chunk
+                    set text = ?
+                    where id = ?
+                ''', (self.__encode(self.decode(value)), chunk_ID))
+
+    def recode_note(self, note_ID, value):
+        '''Store the text of a recorded note (value being its current
+        tbl_note.text) as currently configured - used to migrate the archive
+        after changing the storage mode. Chunks no longer used afterwards are
+        left for delete_unused_chunks'''
+
+        text, chunk_IDs = self.encode(self.decode(value))
+        self.con.execute('''
+            update tbl_note
+            set text = ?
+            where id = ?
+        ''', (text, note_ID))
+        self.con.execute('''
+            delete from tbl_note_chunks
+            where fk_note_id = ?
+        ''', (note_ID,))
+        self.record_chunks(note_ID, chunk_IDs)
+
+    def record_chunks(self, note_ID, chunk_IDs):
+        '''Record that a note uses the passed chunks (see encode)'''
+
+        self.con.executemany('''
+            insert or ignore into tbl_note_chunks(fk_note_id, fk_chunk_id)
+            values(?, ?)
+        ''', ((note_ID, chunk_ID) for chunk_ID in chunk_IDs))
+
+    def train_dictionary(self, size):
+        '''Train a zstd dictionary of up to size bytes on the archive's notes,
+        which new notes are then compressed with, returning its ID - short notes
+        compress far better with one'''
+
+        # Samples are taken from the newest notes, up to 100 times the size of
+        # the dictionary
+        samples = []
+        samples_size = 0
+        for (value,) in self.con.execute('''
+                select text
+                from tbl_note
+                order by id desc
+        '''):
+            sample = self.decode(value).encode('utf-8')
+            samples.append(sample)
+            samples_size += len(sample)
+            if samples_size >= size * 100:
+                break
+
+        try:
+            dictionary = self.__zstandard.train_dictionary(size, samples)
+        except Exception as e:
+            raise Exception('Unable to train a note text compression '
+                            'dictionary on %d notes (too few notes?):\n\n%s\n'
+                            '\n%s\n' % (len(samples), e,
+                                        traceback.format_exc()))
+        dictionary_ID = self.con.execute('''
+            insert into tbl_note_dictionary(data)
+            values(?)
+        ''', (dictionary.as_bytes(),)).lastrowid
+        self.__use_zstd_dictionary(dictionary_ID, dictionary.as_bytes())
+        return dictionary_ID
+
+
+def connect(database_path):
+    '''Open a notes archive with note_text registered, to read notes whatever
+    form their text is stored in'''
+
+    con = sqlite3.connect(database_path)
+    NoteStorage(con)
+    return con
+
+
+def import_zstandard():
+    '''Import the optional zstandard module'''
+
+    try:
+        return importlib.import_module('zstandard')
+    except ImportError:
+        raise Exception('The zstandard module is needed for zstd note '
+                        'storage - please install it (e.g. \'pip install '
+                        'zstandard\')')
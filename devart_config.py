@@ -0,0 +1,233 @@
+'''
+Copyright (c) 2017, OmegaPhil - OmegaPhil@startmail.com
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+# Loading of the scripts' configuration - each script's own YAML document along
+# with credentials.conf, which is shared amongst the scripts. Settings are
+# validated against a schema once, and the result is kept until either file's
+# modification time (or size) changes, so the long-running checkers can look for
+# changes between polls for next to nothing and pick them up without a restart
+
+import copy
+import io
+import numbers
+import os
+import os.path
+import sys
+import traceback
+
+import yaml
+
+
+CONFIG_DIRECTORY = '~/.config/deviantart-scripts'
+
+# How often the checkers look for changes to their configuration while waiting
+# for the next poll
+RELOAD_CHECK_SECONDS = 10
+
+# How kinds of values are described in errors
+KIND_DESCRIPTIONS = {bool: 'true or false', dict: 'a YAML dictionary',
+                     int: 'a whole number', list: 'a YAML list',
+                     numbers.Number: 'a number', str: 'text'}
+
+
+class Setting(object):
+    '''A setting in a configuration schema. kind is the type of value accepted
+    (numbers.Number for any number), with missing settings taking a copy of
+    default unless required. minimum applies to numbers, choices to text or a
+    dictionary's keys, and items is the Setting every item of a list or value
+    of a dictionary must satisfy. Settings that need a restart keep their
+    original value when the configuration is reloaded'''
+
+    # pylint: disable=too-few-public-methods,too-many-arguments
+
+    def __init__(self, kind, default=None, required=False, minimum=None,
+                 choices=None, items=None, restart=False):
+        self.kind = kind
+        self.default = default
+        self.required = required
+        self.minimum = minimum
+        self.choices = choices
+        self.items = items
+        self.restart = restart
+
+    def validate(self, name, value):
+        '''Return the value validated, raising an exception describing the
+        problem otherwise. Numbers given for text are converted, as YAML turns
+        e.g. an all-digit password into one'''
+
+        # bools are also ints to Python
+        if self.kind is str and isinstance(value, numbers.Number) and \
+                not isinstance(value, bool):
+            value = str(value)
+        if not isinstance(value, self.kind) or (isinstance(value, bool) and
+                                                self.kind is not bool):
+            raise Exception('%s should be %s, not \'%s\''
+                            % (name, KIND_DESCRIPTIONS[self.kind], value))
+
+        if self.minimum is not None and value < self.minimum:
+            raise Exception('%s should be at least %s, not %s'
+                            % (name, self.minimum, value))
+        if self.choices is not None:
+            for choice in (value if isinstance(value, dict) else [value]):
+                if choice not in self.choices:
+                    raise Exception('\'%s\' in %s is invalid - please use %s'
+                                    % (choice, name,
+                                       '/'.join('\'%s\'' % choice
+                                                for choice in self.choices)))
+
+        if self.items is not None and isinstance(value, list):
+            value = [self.items.validate('%s item %d' % (name, item_number),
+                                         item)
+                     for item_number, item in enumerate(value, 1)]
+        elif self.items is not None and isinstance(value, dict):
+            value = {key: self.items.validate('%s -> \'%s\'' % (name, key),
+                                              item)
+                     for key, item in value.items()}
+        return value
+
+
+# Settings every script reads, normally from credentials.conf
+COMMON_SCHEMA = {'username': Setting(str, required=True, restart=True),
+                 'password': Setting(str, required=True, restart=True),
+                 'base_url': Setting(str, restart=True),
+                 'record_directory': Setting(str, restart=True),
+                 'request_log': Setting(str, restart=True),
+                 'request_trace': Setting(str, restart=True)}
+
+
+class ConfigLoader(object):
+    '''Loads a script's configuration file together with credentials.conf,
+    validated against schema (a dictionary of setting name -> Setting, in
+    addition to COMMON_SCHEMA). prepare is then called with the configuration
+    to work out anything derived from it, raising an exception if it is
+    invalid'''
+
+    def __init__(self, script_name, schema, prepare=None):
+        config_directory = os.path.expanduser(CONFIG_DIRECTORY)
+        self.config_file_path = os.path.join(config_directory,
+                                             script_name + '.conf')
+        self.credentials_file_path = os.path.join(config_directory,
+                                                  'credentials.conf')
+        self.schema = dict(COMMON_SCHEMA)
+        self.schema.update(schema)
+        self.prepare = prepare
+        self.config = None
+        self.__modification_times = None
+
+    def load(self):
+        '''Return the configuration - the files are only read and validated
+        again when they have changed since last time'''
+
+        modification_times = self.__get_modification_times()
+        if self.config is None or \
+                modification_times != self.__modification_times:
+            self.config = self.__parse()
+            self.__modification_times = modification_times
+        return self.config
+
+    def reload(self):
+        '''Return the new configuration when either file has changed since it
+        was last loaded, otherwise None. An invalid new configuration is raised
+        as an exception once, with the previous configuration kept until the
+        files change again'''
+
+        modification_times = self.__get_modification_times()
+        if modification_times == self.__modification_times:
+            return None
+        self.__modification_times = modification_times
+        config = self.__parse()
+
+        # Settings needing a restart carry on as they were
+        for name in sorted(self.schema):
+            if (self.schema[name].restart and
+                    config.get(name) != self.config.get(name)):
+                print('Changes to \'%s\' in the configuration only take effect '
+                      'once the script is restarted' % name, file=sys.stderr)
+                config[name] = self.config.get(name)
+
+        self.config = config
+        return config
+
+    def __get_modification_times(self):
+
+        # Sizes are included in case a file is rewritten within the filesystem's
+        # timestamp granularity
+        modification_times = []
+        for file_path in (self.config_file_path, self.credentials_file_path):
+            try:
+                status = os.stat(file_path)
+                modification_times.append((status.st_mtime_ns,
+                                           status.st_size))
+            except OSError:
+                modification_times.append(None)
+        return tuple(modification_times)
+
+    def __parse(self):
+
+        # Settings in credentials.conf win over the script's own - where each
+        # setting came from is kept for reporting problems
+        settings = {}
+        file_paths = {}
+        for file_path in (self.config_file_path, self.credentials_file_path):
+            document = load_document(file_path)
+            settings.update(document)
+            file_paths.update(dict.fromkeys(document, file_path))
+
+        # Ensuring required settings exist, and that everything configured is
+        # valid - settings not in the schema are passed through as-is
+        config = dict(settings)
+        for name, setting in self.schema.items():
+            if settings.get(name) is None:
+                if setting.required:
+                    raise Exception('Please ensure %s is configured in \'%s\''
+                                    % (name, self.credentials_file_path
+                                       if name in COMMON_SCHEMA
+                                       else self.config_file_path))
+                config[name] = copy.deepcopy(setting.default)
+                continue
+
+            try:
+                config[name] = setting.validate('\'%s\'' % name,
+                                                settings[name])
+            except Exception as e:
+                raise Exception('Invalid configuration in \'%s\': %s'
+                                % (file_paths[name], e))
+
+        if self.prepare is not None:
+            self.prepare(config)
+        return config
+
+
+def load_document(file_path):
+    '''Load a YAML document of settings - an empty document has none'''
+
+    if not os.path.exists(file_path):
+        raise Exception('Please create the configuration file \'%s\' (see the '
+                        'README)' % file_path)
+    try:
+        with io.open(file_path, 'r') as document_file:
+            settings = yaml.load(document_file, yaml.CLoader)
+    except Exception as e:
+        raise Exception('Unable to load config from YAML document \'%s\':\n\n'
+                        '%s\n\n%s\n' % (file_path, e, traceback.format_exc()))
+
+    if settings is None:
+        return {}
+    if not isinstance(settings, dict):
+        raise Exception('The YAML document \'%s\' should be a dictionary of '
+                        'settings' % file_path)
+    return settings
@@ -0,0 +1,266 @@
+'''
+Copyright (c) 2017, OmegaPhil - OmegaPhil@startmail.com
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+# Metrics for the long-running checkers, served over HTTP in the Prometheus
+# text exposition format so that many accounts' checkers can be scraped,
+# alerted on and graphed
+
+import http.server
+import re
+import threading
+import traceback
+import urllib.parse
+
+import devart
+import devart_config
+
+
+# The metrics settings of the checkers' configuration - the server is only
+# started once
+CONFIG_SCHEMA = {'metrics_port': devart_config.Setting(int, minimum=1,
+                                                       restart=True),
+                 'metrics_address': devart_config.Setting(str, restart=True)}
+
+# Histogram buckets in seconds
+POLL_DURATION_BUCKETS = (0.5, 1, 2, 5, 10, 30, 60, 120, 300)
+REQUEST_DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Metrics(object):
+    '''Thread-safe registry of counters, gauges and histograms - every metric
+    must be defined before use. constant_labels are added to every sample (e.g.
+    the account)'''
+
+    def __init__(self, constant_labels=None):
+        self.constant_labels = dict(constant_labels or {})
+        self.__lock = threading.Lock()
+
+        # Name -> (kind, help text, buckets), and name -> label values tuple
+        # -> value (histograms have [bucket counts, sum, count] as the value)
+        self.__definitions = {}
+        self.__values = {}
+
+    def define(self, name, kind, help_text, buckets=None):
+        '''Define a 'counter', 'gauge' or 'histogram' metric'''
+
+        if kind not in ('counter', 'gauge', 'histogram'):
+            raise Exception('Unable to define metric \'%s\' - invalid kind '
+                            '\'%s\'' % (name, kind))
+        with self.__lock:
+            self.__definitions[name] = (kind, help_text, tuple(buckets or ()))
+            self.__values.setdefault(name, {})
+
+    def increment(self, name, amount=1, **labels):
+        '''Increment a counter (or gauge)'''
+
+        key = self.__key(name, labels)
+        with self.__lock:
+            values = self.__values[name]
+            values[key] = values.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        '''Record a value in a histogram'''
+
+        key = self.__key(name, labels)
+        buckets = self.__definitions[name][2]
+        with self.__lock:
+            values = self.__values[name]
+            if key not in values:
+                values[key] = [[0] * len(buckets), 0.0, 0]
+            histogram = values[key]
+            for bucket_number, bucket in enumerate(buckets):
+                if value <= bucket:
+                    histogram[0][bucket_number] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def render(self):
+        '''Metrics in the Prometheus text exposition format'''
+
+        lines = []
+        with self.__lock:
+            for name, (kind, help_text, buckets) in sorted(
+                    self.__definitions.items()):
+                lines += ['# HELP %s %s' % (name, help_text),
+                          '# TYPE %s %s' % (name, kind)]
+                for key, value in sorted(self.__values[name].items()):
+                    labels = dict(self.constant_labels, **dict(key))
+                    if kind != 'histogram':
+                        lines.append('%s%s %s' % (name, format_labels(labels),
+                                                  format_value(value)))
+                        continue
+
+                    bucket_counts, total, count = value
+                    for bucket, bucket_count in zip(buckets, bucket_counts):
+                        lines.append('%s_bucket%s %d'
+                                     % (name, format_labels(dict(
+                                         labels, le=format_value(bucket))),
+                                        bucket_count))
+                    lines += ['%s_bucket%s %d'
+                              % (name, format_labels(dict(labels, le='+Inf')),
+                                 count),
+                              '%s_sum%s %s' % (name, format_labels(labels),
+                                               format_value(total)),
+                              '%s_count%s %d' % (name, format_labels(labels),
+                                                 count)]
+        return '\n'.join(lines) + '\n'
+
+    def set(self, name, value, **labels):
+        '''Set a gauge'''
+
+        key = self.__key(name, labels)
+        with self.__lock:
+            self.__values[name][key] = value
+
+    def __key(self, name, labels):
+        if name not in self.__definitions:
+            raise Exception('Metric \'%s\' has not been defined' % name)
+        return tuple(sorted((label, str(value))
+                            for label, value in labels.items()))
+
+
+class MetricsInstrumentation(devart.Instrumentation):
+    '''Records deviantART request counts, latencies and sizes by endpoint'''
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        metrics.define('deviantart_requests_total', 'counter',
+                       'Requests made to deviantART by endpoint and HTTP status '
+                       '(status is \'error\' when no response was received)')
+        metrics.define('deviantart_request_duration_seconds', 'histogram',
+                       'Network time of requests to deviantART by endpoint',
+                       REQUEST_DURATION_BUCKETS)
+        metrics.define('deviantart_request_parse_seconds_total', 'counter',
+                       'Time spent parsing responses by endpoint')
+        metrics.define('deviantart_response_bytes_total', 'counter',
+                       'Bytes received from deviantART by endpoint')
+
+    def request_finished(self, record):
+        endpoint = request_endpoint(record)
+        self.metrics.increment('deviantart_requests_total', endpoint=endpoint,
+                               status=record.status or 'error')
+        self.metrics.observe('deviantart_request_duration_seconds',
+                             record.network_time, endpoint=endpoint)
+        self.metrics.increment('deviantart_request_parse_seconds_total',
+                               record.parse_time, endpoint=endpoint)
+        self.metrics.increment('deviantart_response_bytes_total',
+                               record.bytes_received, endpoint=endpoint)
+
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    '''Serves the metrics at /metrics'''
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        '''Serve the metrics'''
+
+        if urllib.parse.urlsplit(self.path).path != '/metrics':
+            self.send_error(404)
+            return
+
+        content = self.server.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; '
+                         'charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+
+        # Scrapes aren't worth logging
+        pass
+
+
+class MetricsServer(http.server.ThreadingHTTPServer):
+    '''HTTP server exposing metrics for scraping'''
+
+    daemon_threads = True
+
+    def __init__(self, metrics, address):
+        super().__init__(address, MetricsRequestHandler)
+        self.metrics = metrics
+
+    def serve_in_background(self):
+        '''Start serving in a daemon thread, returning the thread'''
+
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+def define_checker_metrics(metrics):
+    '''Define the metrics common to the checker scripts'''
+
+    metrics.define('deviantart_poll_duration_seconds', 'histogram',
+                   'Time taken by each poll of deviantART by result',
+                   POLL_DURATION_BUCKETS)
+    metrics.define('deviantart_logins_total', 'counter',
+                   'Logins to deviantART by result')
+    metrics.define('deviantart_new_items_total', 'counter',
+                   'New items detected by type')
+    metrics.define('deviantart_last_success_timestamp_seconds', 'gauge',
+                   'UNIX time of the last successful poll')
+
+
+def format_labels(labels):
+    '''Format labels for a sample line'''
+
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (label, str(value)
+                                          .replace('\\', '\\\\')
+                                          .replace('"', '\\"')
+                                          .replace('\n', '\\n'))
+                             for label, value in sorted(labels.items()))
+
+
+def format_value(value):
+    '''Format a sample value'''
+
+    if isinstance(value, float) and value.is_integer():
+        return '%d' % value
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def request_endpoint(record):
+    '''Endpoint label for a request record - the DiFi calls made, or the path
+    with IDs and usernames generalised'''
+
+    if record.difi_calls:
+        return '+'.join(sorted(set(record.difi_calls)))
+    path = urllib.parse.urlsplit(record.URL).path
+    path = re.sub(r'/[^/]+/(art|gallery)/', r'/:user/\1/', path)
+    path = re.sub(r'/art/[^/]+$', '/art/:deviation', path)
+    return re.sub(r'/[0-9]+(/|$).*', r'/:id\1', path)
+
+
+def start_metrics_server(metrics, config):
+    '''Serve the metrics when 'metrics_port' is configured (on
+    'metrics_address', localhost by default), returning the server or None'''
+
+    if not config.get('metrics_port'):
+        return None
+
+    address = (config.get('metrics_address') or '127.0.0.1',
+               int(config['metrics_port']))
+    try:
+        server = MetricsServer(metrics, address)
+    except Exception as e:
+        raise Exception('Unable to serve metrics on %s:%s:\n\n%s\n\n%s\n'
+                        % (address[0], address[1], e, traceback.format_exc()))
+    server.serve_in_background()
+    return server
@@ -0,0 +1,503 @@
+'''
+Copyright (c) 2017, OmegaPhil - OmegaPhil@startmail.com
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+# Notifications for the checker scripts. Notifications are delivered by sinks
+# (running a command, sending email over SMTP, posting to a webhook or adding
+# to a maildir/mbox) configured in each script's configuration. Sinks are ran
+# by a dedicated worker thread so that a slow one (e.g. a mail server timing
+# out) never holds up polling deviantART - notifications that pile up meanwhile
+# are delivered to each sink as one batch
+
+import email.message
+import email.utils
+import http.client
+import json
+import mailbox
+import numbers
+import os.path
+import queue
+import shlex
+import smtplib
+import socket
+import subprocess
+import sys
+import threading
+import traceback
+import urllib.parse
+
+import devart_config
+
+
+# The notification settings of the checkers' configuration
+CONFIG_SCHEMA = {
+    'command_to_run': devart_config.Setting(str),
+    'command_to_run_on_failure': devart_config.Setting(str),
+    'notification_sinks': devart_config.Setting(
+        list, items=devart_config.Setting(dict)),
+    'failure_notification_sinks': devart_config.Setting(
+        list, items=devart_config.Setting(dict)),
+    'notification_timeout_seconds': devart_config.Setting(numbers.Number, 120,
+                                                          minimum=1),
+    'notification_retries': devart_config.Setting(int, 2, minimum=0),
+    'retry_failed_commands': devart_config.Setting(bool, False)}
+
+
+class Notification(object):
+    '''A subject and message to deliver'''
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, subject, message):
+        self.subject = subject
+        self.message = message
+
+
+class NotificationDispatcher(object):
+    '''Delivers notifications to sinks in the background, retrying failed
+    deliveries up to retries times retry_delay seconds apart'''
+
+    def __init__(self, retries=2, retry_delay=30):
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.__queue = queue.Queue()
+        self.__closing = threading.Event()
+        self.__sinks = []
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def close(self, timeout=None):
+        '''Deliver any queued notifications, stop the worker and close the
+        sinks, waiting up to timeout seconds. Retries are not waited for once
+        closing'''
+
+        self.__closing.set()
+        self.__queue.put(None)
+        self.__thread.join(timeout)
+
+    def notify(self, sinks, subject, message):
+        '''Queue a notification for delivery to each of the passed sinks,
+        returning immediately'''
+
+        for sink in sinks:
+            self.__queue.put((sink, Notification(subject, message)))
+
+    def retire(self, sinks):
+        '''Close the passed sinks once everything already queued for them has
+        been delivered (e.g. when the configuration has been reloaded)'''
+
+        for sink in sinks:
+            self.__queue.put((sink, None))
+
+    def __run(self):
+        while True:
+
+            # Taking everything that has queued up while the last delivery ran,
+            # so that it can be batched
+            items = [self.__queue.get()]
+            while True:
+                try:
+                    items.append(self.__queue.get_nowait())
+                except queue.Empty:
+                    break
+            closing = None in items
+            items = [item for item in items if item is not None]
+
+            # Batching per sink, keeping the order notifications were made in.
+            # Retired sinks come with no notification
+            sinks = []
+            retired_sinks = []
+            for sink, notification in items:
+                if notification is None:
+                    retired_sinks.append(sink)
+                    continue
+                if sink not in sinks:
+                    sinks.append(sink)
+                if sink not in self.__sinks:
+                    self.__sinks.append(sink)
+            for sink in sinks:
+                self.__deliver(sink, [notification
+                                      for item_sink, notification in items
+                                      if item_sink is sink and
+                                      notification is not None])
+            for sink in retired_sinks:
+                if sink in self.__sinks:
+                    self.__sinks.remove(sink)
+                self.__close_sink(sink)
+
+            if closing:
+                for sink in self.__sinks:
+                    self.__close_sink(sink)
+                return
+
+    def __close_sink(self, sink):
+        try:
+            sink.close()
+        except Exception as e:  # pylint: disable=broad-except
+            print('Unable to close notification sink %s:\n\n%s\n'
+                  % (sink, e), file=sys.stderr)
+
+    def __deliver(self, sink, notifications):
+
+        # Sinks remove notifications from the list as they are delivered, so
+        # retries only deliver what is left
+        for attempt in range(self.retries + 1):
+            try:
+                sink.send(notifications)
+                return
+            except Exception as e:  # pylint: disable=broad-except
+                error = '%s\n\n%s' % (e, traceback.format_exc())
+
+            if attempt < self.retries and not self.__closing.is_set():
+                self.__closing.wait(self.retry_delay)
+            else:
+                break
+
+        # The failure can only be reported here - notifying about it could
+        # easily fail the same way
+        print('Delivering %d notification(s) (\'%s\') to %s failed after %d '
+              'attempt(s):\n\n%s\n'
+              % (len(notifications), '\', \''.join(notification.subject
+                                                 for notification
+                                                 in notifications),
+                 sink, attempt + 1, error), file=sys.stderr)
+
+
+class NotificationSink(object):
+    '''Base class of notification sinks - subclass and override send.
+    subject_prefix is added to all subjects, and deliveries should give up
+    after timeout seconds'''
+
+    kind = None
+
+    def __init__(self, subject_prefix, timeout):
+        self.subject_prefix = subject_prefix
+        self.timeout = timeout
+
+    def __str__(self):
+        return '%s sink' % self.kind
+
+    def close(self):
+        '''Release any resources held between deliveries'''
+
+        pass
+
+    def send(self, notifications):
+        '''Deliver a batch of notifications, removing each from the list once
+        delivered - raise an exception on failure. Sinks must override this'''
+
+        raise NotImplementedError('%s doesn\'t implement send'
+                                  % type(self).__name__)
+
+
+class CommandSink(NotificationSink):
+    '''Runs a command (without a shell) with %s and %m replaced by the subject
+    and message - a batch is combined into one run of the command. A non-zero
+    exit status is only treated as a failure to retry when retry_failed is
+    set, otherwise it is just reported'''
+
+    kind = 'command'
+
+    def __init__(self, subject_prefix, timeout, command, retry_failed=False):
+        super().__init__(subject_prefix, timeout)
+        self.command = command
+        self.retry_failed = retry_failed
+
+    def __str__(self):
+        return 'command sink \'%s\'' % self.command
+
+    def send(self, notifications):
+
+        # Subjects are combined without repeats, messages in full
+        subjects = []
+        for notification in notifications:
+            if notification.subject not in subjects:
+                subjects.append(notification.subject)
+        command_fragments = generate_command_fragments(
+            self.command, self.subject_prefix + ', '.join(subjects),
+            '\n\n'.join(notification.message for notification in notifications))
+
+        # Running command without a shell
+        try:
+            process = subprocess.run(command_fragments, timeout=self.timeout,
+                                     check=False)
+        except subprocess.TimeoutExpired:
+            raise Exception('Command timed out after %s seconds' % self.timeout)
+
+        # Commands such as sendemail can exit with a failure status after
+        # delivering, so running them again would duplicate notifications
+        if process.returncode != 0:
+            if self.retry_failed:
+                raise Exception('Command failed with exit status %d'
+                                % process.returncode)
+            print('%s exited with status %d - not retrying as the '
+                  'notification may have been delivered (see '
+                  'retry_failed_commands)' % (self, process.returncode),
+                  file=sys.stderr)
+        del notifications[:]
+
+
+class MailboxSink(NotificationSink):
+    '''Adds each notification as an email to a local mailbox - 'maildir' or
+    'mbox' (a single file)'''
+
+    def __init__(self, subject_prefix, timeout, kind, path, to=None):
+        super().__init__(subject_prefix, timeout)
+        self.kind = kind
+        self.path = os.path.expanduser(path)
+        self.to = to
+
+    def __str__(self):
+        return '%s sink \'%s\'' % (self.kind, self.path)
+
+    def send(self, notifications):
+        if self.kind == 'maildir':
+            destination = mailbox.Maildir(self.path, create=True)
+        else:
+            destination = mailbox.mbox(self.path, create=True)
+        destination.lock()
+        try:
+            while notifications:
+                destination.add(compose_email(self.subject_prefix,
+                                              notifications[0], None, self.to))
+                del notifications[0]
+            destination.flush()
+        finally:
+            destination.unlock()
+            destination.close()
+
+
+class SMTPSink(NotificationSink):
+    '''Emails each notification, keeping the connection to the mail server open
+    between batches. security is 'starttls', 'ssl' or 'none' for plain SMTP'''
+
+    kind = 'smtp'
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, subject_prefix, timeout, host, to, sender, port=None,
+                 security='starttls', username=None, password=None):
+        super().__init__(subject_prefix, timeout)
+        if security not in ('starttls', 'ssl', 'none'):
+            raise Exception('Invalid SMTP security \'%s\' - please use '
+                            '\'starttls\'/\'ssl\'/\'none\'' % security)
+        self.host = host
+        self.port = port or (465 if security == 'ssl' else 25)
+        self.to = to
+        self.sender = sender
+        self.security = security
+        self.username = username
+        self.password = password
+        self.__connection = None
+
+    def __str__(self):
+        return 'smtp sink %s:%s' % (self.host, self.port)
+
+    def close(self):
+        if self.__connection:
+            try:
+                self.__connection.quit()
+            except smtplib.SMTPException:
+                pass
+            self.__connection = None
+
+    def send(self, notifications):
+        connection = self.__connect()
+        while notifications:
+            connection.send_message(compose_email(self.subject_prefix,
+                                                  notifications[0],
+                                                  self.sender, self.to))
+            del notifications[0]
+
+    def __connect(self):
+
+        # Mail servers drop idle connections, so checking the one kept from the
+        # last batch is still alive
+        if self.__connection:
+            try:
+                if self.__connection.noop()[0] == 250:
+                    return self.__connection
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.__connection = None
+
+        if self.security == 'ssl':
+            connection = smtplib.SMTP_SSL(self.host, self.port,
+                                          timeout=self.timeout)
+        else:
+            connection = smtplib.SMTP(self.host, self.port,
+                                      timeout=self.timeout)
+        try:
+            if self.security == 'starttls':
+                connection.starttls()
+            if self.username:
+                connection.login(self.username, self.password)
+        except Exception:
+            connection.close()
+            raise
+        self.__connection = connection
+        return connection
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    '''HTTP connection over a UNIX domain socket'''
+
+    def __init__(self, socket_path, timeout):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class WebhookSink(NotificationSink):
+    '''POSTs a batch of notifications as one JSON document to an HTTP URL, or
+    to a path on a local HTTP server listening on a UNIX domain socket'''
+
+    kind = 'webhook'
+
+    def __init__(self, subject_prefix, timeout, URL=None, socket_path=None,
+                 path='/'):
+        super().__init__(subject_prefix, timeout)
+        if not URL and not socket_path:
+            raise Exception('Webhook sinks need a url or socket')
+        self.URL = URL
+        self.socket_path = socket_path and os.path.expanduser(socket_path)
+        self.path = path
+
+    def __str__(self):
+        return 'webhook sink \'%s\'' % (self.URL or self.socket_path)
+
+    def send(self, notifications):
+        if self.socket_path:
+            connection = UnixHTTPConnection(self.socket_path, self.timeout)
+            path = self.path
+        else:
+            URL = urllib.parse.urlsplit(self.URL)
+            if URL.scheme == 'https':
+                connection = http.client.HTTPSConnection(URL.netloc,
+                                                         timeout=self.timeout)
+            else:
+                connection = http.client.HTTPConnection(URL.netloc,
+                                                        timeout=self.timeout)
+            path = URL.path or '/'
+            if URL.query:
+                path += '?' + URL.query
+
+        body = json.dumps({'notifications': [
+            {'subject': self.subject_prefix + notification.subject,
+             'message': notification.message}
+            for notification in notifications]}).encode('utf-8')
+        try:
+            connection.request('POST', path, body,
+                               {'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            response.read()
+        finally:
+            connection.close()
+        if response.status >= 300:
+            raise Exception('Webhook responded with HTTP status %d'
+                            % response.status)
+        del notifications[:]
+
+
+def compose_email(subject_prefix, notification, sender, to):
+    '''Email of a notification'''
+
+    message = email.message.EmailMessage()
+    message['Subject'] = subject_prefix + notification.subject
+    message['From'] = sender or 'deviantart-scripts'
+    if to:
+        message['To'] = to if isinstance(to, str) else ', '.join(to)
+    message['Date'] = email.utils.formatdate(localtime=True)
+    message.set_content(notification.message)
+    return message
+
+
+def dispatcher_from_config(config):
+    '''NotificationDispatcher configured by 'notification_retries' in the
+    script's configuration'''
+
+    return NotificationDispatcher(config['notification_retries'])
+
+
+def generate_command_fragments(command, subject, message):
+    '''Prepare command with variable substitution'''
+
+    # Substituting values into command to call in the normal way for
+    # the subject since that is essentially fixed - content is not
+    # fixed and can contain quotes and speechmarks. I have tried to
+    # escape such stuff with shlex.quote, but it can't cope in
+    # examples of single quotes, and when a full command is quoted
+    # it doesn't execute correctly. Given that I don't want this going
+    # through a shell, I should be able to give command parameters
+    # straight to the called process without weird escaping - which is
+    # what I am doing here
+    command = command.replace('%s', subject)
+    return [fragment.replace('%m', message) for fragment in
+            shlex.split(command)]
+
+
+def sinks_from_config(subject_prefix, config, sinks_key, command_key):
+    '''Notification sinks configured as a YAML list of dictionaries under
+    sinks_key, falling back to a command sink for the command under command_key.
+    Each sink has a 'type' of 'command', 'smtp', 'webhook', 'maildir' or
+    'mbox' and the settings for that type'''
+
+    timeout = config['notification_timeout_seconds']
+    retry_failed_commands = config['retry_failed_commands']
+    if not config[sinks_key]:
+        if config[command_key]:
+            return [CommandSink(subject_prefix, timeout, config[command_key],
+                                retry_failed_commands)]
+        return []
+
+    sinks = []
+    for sink_config in config[sinks_key]:
+        try:
+            kind = sink_config.get('type')
+            if kind == 'command':
+                sink = CommandSink(subject_prefix, timeout,
+                                   sink_config['command'],
+                                   retry_failed_commands)
+            elif kind == 'smtp':
+                sink = SMTPSink(subject_prefix, timeout, sink_config['host'],
+                                sink_config['to'], sink_config['from'],
+                                sink_config.get('port'),
+                                sink_config.get('security', 'starttls'),
+                                sink_config.get('username'),
+                                sink_config.get('password'))
+            elif kind == 'webhook':
+                sink = WebhookSink(subject_prefix, timeout,
+                                   sink_config.get('url'),
+                                   sink_config.get('socket'),
+                                   sink_config.get('path', '/'))
+            elif kind in ('maildir', 'mbox'):
+                sink = MailboxSink(subject_prefix, timeout, kind,
+                                   sink_config['path'], sink_config.get('to'))
+            else:
+                raise Exception('Unknown sink type \'%s\' - please use '
+                                '\'command\'/\'smtp\'/\'webhook\'/'
+                                '\'maildir\'/\'mbox\'' % kind)
+        except KeyError as e:
+            raise Exception('Notification sink in %s is missing the %s setting:'
+                            '\n\n%s\n' % (sinks_key, e, sink_config))
+        except Exception as e:
+            raise Exception('Invalid notification sink in %s:\n\n%s\n\n%s\n'
+                            % (sinks_key, sink_config, e))
+        sinks.append(sink)
+    return sinks
@@ -0,0 +1,205 @@
+'''
+Copyright (c) 2017, OmegaPhil - OmegaPhil@startmail.com
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+# Quick checks of whether anything has changed on deviantART, for the
+# downloaders' '--check-only' option. Only the standard library is used - pages
+# are scanned with html.parser for the few tags of interest rather than parsed
+# with Beautiful Soup, so that a run finding nothing new finishes without ever
+# importing Beautiful Soup, lxml or requests
+
+import html.parser
+import http.cookiejar
+import traceback
+import urllib.parse
+import urllib.request
+
+import devart
+
+
+class GalleryPageScanner(html.parser.HTMLParser):
+    '''Picks out the ID (as an integer), title and link of the deviations in an
+    'All' gallery page, as parse_gallery_page does'''
+
+    def __init__(self):
+        super().__init__()
+        self.deviations = []
+        self.__stream_depth = 0
+        self.__spans = []
+        self.__deviation = None
+        self.__title_depth = None
+
+    def handle_data(self, data):
+        if self.__title_depth is not None:
+            self.__deviation[1].append(data)
+
+    def handle_endtag(self, tag):
+        if tag == 'div' and self.__stream_depth:
+            self.__stream_depth -= 1
+        elif tag == 'span' and self.__spans:
+            classes = self.__spans.pop()
+            if self.__title_depth is not None and \
+                    len(self.__spans) < self.__title_depth:
+                self.__title_depth = None
+            if 'thumb' in classes and self.__deviation is not None:
+                deviation_ID, title, deviation_URL = self.__deviation
+                self.deviations.append((deviation_ID, ''.join(title),
+                                        deviation_URL))
+                self.__deviation = None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+
+        # Only the main stream div contains the deviations listing
+        if tag == 'div':
+            if self.__stream_depth:
+                self.__stream_depth += 1
+            elif attrs.get('id') == 'gmi-ResourceStream':
+                self.__stream_depth = 1
+            return
+        if tag != 'span' or not self.__stream_depth:
+            return
+
+        classes = (attrs.get('class') or '').split()
+        self.__spans.append(classes)
+        if 'thumb' in classes and self.__deviation is None:
+            if 'href' not in attrs or 'data-deviationid' not in attrs:
+                raise Exception('Unable to fetch the link or ID of deviation '
+                                'span with attributes \'%s\'' % attrs)
+            self.__deviation = (int(attrs['data-deviationid']), None,
+                                attrs['href'])
+
+        # The deviation's title is the text of its first title span
+        elif ('title' in classes and self.__deviation is not None and
+              self.__deviation[1] is None):
+            self.__deviation = (self.__deviation[0], [], self.__deviation[2])
+            self.__title_depth = len(self.__spans)
+
+
+class LoginFormScanner(html.parser.HTMLParser):
+    '''Picks out the fields of the login form'''
+
+    def __init__(self):
+        super().__init__()
+        self.fields = {}
+        self.__in_form = False
+
+    def handle_endtag(self, tag):
+        if tag == 'form':
+            self.__in_form = False
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'form' and attrs.get('id') == 'login':
+            self.__in_form = True
+        elif tag == 'input' and self.__in_form and attrs.get('name'):
+            self.fields[attrs['name']] = attrs.get('value')
+
+
+class NoteFoldersScanner(html.parser.HTMLParser):
+    '''Picks out the ID, title and notes count of the note folders linked to
+    from the notes page, as parse_note_folders does'''
+
+    def __init__(self):
+        super().__init__()
+        self.note_folders = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag != 'a' or 'folder-link' not in (attrs.get('class') or
+                                               '').split():
+            return
+
+        try:
+            self.note_folders.append((attrs['data-folderid'], attrs['title'],
+                                      int(attrs['rel'].replace(',', ''))))
+        except Exception as e:
+            raise Exception('Unable to obtain the ID, title and notes count of '
+                            'note folder link with attributes \'%s\':\n\n%s\n'
+                            '\n%s\n' % (attrs, e, traceback.format_exc()))
+
+
+class ProbeService(object):
+    '''Minimal deviantART access for quick checks, using only the standard
+    library (see DeviantArtService for the real thing)'''
+
+    def __init__(self, username, password, base_URL=None):
+        self.__base_url = (base_URL or devart.DEVIANTART_URL).rstrip('/')
+        self.__username = username
+        self.__password = password
+        self.__opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def __fetch(self, URL, params=None, data=None):
+
+        if params:
+            URL += '?' + urllib.parse.urlencode(params)
+        if data is not None:
+            data = urllib.parse.urlencode(data).encode('utf-8')
+        with self.__opener.open(URL, data, timeout=60) as response:
+            charset = response.headers.get_content_charset() or 'utf-8'
+            return response.read().decode(charset, 'replace')
+
+    def __scan(self, scanner, content):
+        scanner.feed(content)
+        scanner.close()
+        return scanner
+
+    def get_gallery_deviations(self, username):
+        '''Fetch the (ID, title, URL) of the deviations on the first page of the
+        'All' gallery (up to 120, newest first)'''
+
+        try:
+            gallery_URL, params = devart.gallery_page_request(self.__base_url,
+                                                              username, 0)
+            return self.__scan(GalleryPageScanner(),
+                               self.__fetch(gallery_URL, params)).deviations
+
+        except Exception as e:
+            raise Exception('Unable to check the all deviations gallery page:'
+                            '\n\n%s\n\n%s\n' % (e, traceback.format_exc()))
+
+    def get_note_folders(self):
+        '''Fetch the (ID, title, notes count) of the note folders'''
+
+        try:
+            return self.__scan(NoteFoldersScanner(), self.__fetch(
+                self.__base_url + '/notifications/notes')).note_folders
+
+        except Exception as e:
+            raise Exception('Unable to check the deviantART notes page:\n\n%s'
+                            '\n\n%s\n' % (e, traceback.format_exc()))
+
+    def login(self):
+        '''Login to deviantART - the login page's form contains dynamic hidden
+        fields that need to be sent back'''
+
+        try:
+            login_URL = self.__base_url + '/users/login'
+            fields = self.__scan(LoginFormScanner(),
+                                 self.__fetch(login_URL)).fields
+            if not fields.get('validate_token') or \
+                    not fields.get('validate_key'):
+                raise Exception('Unable to find the login form\'s hidden '
+                                'validation fields')
+            self.__fetch(login_URL, data={
+                'username': self.__username, 'password': self.__password,
+                'validate_token': fields['validate_token'],
+                'validate_key': fields['validate_key'], 'remember_me': 1})
+
+        except Exception as e:
+            raise Exception('Unable to log in to deviantART:\n\n%s\n\n%s\n'
+                            % (e, traceback.format_exc()))
@@ -0,0 +1,172 @@
+'''
+Copyright (c) 2017, OmegaPhil - OmegaPhil@startmail.com
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+# Profiling of a whole script run (the scripts' '--profile' option). Every
+# thread gets its own cProfile profiler, and the combined stats are written out
+# for pstats/snakeviz etc along with a summary attributing time to network,
+# parsing, persistence and notification
+
+import atexit
+import cProfile
+import io
+import os.path
+import pstats
+import sys
+import threading
+import time
+import traceback
+
+
+# Categories in the order they are reported, then the rules deciding which
+# category a function's own time goes to. Functions are matched on their source
+# file or, for builtins, their name - the first matching rule wins
+CATEGORIES = ('network', 'parsing', 'persistence', 'notification', 'waiting',
+              'other')
+CATEGORY_RULES = (
+    ('notification', ('subprocess.py', '_posixsubprocess', 'waitpid')),
+    ('network', ('/requests/', '/urllib3/', '/http/client.py', '/socket.py',
+                 '/ssl.py', '_socket', '_ssl', '/idna/', '/charset_normalizer/',
+                 '/chardet/')),
+    ('parsing', ('/bs4/', '/lxml/', 'lxml.', '/soupsieve/', '/html5lib/',
+                 'devart.py:parse_', 'devart.py:extract_text',
+                 'devart.py:deviantart_post_to_text')),
+    ('persistence', ('sqlite3', '/yaml/', '_yaml')),
+    ('waiting', ('time.sleep', '_thread.lock', '_thread.RLock', '_queue.',
+                 'select.', '/selectors.py', '/threading.py', '/queue.py')))
+
+
+class Profiler(object):
+    '''Profiles all threads from start until stop, writing the combined stats to
+    file_path and a summary to stderr'''
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.start_time = None
+        self.main_profiler = None
+        self.__thread_profilers = []
+        self.__lock = threading.Lock()
+
+    def start(self):
+        '''Start profiling this and all subsequently started threads - stop is
+        called automatically on exit'''
+
+        self.start_time = time.perf_counter()
+
+        # Threads start with the profile function set here, which swaps itself
+        # for a dedicated profiler on the thread's first call
+        threading.setprofile(self.__start_thread_profiler)
+        self.main_profiler = cProfile.Profile()
+        self.main_profiler.enable()
+        atexit.register(self.stop)
+
+    def stop(self):
+        '''Stop profiling and write out the stats and summary - safe to call more
+        than once'''
+
+        if self.main_profiler is None:
+            return
+
+        self.main_profiler.disable()
+        threading.setprofile(None)
+        wall_time = time.perf_counter() - self.start_time
+        atexit.unregister(self.stop)
+
+        try:
+            main_stats = pstats.Stats(self.main_profiler)
+            all_stats = pstats.Stats(self.main_profiler)
+            with self.__lock:
+                for profiler in self.__thread_profilers:
+                    all_stats.add(profiler)
+            all_stats.dump_stats(self.file_path)
+            print(summarise(main_stats, all_stats, wall_time,
+                            len(self.__thread_profilers) + 1),
+                  file=sys.stderr)
+            print('Profile written to \'%s\' - inspect with \'python3 -m pstats '
+                  '%s\'' % (self.file_path, self.file_path), file=sys.stderr)
+        except Exception as e:  # pylint: disable=broad-except
+            print('Unable to write profile to \'%s\':\n\n%s\n\n%s\n'
+                  % (self.file_path, e, traceback.format_exc()),
+                  file=sys.stderr)
+        self.main_profiler = None
+
+    def __start_thread_profiler(self, frame, event, arg):  # pylint: disable=unused-argument
+        sys.setprofile(None)
+        profiler = cProfile.Profile()
+        with self.__lock:
+            self.__thread_profilers.append(profiler)
+        profiler.enable()
+
+
+def categorise(function):
+    '''Category of a pstats function key (file path, line number, name)'''
+
+    file_path, _, name = function
+    if file_path == '~':
+        description = name
+    else:
+        description = '%s:%s' % (file_path.replace(os.sep, '/'), name)
+    for category, patterns in CATEGORY_RULES:
+        if any(pattern in description for pattern in patterns):
+            return category
+    return 'other'
+
+
+def category_times(stats):
+    '''Dictionary of category -> seconds spent in the category's functions
+    themselves (so categories add up to the total profiled time)'''
+
+    times = dict.fromkeys(CATEGORIES, 0.0)
+    for function, (_, _, own_time, _, _) in stats.stats.items():
+        times[categorise(function)] += own_time
+    return times
+
+
+def start_profiler(file_path):
+    '''Start profiling the run when a profile path is given (the scripts'
+    --profile option), returning the profiler or None'''
+
+    if not file_path:
+        return None
+    profiler = Profiler(file_path)
+    profiler.start()
+    return profiler
+
+
+def summarise(main_stats, all_stats, wall_time, threads_count):
+    '''Summary of where the time went - the main thread's time is effectively
+    wall time, worker threads' time overlaps with it'''
+
+    main_times = category_times(main_stats)
+    all_times = category_times(all_stats)
+
+    lines = ['Profile summary: %.2fs wall time, %d thread(s)'
+             % (wall_time, threads_count), '',
+             '%-14s %12s %8s %14s' % ('Category', 'Main thread', '% wall',
+                                      'All threads')]
+    for category in CATEGORIES:
+        lines.append('%-14s %11.2fs %7.1f%% %13.2fs'
+                     % (category, main_times[category],
+                        main_times[category] / max(wall_time, 1e-9) * 100,
+                        all_times[category]))
+
+    # The functions with the most time spent in them across all threads
+    output = io.StringIO()
+    all_stats.stream = output
+    all_stats.sort_stats('tottime').print_stats(15)
+    lines += ['', 'Top functions by own time across all threads:',
+              output.getvalue().split('\n\n', 1)[-1].rstrip()]
+    return '\n'.join(lines)
@@ -0,0 +1,634 @@
+'''
+Copyright (c) 2014-2017, OmegaPhil - OmegaPhil@startmail.com
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+# Local stand-in for deviantART, replaying a corpus of responses recorded by
+# DeviantArtService (see its record_directory parameter) or generated for a
+# made-up account by SyntheticAccount, so that everything can be ran and
+# measured without touching the live site
+
+import datetime
+import html
+import http.server
+import io
+import itertools
+import json
+import os
+import os.path
+import random
+import re
+import threading
+import time
+import traceback
+import urllib.parse
+
+import devart
+
+
+# Absolute links to deviantART in replayed responses are rewritten to point at
+# the replay server, bar the outgoing link redirector (which is stripped out
+# when parsing). JSON-escaped links are coped with too
+DEVIANTART_LINK_REGEX = re.compile(
+    r'https?:(\\?/)\1([a-z0-9-]+)\.deviantart\.com(?!\\?/users\\?/outgoing)')
+
+# Bumped whenever the generated responses change, so that saved corpora are
+# generated again (see deviantart-sync-benchmark.py)
+CORPUS_VERSION = 3
+
+# Characters of note text shown in note folder listings
+NOTE_PREVIEW_LENGTH = 100
+
+
+class ReplayServer(http.server.ThreadingHTTPServer):
+    '''HTTP server replaying a corpus of deviantART responses, with optional
+    latency and error injection'''
+
+    # pylint: disable=too-many-arguments,too-many-instance-attributes
+
+    daemon_threads = True
+
+    # latency is the seconds to wait before responding, with up to jitter
+    # seconds more added randomly. error_rate is the fraction of requests to
+    # fail with error_status instead of replaying the response
+    def __init__(self, corpus_directory, address=('127.0.0.1', 0), latency=0.0,
+                 jitter=0.0, error_rate=0.0, error_status=503, seed=None):
+        super().__init__(address, ReplayRequestHandler)
+        self.corpus_directory = corpus_directory
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+
+        # Stats on what has been served
+        self.stats_lock = threading.Lock()
+        self.requests_served = self.errors_injected = self.bytes_sent = 0
+        self.missing_keys = []
+
+    @property
+    def base_URL(self):
+        '''Base URL to pass to DeviantArtService to use this server'''
+
+        return 'http://%s:%s' % self.server_address[:2]
+
+    def reset_stats(self):
+        '''Zero the stats on what has been served'''
+
+        with self.stats_lock:
+            self.requests_served = self.errors_injected = self.bytes_sent = 0
+            self.missing_keys = []
+
+    def serve_in_background(self):
+        '''Start serving requests in a daemon thread, returning the thread -
+        call shutdown to stop'''
+
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+class ReplayRequestHandler(http.server.BaseHTTPRequestHandler):
+    '''Serves a recorded response for each request'''
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        '''Replay a GET request'''
+
+        self.__replay('GET')
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        '''Replay a POST request'''
+
+        self.__replay('POST')
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+
+        # Silencing per-request logging - it would swamp any benchmarking
+        pass
+
+    def __replay(self, method):
+
+        server = self.server
+        if server.latency or server.jitter:
+            time.sleep(server.latency +
+                       server.random.uniform(0, server.jitter))
+
+        # Form fields are part of the key
+        data = {}
+        content_length = int(self.headers.get('Content-Length', 0))
+        if content_length:
+            form = self.rfile.read(content_length).decode('utf-8')
+            for name, value in urllib.parse.parse_qsl(form):
+                data.setdefault(name, []).append(value)
+        key = devart.corpus_key(method, server.base_URL + self.path, data=data)
+
+        with server.stats_lock:
+            server.requests_served += 1
+            inject_error = (server.error_rate and
+                            server.random.random() < server.error_rate)
+            if inject_error:
+                server.errors_injected += 1
+
+        if inject_error:
+            self.__respond(server.error_status, b'Injected error', 'text/plain')
+            return
+
+        response_path = devart.corpus_response_path(server.corpus_directory,
+                                                    key)
+        if not os.path.exists(response_path):
+            with server.stats_lock:
+                server.missing_keys.append(key)
+            self.__respond(404, ('No response recorded for \'%s\'' % key)
+                           .encode('utf-8'), 'text/plain')
+            return
+        with io.open(response_path, 'rb') as response_file:
+            content = response_file.read()
+
+        # Making sure links lead back here
+        path = urllib.parse.urlsplit(self.path).path
+        if path == '/global/difi.php':
+            content_type = 'application/json'
+            content = rewrite_links(content, server.base_URL.replace('/',
+                                                                     '\\/'))
+        elif content.startswith(b'<'):
+            content_type = 'text/html; charset=utf-8'
+            content = rewrite_links(content, server.base_URL)
+        else:
+            content_type = 'application/octet-stream'
+
+        # Logging in provides the userinfo cookie used in DiFi note calls
+        headers = {}
+        if method == 'POST' and path == '/users/login':
+            headers['Set-Cookie'] = ('userinfo=%s; Path=/'
+                                     % urllib.parse.quote('{"username":'
+                                                          '"replay"}'))
+
+        # File downloads may be resumed
+        status = 200
+        byte_range = re.match(r'^bytes=([0-9]+)-$',
+                              self.headers.get('Range', ''))
+        if byte_range and content_type == 'application/octet-stream':
+            offset = int(byte_range.group(1))
+            if offset >= len(content):
+                self.__respond(416, b'', content_type)
+                return
+            headers['Content-Range'] = ('bytes %d-%d/%d'
+                                        % (offset, len(content) - 1,
+                                           len(content)))
+            content = content[offset:]
+            status = 206
+
+        self.__respond(status, content, content_type, headers)
+
+    def __respond(self, status, content, content_type, headers=None):
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+        with self.server.stats_lock:
+            self.server.bytes_sent += len(content)
+
+
+class SyntheticAccount(object):
+    '''A made-up deviantART account, generating the responses deviantART would
+    give for it (in the same form as a recorded corpus)'''
+
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+
+    # Notes are spread over the Inbox, Sent and custom_note_folders custom
+    # folders, with roughly 1 in 10 also in a second folder as on deviantART
+    # (e.g. Starred). messages is the number of each type of Message Center
+    # item. Up to note_links links are placed in each note, with up to
+    # note_paragraphs paragraphs of text, bar the short_notes fraction of notes
+    # that are a short line of plain text (as in chat-style exchanges).
+    # page_chrome is the rough number of characters of site navigation etc to
+    # surround the content of full pages with - real pages are mostly this
+    def __init__(self, username='replayuser', notes=100, custom_note_folders=3,
+                 deviations=150, messages=10, note_links=5, note_paragraphs=8,
+                 page_chrome=0, short_notes=0.0):
+        self.username = username
+        self.notes_count = notes
+        self.custom_note_folders_count = custom_note_folders
+        self.deviations_count = deviations
+        self.messages_count = messages
+        self.note_links = note_links
+        self.note_paragraphs = note_paragraphs
+        self.page_chrome = page_chrome
+        self.short_notes = short_notes
+        self.inbox_ID = 52342
+        self.base_timestamp = 1400000000
+
+        # Folder ID -> title, and folder ID -> note IDs newest first
+        self.note_folders = {'1': 'Inbox', '2': 'Sent', 'unread': 'Unread'}
+        for folder_number in range(custom_note_folders):
+            self.note_folders[str(7000 + folder_number)] = ('Custom folder %d'
+                                                            % folder_number)
+        self.folder_notes = {folder_ID: [] for folder_ID in self.note_folders}
+        custom_folder_IDs = sorted(self.note_folders)[2:-1]
+        for note_ID in range(100000 + notes, 100000, -1):
+            folder_ID = '2' if note_ID % 3 == 0 else '1'
+            self.folder_notes[folder_ID].append(note_ID)
+            if custom_folder_IDs and note_ID % 10 == 0:
+                self.folder_notes[custom_folder_IDs[note_ID // 10 %
+                                                    len(custom_folder_IDs)]
+                                  ].append(note_ID)
+            if folder_ID == '1' and len(self.folder_notes['unread']) < messages:
+                self.folder_notes['unread'].append(note_ID)
+
+        # Deviations are in some of 5 gallery folders
+        self.deviation_IDs = list(range(500000 + deviations, 500000, -1))
+
+    def corpus_key(self, method, path, params=None, data=None):
+        '''Key for a request against deviantART itself'''
+
+        return devart.corpus_key(method, devart.DEVIANTART_URL + path, params,
+                                 data)
+
+    def difi_key(self, calls):
+        '''Key for a DiFi request making the passed calls - query and form
+        fields are keyed alike, so this covers both forms of DiFi request'''
+
+        return self.corpus_key('POST', '/global/difi.php', data={'c[]': calls})
+
+    def responses(self):
+        '''Generate (corpus key, content) tuples for every request the scripts
+        make'''
+
+        # pylint: disable=too-many-locals
+
+        yield (self.corpus_key('GET', '/users/login'),
+               self.login_page().encode('utf-8'))
+        yield (self.corpus_key('POST', '/users/login'),
+               self.page('<h1>Welcome back</h1>').encode('utf-8'))
+        yield (self.corpus_key('GET', '/notifications/notes'),
+               self.notes_page().encode('utf-8'))
+
+        # Message Center
+        yield (self.difi_key(['MessageCenter;get_folders']),
+               difi_response([[{'folderid': str(self.inbox_ID),
+                                'is_inbox': True, 'title': 'Inbox'}]]))
+        # The first pages of whichever views are due are fetched in one go,
+        # with later pages fetched a view at a time
+        views = self.message_center_views()
+        page_size = devart.MESSAGES_PAGE_SIZE
+        for views_count in range(1, len(views) + 1):
+            for messages_types in itertools.combinations(range(len(views)),
+                                                         views_count):
+                yield (self.difi_key([self.message_center_call(messages_type,
+                                                               0)
+                                      for messages_type in messages_types]),
+                       difi_response([message_center_result(
+                           views[messages_type], 0, page_size)
+                                      for messages_type in messages_types]))
+        for messages_type, hits in enumerate(views):
+            for offset in range(page_size, len(hits), page_size):
+                yield (self.difi_key([self.message_center_call(messages_type,
+                                                               offset)]),
+                       difi_response([message_center_result(hits, offset,
+                                                            page_size)]))
+
+        # Notes - folder pages carry on until an empty page
+        for folder_ID, note_IDs in self.folder_notes.items():
+            prepared_folder_ID = devart.format_note_folder_id(folder_ID)
+            for offset in range(0, len(note_IDs) + 25, 25):
+                call = ('"Notes","display_folder",[%s,%s,0]'
+                        % (prepared_folder_ID, offset))
+                yield (self.difi_key([call]),
+                       difi_response([{'body': self.note_folder_page(
+                           note_IDs[offset:offset + 25], folder_ID)}]))
+            for note_ID in note_IDs:
+                call = ('"Notes","display_note",[%s,%s]'
+                        % (prepared_folder_ID, note_ID))
+                yield (self.difi_key([call]),
+                       difi_response([{'body': self.note_page(note_ID,
+                                                              folder_ID)}]))
+
+        # Gallery - as with notes, pages carry on until a short page
+        gallery_path = '/%s/gallery/' % self.username
+        for offset in range(0, len(self.deviation_IDs) + 1, 120):
+            yield (self.corpus_key('GET', gallery_path,
+                                   {'catpath': '/', 'offset': offset}),
+                   self.gallery_page(self.deviation_IDs[offset:offset + 120])
+                   .encode('utf-8'))
+        for folder_number in range(5):
+            yield (self.corpus_key('GET', self.gallery_folder_path(
+                folder_number)), self.gallery_folder_page(folder_number)
+                   .encode('utf-8'))
+        for deviation_ID in self.deviation_IDs:
+            yield (self.corpus_key('GET', self.deviation_path(deviation_ID)),
+                   self.deviation_page(deviation_ID).encode('utf-8'))
+            yield (self.corpus_key('GET', self.file_path(deviation_ID)),
+                   self.deviation_file(deviation_ID))
+
+    def deviation_file(self, deviation_ID):
+        '''Content of a deviation's file - deviation IDs ending in 9 share their
+        file with the previous deviation'''
+
+        if deviation_ID % 10 == 9:
+            deviation_ID -= 1
+        file_random = random.Random(deviation_ID)
+        return bytes(file_random.getrandbits(8)
+                     for _ in range(2048 + deviation_ID % 4096))
+
+    def deviation_page(self, deviation_ID):
+        '''A deviation's page'''
+
+        timestamp = self.base_timestamp + deviation_ID
+        description = self.text(deviation_ID, 3)
+        return self.page(
+            '<div class="dev-view-deviation"><img class="dev-content-full" '
+            'src="%s%s"></div><div class="dev-title-container"><h1><a href="%s%s">'
+            '%s</a><small>by <a class="username" href="%s/%s">%s</a></small>'
+            '</h1></div><div class="dev-metainfo-details"><dl><dt>Submitted on'
+            '</dt><dd><span title="%s" ts="%s">%s</span></dd></dl></div>'
+            '<div class="dev-description"><div class="text">%s</div></div>'
+            % (devart.DEVIANTART_URL, self.file_path(deviation_ID),
+               devart.DEVIANTART_URL, self.deviation_path(deviation_ID),
+               self.deviation_title(deviation_ID), devart.DEVIANTART_URL,
+               self.username, self.username, format_timestamp(timestamp),
+               timestamp, format_timestamp(timestamp), description))
+
+    def deviation_path(self, deviation_ID):
+        '''Path to a deviation's page'''
+
+        return ('/%s/art/%s-%s'
+                % (self.username,
+                   self.deviation_title(deviation_ID).replace(' ', '-'),
+                   deviation_ID))
+
+    def deviation_title(self, deviation_ID):
+        '''A deviation's title'''
+
+        return 'Deviation number %s' % deviation_ID
+
+    def file_path(self, deviation_ID):
+        '''Path to a deviation's file'''
+
+        return '/download/%s/deviation-%s.png' % (deviation_ID, deviation_ID)
+
+    def gallery_folder_page(self, folder_number):
+        '''A gallery folder's page'''
+
+        return self.page('<h2><span class="folder-title">Gallery folder %s'
+                         '</span></h2><div class="description text">Folder '
+                         '%s\'s description</div>'
+                         % (folder_number, folder_number))
+
+    def gallery_folder_path(self, folder_number):
+        '''Path to a gallery folder's page'''
+
+        return '/%s/gallery/%s/Gallery-folder-%s' % (self.username,
+                                                     60000 + folder_number,
+                                                     folder_number)
+
+    def gallery_page(self, deviation_IDs):
+        '''A page of the 'All' gallery listing'''
+
+        thumbs = []
+        for deviation_ID in deviation_IDs:
+            folder_links = ''.join(
+                '<a href="%s%s">Gallery folder %s</a>'
+                % (devart.DEVIANTART_URL, self.gallery_folder_path(folder_number),
+                   folder_number)
+                for folder_number in range(5)
+                if (deviation_ID >> folder_number) % 4 == 0)
+            thumbs.append(
+                '<span class="thumb" href="%s%s" data-deviationid="%s">'
+                '<img src="%s%s" alt="%s"><span class="info">'
+                '<span class="title">%s</span><span class="gallections">%s'
+                '</span></span></span>'
+                % (devart.DEVIANTART_URL, self.deviation_path(deviation_ID),
+                   deviation_ID, devart.DEVIANTART_URL,
+                   self.file_path(deviation_ID),
+                   self.deviation_title(deviation_ID),
+                   self.deviation_title(deviation_ID), folder_links))
+        return self.page('<div id="gallery"><div id="gmi-ResourceStream">%s'
+                         '</div></div>' % ''.join(thumbs))
+
+    def login_page(self):
+        '''The login page'''
+
+        return ('<html><body><form id="login" method="post" action="/users/'
+                'login"><input type="hidden" name="validate_token" value="%s">'
+                '<input type="hidden" name="validate_key" value="%s">'
+                '<input name="username"><input name="password" '
+                'type="password"><input name="remember_me" type="checkbox">'
+                '</form></body></html>' % ('0' * 20, '1' * 10))
+
+    def message_center_call(self, messages_type, offset):
+        '''DiFi call fetching a page of a Message Center view'''
+
+        return ('MessageCenter;get_views;%s,oq:%s'
+                % (self.inbox_ID, devart.MESSAGE_CENTER_VIEWS[messages_type]
+                   % (offset, devart.MESSAGES_PAGE_SIZE)))
+
+    def message_center_views(self):
+        '''Hits of each Message Center view (comments, replies, unread notes
+        and deviations), newest first'''
+
+        numbers = range(self.messages_count - 1, -1, -1)
+        comments = [{'msgid': str(900000 + number),
+                     'title': 'Comment on <b>%s</b>' % self.deviation_title(
+                         self.deviation_IDs[number % len(self.deviation_IDs)])
+                              if self.deviation_IDs else 'a journal',
+                     'who': '<a class="u">commenter%d</a>' % (number % 7),
+                     'ts': str(self.base_timestamp + number),
+                     'url': '%s/comments/%d' % (devart.DEVIANTART_URL, number),
+                     'body': self.text(number, 1)}
+                    for number in numbers]
+        replies = [dict(comment, msgid=str(800000 + number))
+                   for number, comment in zip(numbers, comments)]
+        unread_notes = [{'msgid': str(note_ID), 'title': 'Note %s' % note_ID}
+                        for note_ID in self.folder_notes['unread']]
+        deviations = [{'msgid': '1:%d' % (600000 + number),
+                       'title': 'Watched deviation %d' % number,
+                       'url': '%s/watched%d/art/watched-%d'
+                              % (devart.DEVIANTART_URL, number % 5,
+                                 600000 + number),
+                       'username': 'watched%d' % (number % 5),
+                       'ts': str(self.base_timestamp + number)}
+                      for number in numbers]
+        return [comments, replies, unread_notes, deviations]
+
+    def note_body(self, note_ID):
+        '''The HTML text of a note - short_notes of them are a line of plain
+        text'''
+
+        if random.Random(note_ID).random() < self.short_notes:
+            words = random.Random(-note_ID).choices(
+                ['hi', 'thanks', 'sure', 'sounds', 'good', 'see', 'you',
+                 'tomorrow', 'sketch', 'done', 'great'],
+                k=2 + note_ID % 10)
+            return ' '.join(words)
+        return self.text(note_ID, self.note_paragraphs)
+
+    def note_folder_page(self, note_IDs, folder_ID):
+        '''A page of a note folder listing (note previews) - the other party is
+        the sender of the note, or in the sent folder, the recipient'''
+
+        party_class, party_prefix = (('recipient', 'to') if folder_ID == '2'
+                                     else ('sender', 'from'))
+        items = []
+        for note_ID in note_IDs:
+            timestamp = format_timestamp(self.base_timestamp + note_ID * 60)
+            items.append(
+                '<li class="note%s"><div class="note-details"><span>'
+                '<a href="#" data-noteid="%s">Note %s</a></span>'
+                '<span class="%s">%s <a class="username">%s</a></span>'
+                '<span class="ts" title="%s">%s</span></div>'
+                '<div class="note-preview">%s</div></li>'
+                % (' unread' if note_ID % 4 == 0 else '', note_ID, note_ID,
+                   party_class, party_prefix, self.note_sender(note_ID),
+                   timestamp, timestamp, self.note_preview(note_ID)))
+        return '<ul class="notes">%s</ul>' % ''.join(items)
+
+    def note_page(self, note_ID, folder_ID):
+        '''A note's content, as shown when displaying it in the folder'''
+
+        timestamp = self.base_timestamp + note_ID * 60
+        recipient = (self.note_sender(note_ID) if folder_ID == '2'
+                     else self.username)
+        sender = self.username if folder_ID == '2' else self.note_sender(note_ID)
+        return ('<div class="mcb-header"><span class="mcb-title">Note %s</span>'
+                '<span class="mcb-from" username="%s">from <a class="username">'
+                '%s</a></span><span class="mcb-to">to <a class="username">%s'
+                '</a></span><span class="mcb-ts" title="%s">%s</span></div>'
+                '<div class="mcb-body wrap-text">%s</div>'
+                % (note_ID, sender, sender, recipient,
+                   format_timestamp(timestamp), format_timestamp(timestamp),
+                   self.note_body(note_ID)))
+
+    def note_preview(self, note_ID):
+        '''A note's preview as shown in folder listings - as on deviantART,
+        linebreaks are collapsed, links lost and long notes cut short with an
+        ellipsis, so only short plain notes come through whole'''
+
+        body = self.note_body(note_ID)
+        text = ' '.join(re.sub('<[^>]+>', ' ', body).split())
+        if text == body and len(text) <= NOTE_PREVIEW_LENGTH:
+            return html.escape(text)
+        return html.escape(text[:NOTE_PREVIEW_LENGTH]) + '...'
+
+    def note_sender(self, note_ID):
+        '''Username of the other party of a note'''
+
+        return 'friend%d' % (note_ID % 13)
+
+    def notes_page(self):
+        '''The notes page listing the note folders'''
+
+        links = ''.join('<a class="folder-link" data-folderid="%s" title="%s" '
+                        'rel="%s" href="#">%s</a>'
+                        % (folder_ID, title,
+                           '{:,}'.format(len(self.folder_notes[folder_ID])),
+                           title)
+                        for folder_ID, title in self.note_folders.items()
+                        if folder_ID != 'unread')
+        return self.page('<div class="folders">%s</div>' % links)
+
+    def page(self, content):
+        '''Wrap content in a full page, with page_chrome characters or so of
+        navigation around it'''
+
+        chrome = []
+        chrome_size = 0
+        while chrome_size < self.page_chrome:
+            item = ('<li class="nav-item"><a href="%s/browse/%d/">Browse '
+                    'category %d</a><span class="nav-hint">Popular in '
+                    'category %d</span></li>'
+                    % (devart.DEVIANTART_URL, len(chrome), len(chrome),
+                       len(chrome)))
+            chrome.append(item)
+            chrome_size += len(item)
+        return ('<html><head><title>deviantART</title></head><body>'
+                '<div id="overhead"><a id="oh-menu-deviant" href="/%s/">'
+                '<span class="username">%s</span></a><ul class="nav">%s</ul>'
+                '</div><div id="output">%s</div></body></html>'
+                % (self.username, self.username, ''.join(chrome), content))
+
+    def text(self, seed, paragraphs):
+        '''Some paragraphs of HTML post text, with linebreaks and links through
+        the outgoing link redirector'''
+
+        text_random = random.Random(seed)
+        words = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'commission',
+                 'sketch', 'thanks', 'colours', 'background', 'deadline',
+                 'reference']
+        paragraph_texts = []
+        for paragraph_number in range(1 + text_random.randrange(paragraphs)):
+            sentence = ' '.join(text_random.choice(words)
+                                for _ in range(8 + text_random.randrange(40)))
+            if paragraph_number < self.note_links:
+                sentence += (' <a href="%s/users/outgoing?https://example.com/%d'
+                             '/%d">link</a>' % (devart.DEVIANTART_URL, seed,
+                                                 paragraph_number))
+            paragraph_texts.append(sentence)
+        return '<br />\n<br />\n'.join(paragraph_texts)
+
+    def write_corpus(self, corpus_directory):
+        '''Write every response to the passed corpus directory, returning the
+        number of responses written'''
+
+        count = 0
+        for key, content in self.responses():
+            devart.record_response(corpus_directory, key, content)
+            count += 1
+        return count
+
+
+def difi_response(contents):
+    '''Encode a successful DiFi response with the passed call contents'''
+
+    return json.dumps({'DiFi': {'status': 'SUCCESS', 'response': {'calls': [
+        {'response': {'status': 'SUCCESS', 'content': content}}
+        for content in contents]}}}).encode('utf-8')
+
+
+def format_timestamp(timestamp):
+    '''Format a UNIX timestamp as deviantART does in notes'''
+
+    return (datetime.datetime.fromtimestamp(timestamp)
+            .strftime('%b %d, %Y, %I:%M:%S %p'))
+
+
+def message_center_result(hits, offset, count):
+    '''Content of a Message Center views call returning a page of hits'''
+
+    return [{'result': {'count': len(hits),
+                        'hits': hits[offset:offset + count]}}]
+
+
+def rewrite_links(content, base_URL):
+    '''Rewrite absolute links to deviantART in the passed content to the
+    passed base URL, including user subdomains'''
+
+    def replace(match):
+        slash = match.group(1).decode('ascii')
+        subdomain = match.group(2).decode('ascii')
+        if subdomain == 'www':
+            return base_URL.encode('ascii')
+        return ('%s%s%s' % (base_URL, slash, subdomain)).encode('ascii')
+
+    try:
+        return re.sub(DEVIANTART_LINK_REGEX.pattern.encode('ascii'), replace,
+                      content)
+    except Exception as e:
+        raise Exception('Unable to rewrite links in response content:\n\n%s'
+                        '\n\n%s\n' % (e, traceback.format_exc()))
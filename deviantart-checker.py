@@ -18,40 +18,56 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
+import argparse
 import fcntl
-import io
 import numbers
 import os
 import os.path
-import subprocess
 import time
 import traceback
-import shlex
 import sys
 
-import yaml
-
 import devart
-
+import devart_config
+import devart_metrics
+import devart_notify
+import devart_profile
+
+
+# Event types as named in the configuration
+MESSAGES_TYPES = {'comments': devart.COMMENTS, 'replies': devart.REPLIES,
+                  'unread_notes': devart.UNREAD_NOTES,
+                  'deviations': devart.DEVIATIONS}
+
+# Order new messages are reported in, with the event type and title of each
+SUMMARY_ORDER = ((devart.DEVIATIONS, 'deviations', 'New Deviations'),
+                 (devart.UNREAD_NOTES, 'unread_notes', 'New Unread Notes'),
+                 (devart.REPLIES, 'replies', 'New Replies'),
+                 (devart.COMMENTS, 'comments', 'New Comments'))
+
+# The configuration schema (see devart_config)
+CONFIG_SCHEMA = {
+    'update_every_minutes': devart_config.Setting(numbers.Number, 5,
+                                                  minimum=5),
+    'check_for': devart_config.Setting(
+        list, list(MESSAGES_TYPES),
+        items=devart_config.Setting(str, choices=list(MESSAGES_TYPES))),
+    'check_every_minutes': devart_config.Setting(
+        dict, {}, choices=list(MESSAGES_TYPES),
+        items=devart_config.Setting(numbers.Number, minimum=0)),
+    'notification_whitelist': devart_config.Setting(
+        list, [], items=devart_config.Setting(str)),
+    'apply_whitelist_to': devart_config.Setting(
+        list, [], items=devart_config.Setting(str,
+                                              choices=list(MESSAGES_TYPES)))}
+CONFIG_SCHEMA.update(devart_notify.CONFIG_SCHEMA)
+CONFIG_SCHEMA.update(devart_metrics.CONFIG_SCHEMA)
 
 config = {}
-
-
-def generate_command_fragments(command, subject, message):
-    '''Prepare command with variable substitution'''
-
-    # Substituting values into command to call in the normal way for
-    # the subject since that is essentially fixed - content is not
-    # fixed and can contain quotes and speechmarks. I have tried to
-    # escape such stuff with shlex.quote, but it can't cope in
-    # examples of single quotes, and when a full command is quoted
-    # it doesn't execute correctly. Given that I don't want this going
-    # through a shell, I should be able to give command parameters
-    # straight to the called process without weird escaping - which is
-    # what I am doing here
-    command = command.replace('%s', '[deviantart-checker] ' + subject)
-    return [fragment.replace('%m', message) for fragment in
-            shlex.split(command)]
+config_loader = None
+notifications = None
+notification_sinks = []
+failure_notification_sinks = []
 
 
 def handle_unknown_error(err):
@@ -68,81 +84,22 @@ def handle_unknown_error(err):
     error_message = 'Unhandled error \'%s\'\n\n%s' % (err, traceback.format_exc())
     print(error_message, file=sys.stderr)
 
-    # Running command_to_run_on_failure if specified
-    if config['command_to_run_on_failure']:
-
-        try:
-            command_fragments = generate_command_fragments(config['command_to_run_on_failure'],
-                                                           'Error', error_message)
-
-            # Running command without a shell
-            subprocess.call(command_fragments)
-
-        except Exception as e:  # pylint: disable=broad-except
-            print('Calling the command to run on failure failed:\n\n%s\n'
-                  '\n%s\n' % (config['command_to_run_on_failure'], e),
-                  file=sys.stderr)
+    # Notifying failure_notification_sinks (or command_to_run_on_failure) if
+    # specified - this happens in the background, with failures reported there
+    if notifications:
+        notifications.notify(failure_notification_sinks, 'Error', error_message)
 
 
 def load_config():
     '''Load config'''
 
-    global config  # pylint: disable=global-statement
-
-    # Loading configuration if it exists. Credentials has been split out into
-    # its own file so that it can be shared amongst various scripts
-    config_directory = os.path.expanduser('~/.config/deviantart-scripts')
-    config_file_path = os.path.join(config_directory, 'deviantart-checker.conf')
-    credentials_file_path = os.path.join(config_directory, 'credentials.conf')
-    if (os.path.exists(config_file_path)
-        and os.path.exists(credentials_file_path)):
+    global config, config_loader  # pylint: disable=global-statement
 
-        # Loading YAML documents - theres no need for them to be genuinely
-        # separate documents, so just sticking them together
-        try:
-            config_text = (io.open(config_file_path, 'r').read() + '\n' +
-                            io.open(credentials_file_path, 'r').read())
-            config = yaml.load(config_text, yaml.CLoader)
-            if config is None:
-                raise Exception('YAML documents empty')
-        except Exception as e:
-            raise Exception('Unable to load config from YAML documents '
-                            '\'%s\' and \'%s\':\n\n%s\n\n%s\n'
-                            % (config_file_path, credentials_file_path, str(e),
-                               traceback.format_exc()))
-
-    # Ensuring required settings exist
-    if 'username' not in config or 'password' not in config:
-        raise Exception('Please ensure a deviantART username and password is '
-                        'configured in \'%s\'' % credentials_file_path)
-    if 'command_to_run' not in config:
-        raise Exception('Please ensure command_to_run is configured in \'%s\'' %
-                        config_file_path)
-
-    # Ensuring sensible defaults
-    # Keep update delay at at least 5 minutes so as not to cause deviantART
-    # unnecessary load
-    if ('update_every_minutes' not in config or
-            not isinstance(config['update_every_minutes'], numbers.Number) or
-            not config['update_every_minutes'] >= 5):
-        config['update_every_minutes'] = 5
-
-    # Can't get the indentation to pylint's liking
-    # pylint: disable=bad-continuation
-    # Validating apply_whitelist_to
-    if (('apply_whitelist_to' not in config or
-         not config['apply_whitelist_to']
-        ) and
-        'notification_whitelist' in config and
-        config['notification_whitelist']):
-        print('config specifies notification_whitelist however '
-              'apply_whitelist_to is not present or empty - whitelist will not '
-              'be used', file=sys.stderr)
-    for event in config['apply_whitelist_to']:
-        if event not in ['comments', 'replies', 'unread_notes', 'deviations']:
-            print('\'%s\' in \'apply_whitelist_to\' configuration is invalid -'
-                  ' please use \'comments\'/\'replies\'/\'unread_notes\''
-                  '/\'deviations\'' % event, file=sys.stderr)
+    # Credentials has been split out into its own file so that it can be shared
+    # amongst various scripts - see devart_config
+    config_loader = devart_config.ConfigLoader('deviantart-checker',
+                                               CONFIG_SCHEMA, prepare_config)
+    config = config_loader.load()
 
 
 def poll_service():
@@ -150,25 +107,63 @@ def poll_service():
 
     # pylint: disable=too-many-locals,too-many-branches,too-many-statements
 
+    # Metrics are always gathered, but only served when metrics_port is
+    # configured - any errors here will be fatal and are handled in the main
+    # scope
+    metrics = devart_metrics.Metrics({'account': config['username'],
+                                      'script': 'deviantart-checker'})
+    devart_metrics.define_checker_metrics(metrics)
+    metrics.define('deviantart_state_file_bytes', 'gauge',
+                   'Size of the account state file')
+    devart_metrics.start_metrics_server(metrics, config)
+    instrumentation = devart.instrumentation_from_config(config)
+    instrumentation.append(devart_metrics.MetricsInstrumentation(metrics))
+
     # Logging in to deviantART - any errors here will be fatal and are handled
     # in the main scope
-    dA = devart.DeviantArtService(config['username'], config['password'])
+    dA = devart.DeviantArtService(config['username'], config['password'],
+                                  base_URL=config.get('base_url'),
+                                  record_directory=config.get(
+                                      'record_directory'),
+                                  instrumentation=instrumentation)
     state = devart.AccountState('~/.cache/deviantart-scripts/deviantart-checker-state.txt')
 
-    # Looping for regular message fetching
+    # Looping for regular message fetching - messages types are only fetched
+    # when they are due, last_checked being when each was last successfully
+    # fetched
+    last_checked = {}
+    polls_count = 0
     while True:
 
+        poll_start = time.perf_counter()
+        poll_result = 'failure'
         try:
 
             # Attempting to log in - errors at this level will be logged and the
             # program will simply wait until the next interval to try again
             if not dA.logged_in:
-                dA.login()
+                try:
+                    dA.login()
+                except Exception:
+                    metrics.increment('deviantart_logins_total',
+                                      result='failure')
+                    raise
+                metrics.increment('deviantart_logins_total', result='success')
+
+            # Polls never happen exactly update_every_minutes apart, so
+            # allowing some leeway so that types aren't checked a poll late
+            check_time = time.monotonic()
+            due_messages_types = [
+                MESSAGES_TYPES[event] for event in config['check_for']
+                if (event not in last_checked or
+                    check_time - last_checked[event] >=
+                    config['check_every_minutes'][event] * 60 - 30)]
 
             try:
 
-                # Getting the current state of messages
-                dA.get_messages(state)
+                # Getting the current state of the due messages
+                if due_messages_types:
+                    dA.get_messages(state, due_messages_types)
 
             # Currently I'll treat all exceptions here as issues with
             # deviantART or an expired login - invalidate the login and report
@@ -177,197 +172,239 @@ def poll_service():
                 dA.logged_in = False
                 raise
 
-            # Working out how the state has changed
-            new_comments = devart.get_new(state, devart.COMMENTS)
-            new_replies = devart.get_new(state, devart.REPLIES)
-            new_unread_notes = devart.get_new(state, devart.UNREAD_NOTES)
-            new_deviations = devart.get_new(state, devart.DEVIATIONS)
-
-            # Setting default change reporting state based on whether there is
-            # a notification whitelist in use, and then the particular events
-            # affected
-            notification_whitelist_comments = False
-            notification_whitelist_replies = False
-            notification_whitelist_unread_notes = False
-            notification_whitelist_deviations = False
-            if ('notification_whitelist' in config and
-                    config['notification_whitelist'] and
-                    'apply_whitelist_to' in config and
-                    config['apply_whitelist_to']):
-                if 'comments' in config['apply_whitelist_to']:
-                    notification_whitelist_comments = True
-                if 'replies' in config['apply_whitelist_to']:
-                    notification_whitelist_replies = True
-                if 'unread_notes' in config['apply_whitelist_to']:
-                    notification_whitelist_unread_notes = True
-                if 'deviations' in config['apply_whitelist_to']:
-                    notification_whitelist_deviations = True
+            for event in config['check_for']:
+                if MESSAGES_TYPES[event] in due_messages_types:
+                    last_checked[event] = check_time
+
+            # Working out how the state has changed - types that weren't
+            # fetched haven't changed
+            new_comments = new_replies = set()
+            new_unread_notes = new_deviations = set()
+            if devart.COMMENTS in due_messages_types:
+                new_comments = devart.get_new(state, devart.COMMENTS)
+            if devart.REPLIES in due_messages_types:
+                new_replies = devart.get_new(state, devart.REPLIES)
+            if devart.UNREAD_NOTES in due_messages_types:
+                new_unread_notes = devart.get_new(state, devart.UNREAD_NOTES)
+            if devart.DEVIATIONS in due_messages_types:
+                new_deviations = devart.get_new(state, devart.DEVIATIONS)
+            for messages_type, new_messages in [('comments', new_comments),
+                                                ('replies', new_replies),
+                                                ('unread_notes',
+                                                 new_unread_notes),
+                                                ('deviations', new_deviations)]:
+                metrics.increment('deviantart_new_items_total',
+                                  len(new_messages), type=messages_type)
+            if os.path.exists(state.state_file_path):
+                metrics.set('deviantart_state_file_bytes',
+                            os.path.getsize(state.state_file_path))
 
             # Summarise changes, and when a whitelist is in place, only
             # returning information if it includes something generated from a
             # person of interest
-            # Filter is used to remove empty items, list is used to explicitly
-            # evaluate immediately
-            comments_change_title, comments_change_summary, comments_users = summarise_changes(new_comments, devart.COMMENTS)  # pylint: disable=line-too-long
-            if ((notification_whitelist_comments and not set(config['notification_whitelist']).intersection(comments_users)) or  # pylint: disable=line-too-long
-                    not comments_change_title):
-                comments = ''
-            else:
-                comments = '%s:\n%s' % (comments_change_title,
-                                        comments_change_summary)
-
-            replies_change_title, replies_change_summary, replies_users = summarise_changes(new_replies, devart.REPLIES)  # pylint: disable=line-too-long
-            if ((notification_whitelist_replies and not set(config['notification_whitelist']).intersection(replies_users)) or  # pylint: disable=line-too-long
-                    not replies_change_title):
-                replies = ''
-            else:
-                replies = '%s:\n%s' % (replies_change_title,
-                                       replies_change_summary)
-
-            unread_notes_change_title, unread_notes_change_summary, unread_notes_users = summarise_changes(new_unread_notes, devart.UNREAD_NOTES)  # pylint: disable=line-too-long
-            if ((notification_whitelist_unread_notes and not set(config['notification_whitelist']).intersection(unread_notes_users)) or  # pylint: disable=line-too-long
-                    not unread_notes_change_title):
-                unread_notes = ''
-            else:
-                unread_notes = '%s:\n%s' % (unread_notes_change_title,
-                                            unread_notes_change_summary)
-
-            deviations_change_title, deviations_change_summary, deviations_users = summarise_changes(new_deviations, devart.DEVIATIONS)  # pylint: disable=line-too-long
-            if ((notification_whitelist_deviations and not set(config['notification_whitelist']).intersection(deviations_users)) or  # pylint: disable=line-too-long
-                    not deviations_change_title):
-                deviations = ''
-            else:
-                deviations = '%s:\n%s' % (deviations_change_title,
-                                          deviations_change_summary)
-
-            # pylint: disable=bad-builtin
-            title_bits = list(filter(None, [deviations_change_title,
-                                            unread_notes_change_title,
-                                            replies_change_title,
-                                            comments_change_title]))
-            content = list(filter(None, [deviations, unread_notes, replies,
-                                         comments]))
+            title_bits, content = summarise_changes({
+                devart.COMMENTS: new_comments, devart.REPLIES: new_replies,
+                devart.UNREAD_NOTES: new_unread_notes,
+                devart.DEVIATIONS: new_deviations})
 
+            # Notifications are delivered in the background so that they can't
+            # delay polling
             if content:
+                notifications.notify(notification_sinks,
+                                     ", ".join(title_bits),
+                                     "\n\n".join(content))
 
-                try:
-                    # pylint: disable=line-too-long
-                    command_fragments = generate_command_fragments(config['command_to_run'],
-                                                                   ", ".join(title_bits),
-                                                                   "\n\n".join(content))
-
-                    # Running command without a shell
-                    subprocess.call(command_fragments)
-
-                except Exception as e:  # pylint: disable=broad-except
-                    raise Exception('Calling the command to run to notify changes '
-                                    'failed:\n\n%s\n\n%s\n' %
-                                    (config['command_to_run'], e))
+            poll_result = 'success'
+            metrics.set('deviantart_last_success_timestamp_seconds',
+                        time.time())
 
         except Exception as e:  # pylint: disable=broad-except
             handle_unknown_error(e)
 
-        time.sleep(config['update_every_minutes'] * 60)
+        metrics.observe('deviantart_poll_duration_seconds',
+                        time.perf_counter() - poll_start, result=poll_result)
 
+        # When profiling, only the requested number of polls are made
+        polls_count += 1
+        if options.profile and polls_count >= options.profile_polls:
+            return
 
-def summarise_changes(messages, messages_type):
-    '''A report summarising new messages of the relevant type'''
+        # Waiting for the next poll, picking up any changes to the
+        # configuration meanwhile (including to the wait itself)
+        wait_start = time.monotonic()
+        while True:
+            remaining = (wait_start + config['update_every_minutes'] * 60 -
+                         time.monotonic())
+            if remaining <= 0:
+                break
+            time.sleep(min(remaining, devart_config.RELOAD_CHECK_SECONDS))
+            reload_config()
 
-    # pylint: disable=redefined-outer-name, too-many-branches
-    # pylint: disable=too-many-locals
 
-    users = []
+def prepare_config(config):  # pylint: disable=redefined-outer-name
+    '''Check and work out the settings derived from a newly-loaded
+    configuration'''
 
-    # Returning null-length strings if no actual change has happened
-    if not messages:
-        return '', '', []
+    if not config['command_to_run'] and not config['notification_sinks']:
+        raise Exception('Please ensure command_to_run or notification_sinks is '
+                        'configured in \'%s\''
+                        % config_loader.config_file_path)
 
-    # Dealing with different message types
-    if messages_type == devart.COMMENTS or messages_type == devart.REPLIES:
+    if config['notification_whitelist'] and not config['apply_whitelist_to']:
+        print('config specifies notification_whitelist however '
+              'apply_whitelist_to is not present or empty - whitelist will not '
+              'be used', file=sys.stderr)
 
-        # Sorting comments on page they were posted under then the
-        # timestamp - body is included so that it can be used later
-        new_comments = sorted([(comment.title, comment.ts, comment.who,
-                                comment.body)
-                               for comment in messages],
-                              key=lambda comment: (comment[0], comment[1],
-                                                   comment[2], comment[3]))
-
-        # Generating and returning summary
-        current_title = None
-        summary = []
-        for title, _, who, body in new_comments:
-            if current_title != title:
-                summary.append('\nOn ' + title + ':\n')
-                current_title = title
-            summary.append('%s posted:\n%s' % (who, body))
-
-            # Keeping record of users causing the updates
-            if not who in users:
-                users.append(who)
-
-        if messages_type == devart.COMMENTS:
-            messages_type_text = 'Comments'
-        else:
-            messages_type_text = 'Replies'
-        return 'New ' + messages_type_text, '\n'.join(summary), users
+    # Compiling the whitelist once - usernames are matched case-insensitively
+    # as on deviantART, and whitelisted_events is the event types the whitelist
+    # actually applies to
+    config['notification_whitelist'] = frozenset(
+        username.casefold() for username in config['notification_whitelist'])
+    config['whitelisted_events'] = frozenset(
+        config['apply_whitelist_to'] if config['notification_whitelist']
+        else [])
 
-    elif messages_type == devart.UNREAD_NOTES:
+    # Event types are checked every update unless configured to be checked
+    # less often
+    config['check_every_minutes'] = {
+        event: max(config['check_every_minutes'].get(event, 0),
+                   config['update_every_minutes'])
+        for event in MESSAGES_TYPES}
 
-        # Sorting unread notes based on sender then title
-        new_unread_notes = sorted([(note.sender, note.title, note.text)
-                                   for note in messages],
-                                  key=lambda note: (note[0], note[1]))
 
-        # Generating and returning summary, now including note text
-        current_sender = None
-        summary = []
-        for sender, title, text in new_unread_notes:
-            if current_sender != sender:
-                summary.append('\n' + sender + ' sent:\n')
-                current_sender = sender
-            summary += [title, '=' * len(title), text, '\n']
+def reload_config():
+    '''Pick up any changes to the configuration - an invalid configuration is
+    reported, carrying on with the previous one'''
 
-            # Keeping record of users causing the updates
-            if not sender in users:
-                users.append(sender)
+    # pylint: disable=global-statement
+    global config, notification_sinks, failure_notification_sinks
 
-        return 'New Unread Notes', '\n'.join(summary), users
+    try:
+        new_config = config_loader.reload()
+        if new_config is None:
+            return
+        new_notification_sinks = devart_notify.sinks_from_config(
+            '[deviantart-checker] ', new_config, 'notification_sinks',
+            'command_to_run')
+        new_failure_notification_sinks = devart_notify.sinks_from_config(
+            '[deviantart-checker] ', new_config, 'failure_notification_sinks',
+            'command_to_run_on_failure')
+    except Exception as e:  # pylint: disable=broad-except
+        error_message = ('Unable to reload the configuration - carrying on '
+                         'with the previous one:\n\n%s' % e)
+        print(error_message, file=sys.stderr)
+        notifications.notify(failure_notification_sinks, 'Error',
+                             error_message)
+        return
+
+    # Anything already queued for the old sinks is still delivered
+    notifications.retire(notification_sinks + failure_notification_sinks)
+    notifications.retries = new_config['notification_retries']
+    config = new_config
+    notification_sinks = new_notification_sinks
+    failure_notification_sinks = new_failure_notification_sinks
+
+
+def summarise_changes(new_messages):
+    '''Titles and reports summarising new messages of all types (a dictionary
+    of messages type -> new messages), leaving out types where the whitelist
+    applies and no-one on it was involved'''
+
+    title_bits = []
+    content = []
+    for messages_type, event, title in SUMMARY_ORDER:
+        if not new_messages.get(messages_type):
+            continue
+
+        summary, users = summarise_messages(new_messages[messages_type],
+                                            messages_type)
+        if (event in config['whitelisted_events'] and
+                config['notification_whitelist'].isdisjoint(users)):
+            continue
+        title_bits.append(title)
+        content.append('%s:\n%s' % (title, summary))
+    return title_bits, content
+
+
+def summarise_messages(messages, messages_type):
+    '''A report summarising new messages of the relevant type, along with the
+    casefolded usernames of everyone involved'''
+
+    # Messages are grouped in one pass, with only the groups and the messages
+    # within them sorted
+    groups = {}
+    summary = []
+    if messages_type == devart.COMMENTS or messages_type == devart.REPLIES:
 
-    elif messages_type == devart.DEVIATIONS:
+        # Grouping comments on page they were posted under then sorting on the
+        # timestamp
+        for comment in messages:
+            groups.setdefault(comment.title, []).append(comment)
+        for title in sorted(groups):
+            summary.append('\nOn ' + title + ':\n')
+            summary += ['%s posted:\n%s' % (comment.who, comment.body)
+                        for comment in sorted(groups[title],
+                                              key=lambda comment: (
+                                                  comment.ts, comment.who,
+                                                  comment.body))]
+        users = {comment.who.casefold() for comment in messages}
 
-        # Generating case-insensitive sorted list of usernames and titles,
-        # in that order
-        new_deviations = sorted([(deviation.username, deviation.title)
-                                 for deviation in messages],
-                                key=lambda deviation: (deviation[0].lower(),
-                                                       deviation[1].lower()))  # pylint: disable=line-too-long
+    elif messages_type == devart.UNREAD_NOTES:
 
-        # Generating and returning summary
-        current_username = None
-        summary = []
-        for username, title in new_deviations:
-            if current_username != username:
-                summary.append('\n' + username + ':\n')
-                current_username = username
-            summary.append(title)
+        # Grouping unread notes on sender then sorting on title, now including
+        # note text
+        for note in messages:
+            groups.setdefault(note.sender, []).append(note)
+        for sender in sorted(groups):
+            summary.append('\n' + sender + ' sent:\n')
+            for note in sorted(groups[sender], key=lambda note: note.title):
+                summary += [note.title, '=' * len(note.title), note.text, '\n']
+        users = {note.sender.casefold() for note in messages}
 
-            # Keeping record of users causing the updates
-            if not username in users:
-                users.append(username)
+    elif messages_type == devart.DEVIATIONS:
 
-        return 'New Deviations', '\n'.join(summary), users
+        # Grouping deviations on username then sorting on title, both
+        # case-insensitively
+        for deviation in messages:
+            groups.setdefault(deviation.username, []).append(deviation)
+        for username in sorted(groups, key=lambda username: (username.lower(),
+                                                             username)):
+            summary.append('\n' + username + ':\n')
+            summary += sorted((deviation.title
+                               for deviation in groups[username]),
+                              key=lambda title: (title.lower(), title))
+        users = {deviation.username.casefold() for deviation in messages}
 
     else:
 
         # Invalid messages_type passed
-        raise Exception('summarise_changes was called with an invalid '
+        raise Exception('summarise_messages was called with an invalid '
                         'messages_type (%s)' % messages_type)
 
+    return '\n'.join(summary), users
+
 
-# Loading config
+# Configuring and parsing passed options
+parser = argparse.ArgumentParser()
+parser.add_argument('--profile', dest='profile', help='profile the polls made, '
+'writing the stats to this file and a summary of where the time went to stderr '
+'before exiting')
+parser.add_argument('--profile-polls', dest='profile_polls', help='number of '
+'polls to profile (default 1)', type=int, default=1)
+options = parser.parse_args()
+if options.profile_polls < 1:
+    parser.error('--profile-polls must be at least 1')
+devart_profile.start_profiler(options.profile)
+
+# Loading config, and starting notifications
 try:
     load_config()
+    notifications = devart_notify.dispatcher_from_config(config)
+    notification_sinks = devart_notify.sinks_from_config(
+        '[deviantart-checker] ', config, 'notification_sinks', 'command_to_run')
+    failure_notification_sinks = devart_notify.sinks_from_config(
+        '[deviantart-checker] ', config, 'failure_notification_sinks',
+        'command_to_run_on_failure')
 except Exception as e:  # pylint: disable=broad-except
     print('Unable to load or invalid configuration file:\n\n%s' % e,
           file=sys.stderr)
@@ -395,3 +432,7 @@ with open(__file__) as f:
 
         # Release lock
         fcntl.flock(f, fcntl.LOCK_UN | fcntl.LOCK_NB)
+
+        # Giving queued notifications (e.g. of a fatal error) a chance to be
+        # sent
+        notifications.close()
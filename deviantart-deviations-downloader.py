@@ -19,94 +19,310 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
 import argparse
+import hashlib
 import io
+import math
 import os
 import os.path
+import re
 import sqlite3
 import sys
-import traceback
-
-import yaml
+import threading
+import time
+import urllib.parse
 
 import devart
+import devart_config
+import devart_probe
+import devart_profile
+
 
+# The configuration schema (see devart_config) - by default, every deviation's
+# full detail is revalidated roughly once a month, spread evenly over the
+# nightly runs
+CONFIG_SCHEMA = {
+    'database_path': devart_config.Setting(str, required=True),
+    'files_directory': devart_config.Setting(str),
+    'revalidate_every_days': devart_config.Setting(int, 30, minimum=1)}
 
 config = {}
 con = None
+recorded_deviation_folder_IDs = set()
+worker_state = threading.local()
 
 # pylint: disable=global-statement,global-variable-not-assigned
 
 
-def delete_deviation(deviation):
+def apply_deviation_folder_changes(deviation_folders, mappings_to_add,
+                                   mappings_to_remove, deviation_IDs_to_delete):
+    '''Record new deviation folders, add and remove (deviation ID, folder ID)
+    mappings and delete deviations in one transaction, then clean out folders
+    that no longer have any deviations, and stored files that no longer belong
+    to any deviation'''
 
     global con
 
-    # Reusing this code rather than duplicating - also cleans out folders that
-    # are now empty
-    record_removed_deviation_folder_mappings(deviation, deviation.folders)
-
-    # Deleting deviation
-    con.execute('''
+    deleted_files = []
+    for deviation_ID in deviation_IDs_to_delete:
+        deleted_files += con.execute('''
+            select sha256, path
+            from tbl_deviation_file
+            where fk_deviation_id = ?
+        ''', (deviation_ID,)).fetchall()
+
+    record_deviation_folders(deviation_folders)
+    con.executemany('''
+        insert into tbl_deviation_folders(fk_deviation_id, fk_folder_id)
+        values(?, ?)
+    ''', mappings_to_add)
+    con.executemany('''
         delete from tbl_deviation_folders
-        where fk_deviation_id = :id
-    ''', {'id': deviation.ID})
-    con.execute('''
+        where fk_deviation_id = ?
+            and fk_folder_id = ?
+    ''', mappings_to_remove)
+    con.executemany('''
+        delete from tbl_deviation_folders
+        where fk_deviation_id = ?
+    ''', ((deviation_ID,) for deviation_ID in deviation_IDs_to_delete))
+    con.executemany('''
+        delete from tbl_deviation_file
+        where fk_deviation_id = ?
+    ''', ((deviation_ID,) for deviation_ID in deviation_IDs_to_delete))
+    con.executemany('''
         delete from tbl_deviation
-        where id = :id
-    ''', {'id': deviation.ID})
+        where id = ?
+    ''', ((deviation_ID,) for deviation_ID in deviation_IDs_to_delete))
+
+    # Cleaning up folders with no deviations
+    con.execute('''
+        delete from tbl_folder
+        where not exists (
+            select 1
+            from tbl_deviation_folders df
+            where df.fk_folder_id = tbl_folder.id
+        )
+    ''')
     con.commit()
+    delete_unused_files(deleted_files)
+
+
+def check_for_changes():
+    '''Quickly check for work since the last run (see --check-only), returning a
+    description of the first thing noticed or None. Only the first page of the
+    gallery is checked, so deletions and listing changes beyond it are only
+    noticed when the gallery fits on one page'''
+
+    known_deviations = get_known_deviations()
+    if not known_deviations:
+        return 'no deviations have been recorded yet'
+
+    # As revalidation is spread over the runs, some deviation is nearly always
+    # due - a batch is only called for when none has been validated for a day
+    if (time.time() - get_last_validated_timestamp() >= 24 * 60 * 60 and
+            get_deviation_IDs_to_revalidate(
+                1, config['revalidate_every_days'] * 24 * 60 * 60)):
+        return 'deviations are due for revalidation'
+    if options.download_files and (get_deviation_IDs_without_file_URL() or
+                                   get_deviation_files_to_download()):
+        return 'deviation files are waiting to be downloaded'
+
+    probe = devart_probe.ProbeService(config['username'], config['password'],
+                                      config.get('base_url'))
+    probe.login()
+    deviations = probe.get_gallery_deviations(config['username'])
+    for deviation_ID, title, deviation_URL in deviations:
+        if deviation_ID not in known_deviations:
+            return 'deviation \'%s\' is new' % title
+        if (known_deviations[deviation_ID][1] !=
+                devart.fingerprint(title, deviation_URL)):
+            return 'the listing of deviation \'%s\' has changed' % title
+
+    # deviantART lists 120 deviations per gallery page
+    if len(deviations) < 120 and len(deviations) != len(known_deviations):
+        return 'deviations have been deleted'
+    return None
+
+
+def delete_unused_files(stored_files):
+    '''Delete the passed (SHA-256, path) stored files from the file store when
+    no deviation uses them any more - the store is content-addressed, so
+    another deviation may have an identical file'''
 
-    if options.verbose:
-        print('Deviation \'%s\' deleted' % deviation.title)
+    global con
+
+    # Without files_directory configured there is nowhere to delete from
+    if not config['files_directory']:
+        return
 
+    for sha256, path in set(stored_files):
+        if con.execute('''
+            select 1
+            from tbl_deviation_file
+            where sha256 = ?
+                and path = ?
+        ''', (sha256, path)).fetchone():
+            continue
+
+        # Failing to delete a file is reported, as it only wastes space
+        try:
+            os.remove(os.path.join(config['files_directory'], path))
+        except FileNotFoundError:
+            pass
+        except Exception as e:  # pylint: disable=broad-except
+            print('Unable to delete unused stored file \'%s\':\n\n%s\n'
+                  % (path, e), file=sys.stderr)
+            continue
+        if options.verbose:
+            print('Unused stored file \'%s\' deleted' % path)
+
+
+def download_deviation_file(deviation_file):
+    '''Download the passed (deviation ID, file URL)'s file into the file store,
+    returning its SHA-256, path relative to files_directory and size (runs in
+    a worker thread)'''
+
+    deviation_ID, file_URL = deviation_file
+
+    # Partial downloads are kept between runs so that they can be resumed -
+    # making sure not to resume a download of a file that has since changed
+    partial_file_path = os.path.join(config['files_directory'], 'partial',
+                                     '%s-%s' % (deviation_ID,
+                                                devart.fingerprint(file_URL)))
+    get_worker_service().download_file(file_URL, partial_file_path)
+    return store_file(partial_file_path, file_URL)
 
-def get_all_deviations():
-    '''Fetch all known deviations'''
+
+def get_deviation_files_to_download():
+    '''Fetch (deviation ID, file URL) pairs for deviations whose file has not
+    been downloaded, or has changed since it was'''
 
     global con
 
-    deviations = con.execute('''
-        select id, title, url, username, timestamp, description
-        from tbl_deviation
+    return con.execute('''
+        select d.id, d.file_url
+        from tbl_deviation d
+        left join tbl_deviation_file f on d.id = f.fk_deviation_id
+        where d.file_url != ''
+            and (f.fk_deviation_id is null or f.url != d.file_url)
+        order by d.id
+    ''').fetchall()
+
+
+def get_deviation_folder_index():
+    '''Fetch all deviation to folder mappings in one go, as a dict of
+    deviation ID to a set of folder IDs'''
+
+    global con
+
+    # Doing this per deviation is far too slow over a large gallery
+    deviation_folder_index = {}
+    for deviation_ID, folder_ID in con.execute('''
+        select fk_deviation_id, fk_folder_id
+        from tbl_deviation_folders
+    '''):
+        deviation_folder_index.setdefault(deviation_ID, set()).add(folder_ID)
+
+    return deviation_folder_index
+
+
+def get_deviation_folder_IDs():
+    '''Fetch the IDs of all recorded deviation folders'''
+
+    global con
+
+    folder_IDs = con.execute('''
+        select id
+        from tbl_folder
     ''').fetchall()
 
-    return [devart.Deviation(record[0], record[1], record[2], record[3],
-                             record[4], record[5]) for record in deviations]
+    # Remove silly tuples - folder IDs are stored as text but are ints
+    # elsewhere
+    return {int(folder_ID[0]) for folder_ID in folder_IDs}
 
 
-def get_last_deviation_id():
-    '''Fetch the ID of the newest deviation'''
+def get_deviation_IDs_to_revalidate(count, max_age):
+    '''Fetch the IDs of up to count deviations that haven't had their full
+    detail validated for at least max_age seconds, least recently validated
+    first'''
 
     global con
 
-    last_deviation_ID = con.execute('''
+    # Deviations recorded before fingerprinting was introduced have never been
+    # validated, so go first
+    deviation_IDs = con.execute('''
         select id
         from tbl_deviation
-        order by id desc 
-        limit 1
-    ''').fetchone()
+        where validated_timestamp is null
+            or validated_timestamp <= :validated_before
+        order by validated_timestamp is not null, validated_timestamp
+        limit :count
+    ''', {'validated_before': int(time.time()) - max_age,
+          'count': count}).fetchall()
 
-    # Make sure not to return None
-    if last_deviation_ID is None:
-        return 0
-    else:
-        return int(last_deviation_ID[0])
+    # Remove silly tuples
+    return [deviation_ID[0] for deviation_ID in deviation_IDs]
 
 
-def get_deviation_folders(deviation_ID):
-    '''Return a list of deviation folders associated with the passed deviation'''
+def get_deviation_IDs_without_file_URL():
+    '''Fetch the IDs of deviations recorded before file links were'''
 
     global con
-    recordset = con.execute('''
-        select f.id, f.title, f.description, f.url
-        from tbl_deviation d
-        inner join tbl_deviation_folders df on d.id = df.fk_deviation_id
-            and d.id = :id
-        inner join tbl_folder f on df.fk_folder_id = f.id
-    ''', {'id': deviation_ID}).fetchall()
 
-    return [devart.DeviationFolder(record[0], record[1], record[2], record[3])
-            for record in recordset]
+    deviation_IDs = con.execute('''
+        select id
+        from tbl_deviation
+        where file_url is null
+    ''').fetchall()
+
+    # Remove silly tuples
+    return [deviation_ID[0] for deviation_ID in deviation_IDs]
+
+
+def get_known_deviations():
+    '''Fetch the titles, listing fingerprints and detail fingerprints of all
+    known deviations as a dict keyed by ID'''
+
+    global con
+
+    return {record[0]: record[1:] for record in con.execute('''
+        select id, title, listing_fingerprint, detail_fingerprint
+        from tbl_deviation
+    ''')}
+
+
+def get_last_validated_timestamp():
+    '''Fetch when a deviation's full detail was last validated, 0 if never'''
+
+    global con
+
+    return con.execute('''
+        select coalesce(max(validated_timestamp), 0)
+        from tbl_deviation
+    ''').fetchone()[0]
+
+
+def get_worker_service():
+    '''Return the deviantART service for the current thread - services keep
+    per-request state so can't be shared between threads'''
+
+    global dA
+
+    if not hasattr(worker_state, 'service'):
+        worker_state.service = dA.clone()
+    return worker_state.service
+
+
+def fetch_deviation(deviation):
+    '''Fetch the full detail of a deviation listed in the gallery (runs in a
+    worker thread)'''
+
+    # Combining with folder information only available via the gallery
+    # 16.02.17: dA has redone the HTML for the gallery, no folder information is
+    # available, and its still not available in the deviation pages themselves.
+    # This kills off recording folders for now
+    full_deviation = get_worker_service().get_deviation(deviation.URL)
+    full_deviation.folders = deviation.folders
+    return full_deviation
 
 
 def load_config():
@@ -114,35 +330,15 @@ def load_config():
 
     global config
 
-    # Loading configuration if it exists. Credentials has been split out into
-    # its own file so that it can be shared amongst various scripts
-    config_directory = os.path.expanduser('~/.config/deviantart-scripts')
-    config_file_path = os.path.join(config_directory, 'deviantart-deviations-downloader.conf')
-    credentials_file_path = os.path.join(config_directory, 'credentials.conf')
-    if (os.path.exists(config_file_path)
-        and os.path.exists(credentials_file_path)):
-
-        # Loading YAML documents - theres no need for them to be genuinely
-        # separate documents, so just sticking them together
-        try:
-            config_text = (io.open(config_file_path, 'r').read() + '\n' +
-                            io.open(credentials_file_path, 'r').read())
-            config = yaml.load(config_text, yaml.CLoader)
-            if config is None:
-                raise Exception('YAML documents empty')
-        except Exception as e:
-            raise Exception('Unable to load config from YAML documents '
-                            '\'%s\' and \'%s\':\n\n%s\n\n%s\n'
-                            % (config_file_path, credentials_file_path, e,
-                               traceback.format_exc()))
-
-    # Ensuring required settings exist
-    if 'username' not in config or 'password' not in config:
-        raise Exception('Please ensure a deviantART username and password is '
-                        'configured in \'%s\'' % credentials_file_path)
-    if 'database_path' not in config:
-        raise Exception('Please ensure database_path is configured in \'%s\'' %
-                        config_file_path)
+    # Credentials has been split out into its own file so that it can be shared
+    # amongst various scripts - see devart_config
+    config_loader = devart_config.ConfigLoader(
+        'deviantart-deviations-downloader', CONFIG_SCHEMA)
+    config = config_loader.load()
+    if options.download_files and not config['files_directory']:
+        raise Exception('Please ensure files_directory is configured in \'%s\' '
+                        'in order to download files'
+                        % config_loader.config_file_path)
 
 
 def prepare_database(database_path):
@@ -170,7 +366,11 @@ def prepare_database(database_path):
             url text not null,
             username text not null,
             timestamp integer not null,
-            description text not null);
+            description text not null,
+            listing_fingerprint text,
+            detail_fingerprint text,
+            validated_timestamp integer,
+            file_url text);
         create table if not exists tbl_folder ( 
             id text primary key not null,
             title text not null,
@@ -181,31 +381,65 @@ def prepare_database(database_path):
             fk_deviation_id integer not null references tbl_deviation,
             fk_folder_id integer not null references tbl_folder
         );
+        /* Downloaded files are stored content-addressed (by SHA-256) so
+         * identical files are only stored once - path is relative to the
+         * configured files_directory */
+        create table if not exists tbl_deviation_file (
+            fk_deviation_id integer primary key not null references tbl_deviation,
+            url text not null,
+            sha256 text not null,
+            path text not null,
+            size integer not null);
+        create index if not exists sha256 on tbl_deviation_file(sha256);
         create unique index if not exists fk_note_id_fk_folder_id on tbl_deviation_folders(fk_deviation_id, fk_folder_id);
         create index if not exists fk_note_id_fk_folder_id on tbl_deviation_folders(fk_deviation_id, fk_folder_id);
         create index if not exists title on tbl_deviation(title);
         create index if not exists title on tbl_folder(title);
     ''')
+
+    # Upgrading databases created before deviations were fingerprinted and
+    # their file links recorded - the new columns are left NULL until each
+    # deviation is next validated
+    deviation_columns = [column[1] for column
+                         in con.execute('pragma table_info(tbl_deviation)')]
+    for column, column_type in [('listing_fingerprint', 'text'),
+                                ('detail_fingerprint', 'text'),
+                                ('validated_timestamp', 'integer'),
+                                ('file_url', 'text')]:
+        if column not in deviation_columns:
+            con.execute('alter table tbl_deviation add column %s %s'
+                        % (column, column_type))
+    con.execute('''
+        create index if not exists validated_timestamp
+        on tbl_deviation(validated_timestamp)
+    ''')
     con.commit()
 
 
-def record_deviation(deviation):
+def record_deviation(deviation, listing_fingerprint):
     '''Record deviation in database'''
 
     # pylint: disable=redefined-outer-name
 
     global con
 
-    # At this point the associated folders are already guaranteed created, so
-    # just inserting in
+    # Making sure the associated folders are recorded first
+    record_deviation_folders(deviation.folders)
     con.execute('''
         insert into tbl_deviation(id, title, url, username, timestamp,
-        description)
-        values(:id, :title, :url, :username, :timestamp, :description);
+        description, listing_fingerprint, detail_fingerprint,
+        validated_timestamp, file_url)
+        values(:id, :title, :url, :username, :timestamp, :description,
+        :listing_fingerprint, :detail_fingerprint, :validated_timestamp,
+        :file_url);
         ''',
         {'id': deviation.ID, 'title': deviation.title, 'url': deviation.URL,
          'username': deviation.username, 'timestamp': deviation.ts,
-         'description': deviation.description})
+         'description': deviation.description,
+         'listing_fingerprint': listing_fingerprint,
+         'detail_fingerprint': deviation.fingerprint,
+         'validated_timestamp': int(time.time()),
+         'file_url': deviation.file_URL})
 
     # Recording all folder mappings
     for deviation_folder in deviation.folders:
@@ -227,61 +461,91 @@ def record_deviation(deviation):
                  deviation.folders))
 
 
-def record_deviation_folders(deviation_folders):
-    '''Make sure deviation folders passed are recorded in the database'''
-
-    # pylint: disable=redefined-outer-name
+def record_deviation_file(deviation_ID, file_URL, sha256, path, size):
+    '''Record the downloaded file of a deviation, deleting any file it replaces
+    that is no longer used'''
 
     global con
 
-    for deviation_folder in deviation_folders:
+    previous_file = con.execute('''
+        select sha256, path
+        from tbl_deviation_file
+        where fk_deviation_id = ?
+    ''', (deviation_ID,)).fetchone()
+    con.execute('''
+        insert or replace into tbl_deviation_file(fk_deviation_id, url, sha256,
+        path, size)
+        values(:id, :url, :sha256, :path, :size)
+        ''',
+        {'id': deviation_ID, 'url': file_URL, 'sha256': sha256, 'path': path,
+         'size': size})
+    con.commit()
+    if previous_file is not None and tuple(previous_file) != (sha256, path):
+        delete_unused_files([previous_file])
 
-        # Recording deviation folder if its not already in the database -
-        # separating this out in order to get proper feedback for verbose mode
-        folder_exists = con.execute('''
-            select 1
-            from tbl_folder
-            where id = :folder_id
-        ''', {'folder_id': deviation_folder.ID}).fetchone()
-        if folder_exists is None:
+    if options.verbose:
+        print('Deviation ID \'%s\' file downloaded to \'%s\' (%d bytes)'
+              % (deviation_ID, path, size))
 
-            con.execute('''
-                insert into tbl_folder(id, title, description, url)
-                values(:id, :title, :description, :url)
-            ''', {'id': deviation_folder.ID, 'title': deviation_folder.title,
-                  'description': deviation_folder.description,
-                  'url': deviation_folder.URL})
 
-            print('Deviation folder \'%s\' recorded' % deviation_folder.title)
+def record_listing_fingerprints(listing_fingerprints):
+    '''Record the passed (listing fingerprint, deviation ID) pairs for known
+    deviations (the caller commits)'''
 
-    con.commit()
+    global con
 
+    con.executemany('''
+        update tbl_deviation
+        set listing_fingerprint = ?
+        where id = ?
+    ''', listing_fingerprints)
 
-def record_new_deviation_folder_mappings(deviation, deviation_folders):
-    '''Associate deviation with new folders in the database'''
 
-    # Full deviation passed in to get at its title
+def record_revalidated_deviation(deviation, listing_fingerprint):
+    '''Record the result of revalidating a known deviation's full detail,
+    updating it if the deviation has been edited'''
 
     # pylint: disable=redefined-outer-name
 
     global con
 
-    for deviation_folder in deviation_folders:
+    # Deviations recorded before fingerprinting have no detail fingerprint to
+    # compare with, so are just updated
+    recorded_fingerprint = known_deviations[deviation.ID][2]
+    deviation_edited = deviation.fingerprint != recorded_fingerprint
+    if deviation_edited:
         con.execute('''
-            insert into tbl_deviation_folders(fk_deviation_id, fk_folder_id)
-            values(:id, :folder_id)
-        ''', {'id': deviation.ID, 'folder_id': deviation_folder.ID})
+            update tbl_deviation
+            set title = :title, url = :url, username = :username,
+                timestamp = :timestamp, description = :description,
+                detail_fingerprint = :detail_fingerprint
+            where id = :id
+            ''',
+            {'id': deviation.ID, 'title': deviation.title,
+             'url': deviation.URL, 'username': deviation.username,
+             'timestamp': deviation.ts, 'description': deviation.description,
+             'detail_fingerprint': deviation.fingerprint})
+    con.execute('''
+        update tbl_deviation
+        set listing_fingerprint = :listing_fingerprint,
+            validated_timestamp = :validated_timestamp, file_url = :file_url
+        where id = :id
+        ''',
+        {'id': deviation.ID, 'listing_fingerprint': listing_fingerprint,
+         'validated_timestamp': int(time.time()),
+         'file_url': deviation.file_URL})
     con.commit()
 
-    if deviation_folders and options.verbose:
-        print('Deviation \'%s\' is associated with new deviation folders \'%s\''
-          % (deviation.title, deviation_folders))
+    if deviation_edited and recorded_fingerprint and options.verbose:
+        print('Edited deviation updated, ID: \'%s\', title: \'%s\', URL: '
+              '\'%s\', timestamp: \'%s\', description: \'%s\''
+              % (deviation.ID, deviation.title, deviation.URL, deviation.ts,
+                 deviation.description))
 
 
-def record_removed_deviation_folder_mappings(deviation, deviation_folders):
-    '''Remove association of deviation with given folders in the database'''
-
-    # Full deviation passed in to get at its title
+def record_deviation_folders(deviation_folders):
+    '''Make sure deviation folders passed are recorded in the database (the
+    caller commits)'''
 
     # pylint: disable=redefined-outer-name
 
@@ -289,37 +553,70 @@ def record_removed_deviation_folder_mappings(deviation, deviation_folders):
 
     for deviation_folder in deviation_folders:
 
-        # Should only be a few of these, so not going to bother doing IN, and it
-        # needs to be separated in a loop to deal with the folder cleanup
+        # Recording deviation folder if its not already in the database -
+        # separating this out in order to get proper feedback for verbose mode
+        if deviation_folder.ID in recorded_deviation_folder_IDs:
+            continue
+
         con.execute('''
-            delete from tbl_deviation_folders
-            where fk_deviation_id = :id
-                and fk_folder_id = :folder_id
-        ''', {'id': deviation.ID, 'folder_id': deviation_folder.ID})
-
-        # Cleaning up folders with no deviations
-        deviations_mapped_count = con.execute('''
-            select count(1)
-            from tbl_deviation_folders
-            where fk_folder_id = :folder_id
-        ''', {'folder_id': deviation_folder.ID}).fetchone()
-        if deviations_mapped_count is None:
-            con.execute('''
-                delete from tbl_folder
-                where id = :folder_id
-            ''', {'folder_id': deviation_folder.ID})
-    con.commit()
+            insert into tbl_folder(id, title, description, url)
+            values(:id, :title, :description, :url)
+        ''', {'id': deviation_folder.ID, 'title': deviation_folder.title,
+              'description': deviation_folder.description,
+              'url': deviation_folder.URL})
+        recorded_deviation_folder_IDs.add(deviation_folder.ID)
+
+        print('Deviation folder \'%s\' recorded' % deviation_folder.title)
+
+
+def store_file(file_path, file_URL):
+    '''Move the passed downloaded file into the content-addressed file store,
+    returning its SHA-256, path relative to files_directory and size - files
+    identical to one already stored are simply discarded'''
+
+    # Hashing in chunks so that large files are never held in memory
+    sha256 = hashlib.sha256()
+    with io.open(file_path, 'rb') as downloaded_file:
+        for chunk in iter(lambda: downloaded_file.read(65536), b''):
+            sha256.update(chunk)
+    digest = sha256.hexdigest()
+    size = os.path.getsize(file_path)
+
+    # Keeping the file extension so that stored files are still usable
+    extension = os.path.splitext(urllib.parse.urlparse(file_URL).path)[1].lower()
+    if not re.match(r'^\.[a-z0-9]{1,5}$', extension):
+        extension = ''
+
+    # Fanning out into subdirectories to keep directory sizes sensible
+    path = os.path.join(digest[:2], digest[2:4], digest + extension)
+    stored_file_path = os.path.join(config['files_directory'], path)
+    if os.path.exists(stored_file_path):
+        os.remove(file_path)
+    else:
+        os.makedirs(os.path.dirname(stored_file_path), exist_ok=True)
+        os.replace(file_path, stored_file_path)
 
-    if deviation_folders and options.verbose:
-        print('Deviation \'%s\' is no longer associated with the deviation '
-        'folders \'%s\'' % (deviation.title, deviation_folders))
+    return digest, path, size
 
 
 # Configuring and parsing passed options
 parser = argparse.ArgumentParser()
+parser.add_argument('-c', '--check-only', dest='check_only', help='quickly '
+'check deviantART first, only syncing when something has changed',
+action='store_true', default=False)
+parser.add_argument('-d', '--download-files', dest='download_files', help=
+'download the image/original file of each deviation into files_directory',
+action='store_true', default=False)
+parser.add_argument('-j', '--jobs', dest='jobs', help='number of new '
+'deviations/files to fetch concurrently (default 4)', type=int, default=4)
+parser.add_argument('--profile', dest='profile', help='profile the run, '
+'writing the stats to this file and a summary of where the time went to stderr')
 parser.add_argument('--verbose', dest='verbose', help='verbose output of '
 'script activities', action='store_true', default=False)
 options = parser.parse_args()
+if options.jobs < 1:
+    parser.error('--jobs must be at least 1')
+devart_profile.start_profiler(options.profile)
 
 try:
     load_config()
@@ -336,8 +633,30 @@ except Exception as e:  # pylint: disable=broad-except
           % (config['database_path'], e), file=sys.stderr)
     sys.exit(1)
 
+# Finishing here when a quick check shows there is nothing to do - this is done
+# with only the standard library, so Beautiful Soup, lxml and requests are never
+# even imported. When the check itself fails, the normal sync goes ahead and
+# reports any real problem
+if options.check_only:
+    try:
+        change = check_for_changes()
+    except Exception as e:  # pylint: disable=broad-except
+        change = 'the quick check failed:\n\n%s\n' % e
+    if change is None:
+        if options.verbose:
+            print('Nothing has changed on deviantART since the last run')
+        con.close()
+        sys.exit(0)
+    if options.verbose:
+        print('Syncing as %s' % change)
+
 try:
-    dA = devart.DeviantArtService(config['username'], config['password'])
+    dA = devart.DeviantArtService(config['username'], config['password'],
+                                  base_URL=config.get('base_url'),
+                                  record_directory=config.get(
+                                      'record_directory'),
+                                  instrumentation=devart.
+                                  instrumentation_from_config(config))
     dA.login()
 except Exception as e:  # pylint: disable=broad-except
     print('Unable to log in to DeviantArt:\n\n%s\n' % e, file=sys.stderr)
@@ -373,61 +692,144 @@ while True:
     # Looping
     deviation_offset += 120
 
-# Obtaining the last fetched deviation ID from the prior run
-last_deviation_id = get_last_deviation_id()
-if options.verbose:
-    print('Last deviation ID: %s' % last_deviation_id)
-
-recorded_deviation_folders = []
+# Loading everything already recorded in one go - the changes to folder
+# mappings are then determined in memory and applied in one transaction
+known_deviations = get_known_deviations()
+deviation_folder_index = get_deviation_folder_index()
+recorded_deviation_folder_IDs.update(get_deviation_folder_IDs())
+
+# Deviations are fingerprinted by what the gallery listing shows (title and
+# URL) - the full detail of known deviations is only fetched again when this
+# changes or when the deviation is due for revalidation (which catches e.g.
+# description edits), with revalidation spread over the configured number of
+# days rather than refetching everything every run
+revalidation_count = int(math.ceil(len(known_deviations) /
+                                   config['revalidate_every_days']))
+deviation_IDs_to_revalidate = set(get_deviation_IDs_to_revalidate(
+    revalidation_count, config['revalidate_every_days'] * 24 * 60 * 60))
+
+# File links are only known for deviations fetched since they started being
+# recorded, so when downloading files the rest need their detail fetched again
+if options.download_files:
+    deviation_IDs_to_revalidate.update(get_deviation_IDs_without_file_URL())
+
+# Comparing what is recorded with the gallery in one go
+new_deviation_IDs, deleted_deviation_IDs, _ = devart.diff_IDs(
+    known_deviations, [deviation.ID for deviation in deviations])
+
+deviations_to_fetch = []
+listing_fingerprints = {}
+listing_fingerprints_to_record = []
+new_deviation_folders = {}
+mappings_to_add = []
+mappings_to_remove = []
 for deviation in deviations:
+    listing_fingerprint = devart.fingerprint(deviation.title, deviation.URL)
+    listing_fingerprints[deviation.ID] = listing_fingerprint
+
+    # Anything not yet recorded is new - this rather than the newest recorded
+    # ID is used so that a deviation that failed to be fetched in a previous
+    # run is picked up again
+    if deviation.ID in new_deviation_IDs:
+        deviations_to_fetch.append(deviation)
+    else:
 
-    # Deviations are returned newest first, ID increases over time
-    if deviation.ID > last_deviation_id:
-
-        # New deviation detected - fetch the real detail, combine with folder
-        # information only available via the gallery
-        # 16.02.17: dA has redone the HTML for the gallery, no folder
-        # information is available, and its still not available in the deviation
-        # pages themselves. This kills off recording folders for now
-        full_deviation = dA.get_deviation(deviation.URL)
-        full_deviation.folders = deviation.folders
-
-        # Making sure folders are recorded, caching to reduce pointless lookups/
-        # insert or ignore attempts. Should only be a few folders so a list is
-        # fine
+        # Known deviation detected - checking whether its listing has changed.
+        # Deviations recorded before fingerprinting have their listing
+        # fingerprint filled in, and are validated on the usual schedule
+        recorded_listing_fingerprint = known_deviations[deviation.ID][1]
+        if recorded_listing_fingerprint is None:
+            listing_fingerprints_to_record.append((listing_fingerprint,
+                                                   deviation.ID))
+        elif recorded_listing_fingerprint != listing_fingerprint:
+            deviation_IDs_to_revalidate.add(deviation.ID)
+        if deviation.ID in deviation_IDs_to_revalidate:
+            deviations_to_fetch.append(deviation)
+
+        # Determining differences with the associated folders recorded
+        current_folder_IDs = deviation_folder_index.get(deviation.ID, set())
+        folder_IDs = set()
+        added_deviation_folders = []
         for deviation_folder in deviation.folders:
-            if deviation_folder not in recorded_deviation_folders:
-                record_deviation_folders([deviation_folder])
-                recorded_deviation_folders.append(deviation_folder)
-
-        # Recording the deviation
-        record_deviation(full_deviation)
+            folder_IDs.add(deviation_folder.ID)
+            if deviation_folder.ID not in current_folder_IDs:
+                added_deviation_folders.append(deviation_folder)
+                new_deviation_folders[deviation_folder.ID] = deviation_folder
+                mappings_to_add.append((deviation.ID, deviation_folder.ID))
+        removed_folder_IDs = current_folder_IDs - folder_IDs
+        mappings_to_remove += [(deviation.ID, folder_ID)
+                               for folder_ID in removed_folder_IDs]
+
+        if added_deviation_folders and options.verbose:
+            print('Deviation \'%s\' is associated with new deviation folders '
+                  '\'%s\'' % (deviation.title, added_deviation_folders))
+        if removed_folder_IDs and options.verbose:
+            print('Deviation \'%s\' is no longer associated with the deviation '
+                  'folder IDs \'%s\'' % (deviation.title, removed_folder_IDs))
+
+# New and to-be-revalidated deviations detected - fetching the real detail
+# concurrently, recording each as it arrives in ID order (oldest first).
+# Failures are retried, and failing that reported without aborting the rest of
+# the run
+if options.verbose:
+    print('Fetching %d new or changed deviations...' % len(deviations_to_fetch))
+deviations_to_fetch.sort(key=lambda deviation: deviation.ID)
+failed_deviations = []
+for deviation, full_deviation, error in devart.fetch_concurrently(
+        fetch_deviation, deviations_to_fetch, options.jobs):
+    if error is not None:
+        print('Unable to fetch deviation \'%s\' (\'%s\'):\n\n%s\n'
+              % (deviation.title, deviation.URL, error), file=sys.stderr)
+        failed_deviations.append(deviation)
+        continue
+
+    # Recording the deviation (along with any new folders), or updating it if
+    # it has been edited
+    if deviation.ID in known_deviations:
+        record_revalidated_deviation(full_deviation,
+                                     listing_fingerprints[deviation.ID])
     else:
+        record_deviation(full_deviation, listing_fingerprints[deviation.ID])
 
-        # Known deviation detected - obtaining associated folders
-        current_deviation_folders = get_deviation_folders(deviation.ID)
-
-        # Determining differences and recording in database (
-        # record_removed_deviation_folder_mappings deals with deleting unused
-        # folders)
-        new_deviation_folders = (set(deviation.folders) -
-                                 set(current_deviation_folders))
-        unknown_deviation_folders = (set(new_deviation_folders) -
-                                     set(recorded_deviation_folders))
-        record_deviation_folders(unknown_deviation_folders)
-        record_new_deviation_folder_mappings(deviation, new_deviation_folders)
-        deleted_deviation_folders = (set(current_deviation_folders)
-                                     - set(deviation.folders))
-        record_removed_deviation_folder_mappings(deviation,
-                                                 deleted_deviation_folders)
-
-# Detecting and dealing with deleted deviations
-known_deviation_ids = set(get_all_deviations())
-deleted_deviations = known_deviation_ids - set(deviations)
-for deleted_deviation in deleted_deviations:
-    delete_deviation(deleted_deviation)
+# Reporting deleted deviations
+if options.verbose:
+    for deleted_deviation_ID in deleted_deviation_IDs:
+        print('Deviation \'%s\' deleted'
+              % known_deviations[deleted_deviation_ID][0])
+
+# Applying all changes to known deviations in one transaction
+record_listing_fingerprints(listing_fingerprints_to_record)
+apply_deviation_folder_changes(new_deviation_folders.values(), mappings_to_add,
+                               mappings_to_remove, deleted_deviation_IDs)
+
+# Downloading the files of deviations concurrently, resuming any partial
+# downloads from a previous run
+failed_downloads = []
+if options.download_files:
+    os.makedirs(os.path.join(config['files_directory'], 'partial'),
+                exist_ok=True)
+    deviation_files = get_deviation_files_to_download()
+    if options.verbose:
+        print('Downloading %d deviation files...' % len(deviation_files))
+    for deviation_file, stored_file, error in devart.fetch_concurrently(
+            download_deviation_file, deviation_files, options.jobs):
+        if error is not None:
+            print('Unable to download the file of deviation ID \'%s\':\n\n%s\n'
+                  % (deviation_file[0], error), file=sys.stderr)
+            failed_downloads.append(deviation_file)
+            continue
+
+        record_deviation_file(*(tuple(deviation_file) + stored_file))
 
 con.close()
 
 if options.verbose:
     print('Finished')
+
+# Failed deviations will be fetched again on the next run (failed
+# revalidations because their listing fingerprint or validation timestamp
+# haven't been updated)
+if failed_deviations or failed_downloads:
+    print('%d deviations and %d deviation files could not be fetched'
+          % (len(failed_deviations), len(failed_downloads)), file=sys.stderr)
+    sys.exit(1)
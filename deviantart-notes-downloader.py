@@ -19,24 +19,81 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
 import argparse
-import io
+import concurrent.futures
 import os
 import os.path
+import queue
 import sqlite3
 import sys
-import traceback
-
-import yaml
+import threading
 
 import devart
-
+import devart_archive
+import devart_config
+import devart_probe
+import devart_profile
+
+
+# The configuration schema (see devart_config) - max_concurrent_requests
+# defaults to allowing one request in flight per --jobs worker.
+# use_note_previews takes notes from folder listings when they appear to be
+# shown there in full, rather than fetching them individually - off by default,
+# as a listing gives no way of telling whether line breaks survived
+CONFIG_SCHEMA = {
+    'database_path': devart_config.Setting(str, required=True),
+    'ignored_folders': devart_config.Setting(list, [],
+                                             items=devart_config.Setting(str)),
+    'max_concurrent_requests': devart_config.Setting(int, minimum=1),
+    'use_note_previews': devart_config.Setting(bool, False)}
+CONFIG_SCHEMA.update(devart_archive.CONFIG_SCHEMA)
 
 config = {}
 con = None
+note_storage = None
+
+# Worker threads fetch from deviantART while all database writes are funnelled
+# through the main thread via write_queue - sqlite connections can't be shared
+# between threads. known_note_IDs is the set of notes already recorded, so that
+# workers only fetch notes that haven't been seen before
+write_queue = queue.Queue()
+known_note_IDs = set()
+known_note_IDs_lock = threading.Lock()
+worker_state = threading.local()
 
 # pylint: disable=global-statement,global-variable-not-assigned
 
 
+def check_for_changes():
+    '''Quickly check deviantART for changes since the last run (see
+    --check-only), returning a description of the first change noticed or None.
+    Note folders are compared on their titles and the notes counts shown on the
+    notes page, the same heuristic the note count discrepancy check uses'''
+
+    probe = devart_probe.ProbeService(config['username'], config['password'],
+                                      config.get('base_url'))
+    probe.login()
+    note_folders = {folder_ID: (title, notes_count)
+                    for folder_ID, title, notes_count in probe.get_note_folders()
+                    if folder_ID not in config['ignored_folders'] and
+                    title not in config['ignored_folders']}
+    recorded_note_folders = get_note_folder_summaries()
+
+    for folder_ID, (title, notes_count) in note_folders.items():
+        if folder_ID not in recorded_note_folders:
+            return 'note folder \'%s\' is new' % title
+        recorded_title, recorded_notes_count = recorded_note_folders[folder_ID]
+        if title != recorded_title:
+            return ('note folder \'%s\' has been renamed to \'%s\''
+                    % (recorded_title, title))
+        if notes_count != recorded_notes_count:
+            return ('note folder \'%s\' has %d notes on deviantART, %d '
+                    'recorded' % (title, notes_count, recorded_notes_count))
+    for folder_ID in recorded_note_folders.keys() - note_folders.keys():
+        return ('note folder \'%s\' has been deleted'
+                % recorded_note_folders[folder_ID][0])
+    return None
+
+
 def delete_note_folder_ID(folder_ID):
     '''Delete specified note folder'''
 
@@ -55,75 +112,109 @@ def delete_note_folder_ID(folder_ID):
         print('Folder ID %s deleted' % folder_ID)
 
 
-def delete_note_IDs(note_IDs, folder_ID):
-    '''Delete specified note IDs'''
+def delete_unstaged_note_IDs(folder_ID):
+    '''Delete notes recorded in the folder that are not in the staged remote
+    note IDs (see stage_remote_note_IDs), returning the number deleted'''
 
     global con
 
-    # Database wrappers don't support substituting in sequences, so just doing
-    # it direct
+    # Everything is done set-based inside SQLite, so there is no need for huge
+    # IN lists (which fall foul of SQLite's variable limit) or Python-side sets
     # Notes can now be mapped to more than one folder, so an outright tbl_note
     # delete needs to ensure there are no remaining mappings
-    # This hits up against the usual IN problem - here I'm generating an
-    # unnamed parameter string to insert on the IN, and when the parameters are
-    # passed I'm making sure to add the folder_ID at the end (the set is
-    # converted to a list to make sure that it is impossible for the folder ID
-    # to clash with the note IDs, and in the last case, sets can't be multiplied)
-    unnamed_params = ','.join(['?' for note_ID in note_IDs])
-    note_IDs_params_1 = list(note_IDs) + [folder_ID]
-    note_IDs_params_2 = list(note_IDs) * 2
+    con.execute('''
+        delete from tmp_deleted_note;
+    ''')
+    deleted_count = con.execute('''
+        insert into tmp_deleted_note(id)
+        select nf.fk_note_id
+        from tbl_note_folders nf
+        where nf.fk_folder_id = :folder_ID
+            and not exists (
+                select 1
+                from tmp_remote_note r
+                where r.id = nf.fk_note_id
+            );
+    ''', {'folder_ID': folder_ID}).rowcount
     con.execute('''
         delete from tbl_note_folders
-        where fk_note_id in (%s)
-            and fk_folder_id = ?;
-    ''' % unnamed_params, note_IDs_params_1)
-    con.commit()
+        where fk_folder_id = :folder_ID
+            and fk_note_id in (
+                select id
+                from tmp_deleted_note
+            );
+    ''', {'folder_ID': folder_ID})
     con.execute('''
         delete from tbl_note
-        where id in (%(unnamed_params)s) and id not in (
-            select fk_note_id
-            from tbl_note_folders
-            where fk_note_id in (%(unnamed_params)s)
-        )
-    ''' % {'unnamed_params': unnamed_params}, note_IDs_params_2)
+        where id in (
+            select id
+            from tmp_deleted_note
+        ) and not exists (
+            select 1
+            from tbl_note_folders nf
+            where nf.fk_note_id = tbl_note.id
+        );
+    ''')
+    if deleted_count:
+        note_storage.delete_unused_chunks()
     con.commit()
 
-    if options.verbose:
-        print('Note IDs deleted: %s' % note_IDs)
+    if deleted_count and options.verbose:
+        deleted_note_IDs = con.execute('''
+            select id
+            from tmp_deleted_note
+        ''').fetchall()
+        print('Note IDs deleted: %s' % [ID[0] for ID in deleted_note_IDs])
 
+    return deleted_count
 
-def get_current_note_folder_IDs():
-    '''Fetch the IDs associated with note folders recorded in the database'''
+
+def fetch_notes_in_folder(note_folder, note_IDs, note_previews):
+    '''Queue the passed note IDs to be recorded in the folder, with
+    note_previews as returned by fetch_remote_note_previews_in_folder (runs in
+    a worker thread)'''
+
+    service = get_worker_service()
+    for note_ID in note_IDs:
+        queue_note_in_folder(service, note_ID, note_folder.ID,
+                             note_previews.get(note_ID))
+
+
+def fetch_remote_note_previews_in_folder(note_folder):
+    '''Fetch all note IDs in the folder from deviantART, along with the notes
+    that can be made from their previews (runs in a worker thread) - for large
+    folders this will result in multiple DiFi calls'''
+
+    return get_worker_service().get_note_previews_in_folder(note_folder.ID)
+
+
+def get_all_note_ids():
+    '''Fetch the IDs of all notes recorded in the database, regardless of
+    folder'''
 
     global con
 
-    folder_IDs_result = con.execute('''
+    note_IDs = con.execute('''
         select id
-        from tbl_folder
+        from tbl_note
     ''').fetchall()
 
     # Remove silly tuples
-    return [folder_ID[0] for folder_ID in folder_IDs_result]
+    return {note_ID[0] for note_ID in note_IDs}
 
 
-def get_note_ids_in_folder(folder_ID):
-    '''Fetch all note IDs associated with a particular folder'''
+def get_current_note_folder_IDs():
+    '''Fetch the IDs associated with note folders recorded in the database'''
 
     global con
 
-    note_IDs = con.execute('''
-        select n.id
-        from tbl_note n
-        inner join tbl_note_folders nf on n.id = nf.fk_note_id 
-            and nf.fk_folder_id = :folder_ID
-    ''', {'folder_ID': folder_ID}).fetchall()
+    folder_IDs_result = con.execute('''
+        select id
+        from tbl_folder
+    ''').fetchall()
 
-    # Converting to a set without silly tuples, and making sure not to return
-    # None
-    if note_IDs is None:
-        return set()
-    else:
-        return {ID[0] for ID in note_IDs}
+    # Remove silly tuples
+    return [folder_ID[0] for folder_ID in folder_IDs_result]
 
 
 def get_last_note_id(folder_ID):
@@ -149,6 +240,39 @@ def get_last_note_id(folder_ID):
         return int(last_note_ID[0])
 
 
+def get_unrecorded_staged_note_IDs(folder_ID):
+    '''Fetch the staged remote note IDs (see stage_remote_note_IDs) that are
+    not yet recorded in the folder, newest first'''
+
+    global con
+
+    note_IDs = con.execute('''
+        select r.id
+        from tmp_remote_note r
+        where not exists (
+            select 1
+            from tbl_note_folders nf
+            where nf.fk_note_id = r.id
+                and nf.fk_folder_id = :folder_ID
+        )
+        order by r.id desc
+    ''', {'folder_ID': folder_ID}).fetchall()
+
+    # Remove silly tuples
+    return [note_ID[0] for note_ID in note_IDs]
+
+
+def get_worker_service():
+    '''Return the deviantART service for the current thread - services keep
+    per-request state so can't be shared between threads'''
+
+    global dA
+
+    if not hasattr(worker_state, 'service'):
+        worker_state.service = dA.clone()
+    return worker_state.service
+
+
 def get_note_folder_notes_count(folder_ID):
     '''Get a count of all notes in a folder'''
 
@@ -162,42 +286,29 @@ def get_note_folder_notes_count(folder_ID):
     ''', {'folder_ID': folder_ID}).fetchone()[0]
 
 
+def get_note_folder_summaries():
+    '''Fetch the title and recorded notes count of all note folders as a dict
+    keyed by ID'''
+
+    global con
+    return {record[0]: record[1:] for record in con.execute('''
+        select f.id, f.title, count(n.id)
+        from tbl_folder f
+        left join tbl_note_folders nf on f.id = nf.fk_folder_id
+        left join tbl_note n on nf.fk_note_id = n.id
+        group by f.id, f.title
+    ''')}
+
+
 def load_config():
     '''Load config'''
 
     global config
 
-    # Loading configuration if it exists. Credentials has been split out into
-    # its own file so that it can be shared amongst various scripts
-    config_directory = os.path.expanduser('~/.config/deviantart-scripts')
-    config_file_path = os.path.join(config_directory, 'deviantart-notes-downloader.conf')
-    credentials_file_path = os.path.join(config_directory, 'credentials.conf')
-    if (os.path.exists(config_file_path)
-        and os.path.exists(credentials_file_path)):
-
-        # Loading YAML documents - theres no need for them to be genuinely
-        # separate documents, so just sticking them together
-        try:
-            config_text = (io.open(config_file_path, 'r').read() + '\n' +
-                            io.open(credentials_file_path, 'r').read())
-            config = yaml.load(config_text, yaml.CLoader)
-            if config is None:
-                raise Exception('YAML documents empty')
-        except Exception as e:
-            raise Exception('Unable to load config from YAML documents '
-                            '\'%s\' and \'%s\':\n\n%s\n\n%s\n'
-                            % (config_file_path, credentials_file_path, str(e),
-                               traceback.format_exc()))
-
-    # Ensuring required settings exist
-    if 'username' not in config or 'password' not in config:
-        raise Exception('Please ensure a deviantART username and password is '
-                        'configured in \'%s\'' % credentials_file_path)
-    if 'database_path' not in config:
-        raise Exception('Please ensure database_path is configured in \'%s\'' %
-                        config_file_path)
-    if 'ignored_folders' not in config:
-        config['ignored_folders'] = []
+    # Credentials has been split out into its own file so that it can be shared
+    # amongst various scripts - see devart_config
+    config = devart_config.ConfigLoader('deviantart-notes-downloader',
+                                        CONFIG_SCHEMA).load()
 
 
 def prepare_database(database_path):
@@ -236,8 +347,21 @@ def prepare_database(database_path):
             fk_folder_id integer not null references tbl_folder
         );
         create index if not exists fk_note_id_fk_folder_id on tbl_note_folders(fk_note_id, fk_folder_id);
+        create index if not exists fk_folder_id on tbl_note_folders(fk_folder_id);
         create index if not exists sender on tbl_note(sender);
+
+        /* Connection-specific scratch tables used to reconcile folders with
+         * deviantART set-based */
+        create temp table if not exists tmp_remote_note (
+            id integer primary key not null);
+        create temp table if not exists tmp_deleted_note (
+            id integer primary key not null);
     ''')
+
+    # Note text is stored as configured - see devart_archive
+    global note_storage
+    note_storage = devart_archive.NoteStorage(con, config['note_storage'],
+                                              config['deduplicate_note_text'])
     con.commit()
 
 
@@ -250,13 +374,17 @@ def record_note(note):
 
     # At this point the associated folder is already guaranteed created, so just
     # inserting in - however since one note can appear in many folders (e.g.
-    # Inbox and Starred), insert or ignore is used
-    con.execute('''
+    # Inbox and Starred), insert or ignore is used. The text is stored as
+    # configured, possibly using shared chunks
+    text, chunk_IDs = note_storage.encode(note.text)
+    if con.execute('''
         insert or ignore into tbl_note(id, title, sender, recipient, timestamp, text)
         values(:id, :title, :sender, :recipient, :timestamp, :text);
         ''',
         {'id': note.ID, 'title': note.title, 'sender': note.sender,
-         'recipient': note.recipient, 'timestamp': note.ts, 'text':note.text})
+         'recipient': note.recipient, 'timestamp': note.ts,
+         'text': text}).rowcount:
+        note_storage.record_chunks(note.ID, chunk_IDs)
     con.execute('''
         insert into tbl_note_folders(fk_note_id, fk_folder_id)
         values(:id, :folder_id);
@@ -264,6 +392,11 @@ def record_note(note):
         {'id': note.ID, 'folder_id': note.folder_ID})
     con.commit()
 
+    # Only now can workers treat the note as known - otherwise a folder mapping
+    # could be recorded before the note itself
+    with known_note_IDs_lock:
+        known_note_IDs.add(note.ID)
+
     if options.verbose:
         print('New note recorded, ID: \'%s\', title: \'%s\', sender: \'%s\', '
               'recipient: \'%s\', timestamp: \'%s\', folder ID: \'%s\''
@@ -271,6 +404,45 @@ def record_note(note):
                  note.folder_ID))
 
 
+def stage_remote_note_IDs(note_IDs):
+    '''Stage the note IDs present in a deviantART folder in a temporary table,
+    replacing any previously staged'''
+
+    global con
+
+    con.execute('''
+        delete from tmp_remote_note;
+    ''')
+    con.executemany('''
+        insert or ignore into tmp_remote_note(id)
+        values(?);
+    ''', ((note_ID,) for note_ID in note_IDs))
+
+
+def record_note_folder_mapping(note_ID, folder_ID):
+    '''Record an already-known note as also being in the passed folder'''
+
+    global con
+
+    # Making sure not to duplicate an existing mapping
+    con.execute('''
+        insert into tbl_note_folders(fk_note_id, fk_folder_id)
+        select :id, :folder_id
+        where not exists (
+            select 1
+            from tbl_note_folders
+            where fk_note_id = :id
+                and fk_folder_id = :folder_id
+        );
+        ''',
+        {'id': note_ID, 'folder_id': folder_ID})
+    con.commit()
+
+    if options.verbose:
+        print('Known note ID \'%s\' recorded in folder ID \'%s\''
+              % (note_ID, folder_ID))
+
+
 def record_note_folder(note_folder):
     '''Record note folder in database'''
 
@@ -310,14 +482,123 @@ def record_note_folder(note_folder):
                 print('Note folder ID \'%s\' renamed to \'%s\''
                       % (note_folder.ID, note_folder.title))
 
+
+def queue_note_in_folder(service, note_ID, folder_ID, preview=None):
+    '''Queue note to be recorded as being in a folder, only fetching it from
+    deviantART when it hasn't been recorded before and preview (the note as
+    made from the folder listing, see devart.parse_note_preview) is None (runs
+    in a worker thread)'''
+
+    # Notes are really views (e.g. Inbox and Starred), so the note may well
+    # already be archived via another folder - there is no point re-downloading
+    # and parsing its body just to record the folder mapping. A note being
+    # fetched concurrently by another folder's worker isn't known yet, so may
+    # occasionally be fetched twice, which is harmless
+    with known_note_IDs_lock:
+        note_known = note_ID in known_note_IDs
+    if note_known:
+        write_queue.put((record_note_folder_mapping, (note_ID, folder_ID)))
+    else:
+        if preview is None or not config['use_note_previews']:
+            preview = service.get_note_in_folder(folder_ID, note_ID)
+        write_queue.put((record_note, (preview,)))
+
+
+def run_workers(function, args_list):
+    '''Call function once per tuple of arguments in worker threads, with
+    database writes queued by the workers being carried out in this thread as
+    they arrive. Returns the results of the calls in order'''
+
+    def worker(*args):
+        try:
+            return function(*args)
+        finally:
+
+            # Letting the writer know this worker has finished
+            write_queue.put(None)
+
+    with concurrent.futures.ThreadPoolExecutor(options.jobs) as executor:
+        futures = [executor.submit(worker, *args) for args in args_list]
+
+        # Acting as the single database writer until all workers are done
+        running_workers = len(futures)
+        while running_workers:
+            write = write_queue.get()
+            if write is None:
+                running_workers -= 1
+                continue
+            write_function, write_args = write
+            write_function(*write_args)
+
+        # Raising any worker failure
+        return [future.result() for future in futures]
+
+
+def sync_note_folder(note_folder, last_note_ID):
+    '''Fetch notes newer than last_note_ID in the folder, queueing them to be
+    recorded (runs in a worker thread with its own paging cursor)'''
+
+    service = get_worker_service()
+    note_offset = 0
+    while True:
+
+        # Only the note IDs and previews are fetched here - notes are then
+        # fetched individually only when they aren't already known, and the
+        # preview isn't the whole note
+        if options.verbose:
+            print('Fetching notes at offset %d in folder \'%s\'...'
+                  % (note_offset, note_folder.title))
+        note_previews = service.get_note_previews_in_folder_page(
+            note_folder.ID, note_offset)
+        if options.verbose:
+            print('%d notes returned from folder \'%s\', processing...'
+                  % (len(note_previews), note_folder.title))
+
+        last_fetched_note_detected = False
+        for note_ID, _, preview in note_previews:
+
+            # Notes are returned newest first, ID increases over time
+            # If the latest note has already been recorded, the folder is done
+            if note_ID <= last_note_ID:
+                last_fetched_note_detected = True
+                break
+
+            queue_note_in_folder(service, note_ID, note_folder.ID, preview)
+
+        # Breaking if notes have been fetched
+        # If less than 25 notes are returned, its the last page of notes (of
+        # course doesn't detect the situation where exactly 25 notes are on the
+        # last page)
+        if last_fetched_note_detected or len(note_previews) < 25:
+            if options.verbose:
+                print('Last note in folder \'%s\' processed'
+                      % note_folder.title)
+            break
+
+        # Looping
+        note_offset += 25
+
+
 # Configuring and parsing passed options
 parser = argparse.ArgumentParser()
+parser.add_argument('-c', '--check-only', dest='check_only', help='quickly '
+'check deviantART first, only syncing when something has changed',
+action='store_true', default=False)
 parser.add_argument('-f', '--fsck', dest='fsck', help='force compare note IDs in'
 ' local and remote folders to delete/fetch as appropriate', action='store_true',
 default=False)
+parser.add_argument('-j', '--jobs', dest='jobs', help='number of note folders '
+'to sync concurrently (default 1)', type=int, default=1)
+parser.add_argument('--profile', dest='profile', help='profile the run, '
+'writing the stats to this file and a summary of where the time went to stderr')
 parser.add_argument('--verbose', dest='verbose', help='verbose output of '
 'script activities', action='store_true', default=False)
 options = parser.parse_args()
+if options.jobs < 1:
+    parser.error('--jobs must be at least 1')
+if options.check_only and options.fsck:
+    parser.error('--check-only can\'t be used with --fsck')
+devart_profile.start_profiler(options.profile)
 
 try:
     load_config()
@@ -334,8 +615,32 @@ except Exception as e:  # pylint: disable=broad-except
           % (config['database_path'], e), file=sys.stderr)
     sys.exit(1)
 
+# Finishing here when a quick check shows nothing has changed - this is done
+# with only the standard library, so Beautiful Soup, lxml and requests are never
+# even imported. When the check itself fails, the normal sync goes ahead and
+# reports any real problem
+if options.check_only:
+    try:
+        change = check_for_changes()
+    except Exception as e:  # pylint: disable=broad-except
+        change = 'the quick check failed:\n\n%s\n' % e
+    if change is None:
+        if options.verbose:
+            print('Nothing has changed on deviantART since the last run')
+        con.close()
+        sys.exit(0)
+    if options.verbose:
+        print('Syncing as %s' % change)
+
 try:
-    dA = devart.DeviantArtService(config['username'], config['password'])
+
+    # All workers share the one request budget
+    request_limiter = threading.BoundedSemaphore(
+        config['max_concurrent_requests'] or options.jobs)
+    dA = devart.DeviantArtService(config['username'], config['password'],
+                                  request_limiter, config.get('base_url'),
+                                  config.get('record_directory'),
+                                  devart.instrumentation_from_config(config))
     dA.login()
 except Exception as e:  # pylint: disable=broad-except
     print('Unable to log in to DeviantArt:\n\n%s\n' % e, file=sys.stderr)
@@ -352,67 +657,44 @@ except Exception as e:  # pylint: disable=broad-except
     sys.exit(1)
 
 # Removing any note_folders the user wants to ignore (better than manually
-# skipping them in each loop)
+# skipping them in each loop) - these can be given by ID or title, as with
+# check_for_changes
 if config['ignored_folders']:
     note_folders = [folder for folder in note_folders
-                    if folder not in config['ignored_folders']]
+                    if folder.ID not in config['ignored_folders'] and
+                    folder.title not in config['ignored_folders']]
+
+# Notes already recorded under any folder are never refetched
+known_note_IDs.update(get_all_note_ids())
+
+# Ensuring note folders are recorded in the database (also deals with
+# renames) - fsck mode needs them too, as it may be populating a new database
+for note_folder in note_folders:
+    record_note_folder(note_folder)
 
 # Only run the main loop if not running in fsck mode (this is redundant
-# otherwise)
+# otherwise). Folders are synced concurrently (see --jobs), so the total time
+# approaches that of the largest folder rather than the sum of all of them
 if not options.fsck:
+    folders_to_sync = []
     for note_folder in note_folders:  # pylint: disable=redefined-outer-name
 
-        if options.verbose:
-            print('Processing note folder \'%s\'...' % note_folder.title)
-
-        # Ensuring note folder is recorded in the database (also deals with renames)
-        record_note_folder(note_folder)
-
         # Obtaining the last/latest note ID recorded for this folder
         last_note_ID = get_last_note_id(note_folder.ID)
         if options.verbose:
-            print('Last note ID for this folder: %s' % last_note_ID)
+            print('Last note ID for folder \'%s\': %s' % (note_folder.title,
+                                                         last_note_ID))
+        folders_to_sync.append((note_folder, last_note_ID))
 
-        # Fetching notes
-        note_offset = 0
-        last_fetched_note_detected = False
-        while True:
-
-            if options.verbose:
-                print('Fetching notes at offset %d...' % note_offset)
-            notes = dA.get_notes_in_folder(note_folder.ID, note_offset)
-            if options.verbose:
-                print('%d notes returned, processing...' % len(notes))
-
-            for note in notes:
-
-                # Notes are returned newest first, ID increases over time
-                # If the latest note has already been recorded, skip to next folder
-                if note.ID <= last_note_ID:
-                    last_fetched_note_detected = True
-                    break
-
-                record_note(note)
-
-            # Breaking if notes have been fetched
-            # If less than 25 notes are returned, its the last page of notes (of
-            # course doesn't detect the situation where exactly 25 notes are on the
-            # last page)
-            if last_fetched_note_detected or len(notes) < 25:
-                if options.verbose:
-                    print('Last note in folder processed')
-                break
-
-            # Looping
-            note_offset += 25
+    run_workers(sync_note_folder, folders_to_sync)
 
 # Detecting deleted folders - the direction of the set delete is important
 # Fsck mode should still delete and rename folders
 if options.verbose:
     print('Checking for folders to delete...')
-db_note_folders = set(get_current_note_folder_IDs())
-da_note_folders = set([note_folder.ID for note_folder in note_folders])
-deleted_folders = db_note_folders - da_note_folders
+deleted_folders = devart.diff_IDs(get_current_note_folder_IDs(),
+                                  [note_folder.ID
+                                   for note_folder in note_folders])[1]
 for deleted_folder_ID in deleted_folders:
     delete_note_folder_ID(deleted_folder_ID)
 
@@ -438,12 +720,10 @@ if options.verbose:
         print('Force-checking note folders...')
     else:
         print('Checking for note count discrepancies...')
+folders_to_check = []
 for note_folder in note_folders:
     local_notes_count = get_note_folder_notes_count(note_folder.ID)
     if options.fsck or note_folder.site_note_count != local_notes_count:
-
-        # Fetching sets of IDs on deviantART and the local database - for large
-        # folders this will result in multiple DiFi calls
         if options.verbose:
             if options.fsck:
                 print('Checking folder \'%s\' - remote count: %s, local count: '
@@ -454,24 +734,38 @@ for note_folder in note_folders:
                       '%s, local count: %s'
                       % (note_folder.title, note_folder.site_note_count,
                          local_notes_count))
-        dA_note_ids = dA.get_note_ids_in_folder(note_folder.ID)
-        local_note_ids = get_note_ids_in_folder(note_folder.ID)
+        folders_to_check.append((note_folder,))
 
-        # Notes to delete
-        note_ids_to_delete = local_note_ids - dA_note_ids
-        if note_ids_to_delete:
-            if options.verbose:
-                print('Deleting note IDs %s...' % note_ids_to_delete)
-            delete_note_IDs(note_ids_to_delete, note_folder.ID)
+# Fetching sets of IDs on deviantART for all folders to check concurrently,
+# then comparing with the local database
+dA_folder_note_previews = run_workers(fetch_remote_note_previews_in_folder,
+                                      folders_to_check)
+folders_to_fetch = []
+for (note_folder,), dA_note_previews in zip(folders_to_check,
+                                            dA_folder_note_previews):
 
-        # Notes to fetch
-        note_ids_to_fetch = dA_note_ids - local_note_ids
-        if note_ids_to_fetch:
-            if options.verbose:
-                print('Fetching note IDs %s...' % note_ids_to_fetch)
-            for note_ID in note_ids_to_fetch:
-                note = dA.get_note_in_folder(note_folder.ID, note_ID)
-                record_note(note)
+    # Comparison is done inside SQLite against the staged remote IDs
+    stage_remote_note_IDs(dA_note_previews)
+
+    # Notes to delete
+    if options.verbose:
+        print('Deleting notes no longer in folder \'%s\'...' % note_folder.title)
+    delete_unstaged_note_IDs(note_folder.ID)
+
+    # Notes to fetch
+    note_ids_to_fetch = get_unrecorded_staged_note_IDs(note_folder.ID)
+    if note_ids_to_fetch:
+        if options.verbose:
+            print('Fetching note IDs %s...' % note_ids_to_fetch)
+        folders_to_fetch.append((note_folder, note_ids_to_fetch,
+                                 dA_note_previews))
+
+# Deletions may have removed notes entirely (e.g. a note moved between folders),
+# so these must be fetched again rather than just mapped
+with known_note_IDs_lock:
+    known_note_IDs.clear()
+    known_note_IDs.update(get_all_note_ids())
+run_workers(fetch_notes_in_folder, folders_to_fetch)
 
 con.close()
 
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+'''
+Version 0.1 2017.02.25
+Copyright (c) 2017, OmegaPhil - OmegaPhil@startmail.com
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+# Brings the notes downloader's existing archive into line with its configured
+# note_storage and deduplicate_note_text settings (see devart_archive) - the
+# downloader only stores new notes as configured. This is done offline: the
+# database is locked exclusively for the duration, so the notes downloader
+# can't run meanwhile, and is vacuumed at the end to actually give the space
+# back
+
+import argparse
+import os.path
+import sqlite3
+import sys
+import time
+
+import devart_archive
+import devart_config
+
+
+# Only the notes downloader's database and storage settings matter here
+CONFIG_SCHEMA = {'database_path': devart_config.Setting(str, required=True)}
+CONFIG_SCHEMA.update(devart_archive.CONFIG_SCHEMA)
+
+# Notes are re-encoded in batches to keep memory use down on large archives
+BATCH_SIZE = 1000
+
+# zstd's own recommended dictionary size
+DEFAULT_DICTIONARY_SIZE = 112640
+
+
+def get_text_size(con):
+    '''Bytes taken by note text, including the shared chunks'''
+
+    return con.execute('''
+        select (select coalesce(sum(length(cast(text as blob))), 0)
+                from tbl_note) +
+            (select coalesce(sum(length(cast(text as blob))), 0)
+             from tbl_note_chunk)
+    ''').fetchone()[0]
+
+
+def migrate_notes(note_storage):
+    '''Store the text of every note as configured, returning the number of
+    notes'''
+
+    note_count = 0
+    note_ID = -1
+    while True:
+        notes = note_storage.con.execute('''
+            select id, text
+            from tbl_note
+            where id > ?
+            order by id
+            limit ?
+        ''', (note_ID, BATCH_SIZE)).fetchall()
+        if not notes:
+            return note_count
+        for note_ID, value in notes:
+            note_storage.recode_note(note_ID, value)
+        note_count += len(notes)
+        if options.verbose:
+            print('%d notes migrated...' % note_count)
+
+
+# Configuring and parsing passed options
+parser = argparse.ArgumentParser()
+parser.add_argument('--dictionary-size', dest='dictionary_size', help='size in '
+'bytes of the compression dictionary trained on the archive for zstd storage, '
+'0 to keep the latest one trained (default %d)' % DEFAULT_DICTIONARY_SIZE,
+type=int, default=DEFAULT_DICTIONARY_SIZE)
+parser.add_argument('--verbose', dest='verbose', help='verbose output of '
+'script activities', action='store_true', default=False)
+options = parser.parse_args()
+if options.dictionary_size < 0:
+    parser.error('--dictionary-size can\'t be negative')
+
+try:
+    config = devart_config.ConfigLoader('deviantart-notes-downloader',
+                                        CONFIG_SCHEMA).load()
+except Exception as e:  # pylint: disable=broad-except
+    print('Unable to load or invalid configuration file:\n\n%s' % e,
+          file=sys.stderr)
+    sys.exit(1)
+
+database_path = config['database_path']
+if not os.path.exists(database_path):
+    print('The notes database \'%s\' doesn\'t exist - nothing to migrate'
+          % database_path, file=sys.stderr)
+    sys.exit(1)
+
+# The exclusive lock fails straight away when the notes downloader is running.
+# isolation_level None as transactions are managed here. The storage tables are
+# created first, as executescript commits any open transaction
+try:
+    file_size = os.path.getsize(database_path)
+    con = sqlite3.connect(database_path, timeout=0, isolation_level=None)
+    con.execute('pragma foreign_keys = on')
+    note_storage = devart_archive.NoteStorage(con, config['note_storage'],
+                                              config['deduplicate_note_text'])
+    con.execute('begin exclusive')
+except sqlite3.OperationalError as e:
+    print('Unable to lock the \'%s\' SQLite database - is the notes '
+          'downloader running?\n\n%s\n' % (database_path, e), file=sys.stderr)
+    sys.exit(1)
+except Exception as e:  # pylint: disable=broad-except
+    print('Unable to open the \'%s\' SQLite database:\n\n%s\n'
+          % (database_path, e), file=sys.stderr)
+    sys.exit(1)
+
+try:
+    start_time = time.perf_counter()
+    text_size = get_text_size(con)
+
+    # A new dictionary is trained on the current notes before compressing
+    # them with it
+    if config['note_storage'] == 'zstd' and options.dictionary_size:
+        dictionary_ID = note_storage.train_dictionary(options.dictionary_size)
+        if options.verbose:
+            print('Trained compression dictionary ID %d' % dictionary_ID)
+
+    # Chunks that end up unused are only deleted once every note is migrated,
+    # as notes still being read may use them. Chunks that are kept are then
+    # brought into line too
+    note_count = migrate_notes(note_storage)
+    deleted_chunk_count = note_storage.delete_unused_chunks()
+    note_storage.recode_chunks(BATCH_SIZE)
+    chunk_count = con.execute('''
+        select count(*)
+        from tbl_note_chunk
+    ''').fetchone()[0]
+    migrated_text_size = get_text_size(con)
+    con.execute('commit')
+except Exception as e:  # pylint: disable=broad-except
+    print('Unable to migrate the \'%s\' SQLite database (nothing has been '
+          'changed):\n\n%s\n' % (database_path, e), file=sys.stderr)
+    sys.exit(1)
+
+# Freeing the space now unused - this needs no transaction to be open
+try:
+    con.execute('vacuum')
+    con.close()
+except Exception as e:  # pylint: disable=broad-except
+    print('Notes migrated, but unable to vacuum the \'%s\' SQLite database to '
+          'free the space:\n\n%s\n' % (database_path, e), file=sys.stderr)
+    sys.exit(1)
+
+print('Migrated %d notes to %s storage%s in %.1fs - %d chunks shared (%d '
+      'deleted)\nNote text: %.1fMB -> %.1fMB\nDatabase: %.1fMB -> %.1fMB'
+      % (note_count, config['note_storage'],
+         ' with deduplication' if config['deduplicate_note_text'] else '',
+         time.perf_counter() - start_time, chunk_count, deleted_chunk_count,
+         text_size / 1048576, migrated_text_size / 1048576,
+         file_size / 1048576, os.path.getsize(database_path) / 1048576))
+
+# Encoded text can't be read by queries outside of devart_archive
+if config['note_storage'] != 'plain' or config['deduplicate_note_text']:
+    print('\nEncoded note text is now stored as BLOBs - read it with the '
+          'note_text() SQL\nfunction or the view_note view, on connections '
+          'opened with\ndevart_archive.connect() (other SQLite tools will '
+          'fail with \'no such\nfunction: note_text\'). Configure plain '
+          'storage and migrate again to undo this')
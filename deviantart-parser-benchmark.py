@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+'''
+Version 0.1 2017.02.12
+Copyright (c) 2017, OmegaPhil - OmegaPhil@startmail.com
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import argparse
+import datetime
+import io
+import json
+import platform
+import resource
+import sys
+import time
+import tracemalloc
+
+import bs4
+
+import devart
+import devart_replay
+
+
+def benchmark(function, min_time, repeat):
+    '''Measure the passed function, returning the best ops/sec over repeat
+    rounds of at least min_time seconds, and the peak memory allocated during
+    one call'''
+
+    # Warming up, then measuring allocations on their own as tracing slows
+    # everything down
+    function()
+    tracemalloc.start()
+    function()
+    peak_allocated = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    best_ops_per_sec = 0
+    for _ in range(repeat):
+        ops = 0
+        start = time.perf_counter()
+        elapsed = 0
+        while elapsed < min_time:
+            function()
+            ops += 1
+            elapsed = time.perf_counter() - start
+        best_ops_per_sec = max(best_ops_per_sec, ops / elapsed)
+
+    return best_ops_per_sec, peak_allocated
+
+
+def compare(results, baseline, threshold):
+    '''Print a comparison of results against the baseline, returning the names
+    of benchmarks that regressed by more than the threshold fraction'''
+
+    regressions = []
+    print('\n%-24s %14s %14s %8s %12s' % ('Benchmark', 'Baseline ops/s',
+                                          'Current ops/s', 'Speed', 'Allocs'))
+    for name, result in sorted(results['benchmarks'].items()):
+        if name not in baseline['benchmarks']:
+            print('%-24s %14s %14.1f' % (name, '-', result['ops_per_sec']))
+            continue
+
+        base_result = baseline['benchmarks'][name]
+        speed = result['ops_per_sec'] / base_result['ops_per_sec']
+        allocations = (result['peak_allocated_bytes'] /
+                       max(base_result['peak_allocated_bytes'], 1))
+        regressed = speed < 1 - threshold or allocations > 1 + threshold
+        if regressed:
+            regressions.append(name)
+        print('%-24s %14.1f %14.1f %7.2fx %11.2fx%s'
+              % (name, base_result['ops_per_sec'], result['ops_per_sec'], speed,
+                 allocations, '  REGRESSED' if regressed else ''))
+    return regressions
+
+
+def generate_fixtures():
+    '''Generate pages of realistic sizes from a synthetic account - full pages
+    carry ~200KB of site chrome as deviantART's do, notes are long and full of
+    links'''
+
+    account = devart_replay.SyntheticAccount(notes=50, custom_note_folders=40,
+                                             deviations=120, messages=1,
+                                             note_links=40, note_paragraphs=60,
+                                             page_chrome=200000)
+
+    # The longest note in the folder is the one that matters
+    note_ID = max(account.folder_notes['1'],
+                  key=lambda note_ID: len(account.note_page(note_ID, '1')))
+
+    return {'gallery_page': account.gallery_page(account.deviation_IDs[:120]),
+            'note': account.note_page(note_ID, '1'),
+            'note_ID': note_ID,
+            'notes_page': account.notes_page(),
+            'post': account.text(note_ID, 60)}
+
+
+# Configuring and parsing passed options
+parser = argparse.ArgumentParser()
+parser.add_argument('-b', '--benchmark', help='only run the named benchmark '
+                    '(may be repeated)', action='append')
+parser.add_argument('-o', '--output', help='write results as JSON to this file '
+                    '(e.g. to keep as a baseline)')
+parser.add_argument('-c', '--compare', help='compare results against a '
+                    'baseline JSON file written by --output, exiting with 1 on '
+                    'regressions')
+parser.add_argument('-t', '--threshold', help='fraction a benchmark can slow '
+                    'down or allocate more by before being treated as a '
+                    'regression, default 0.1', type=float, default=0.1)
+parser.add_argument('--min-time', help='seconds to run each round of a '
+                    'benchmark for, default 1', type=float, default=1.0)
+parser.add_argument('--repeat', help='rounds of each benchmark (best is taken)'
+                    ', default 3', type=int, default=3)
+options = parser.parse_args()
+
+fixtures = generate_fixtures()
+
+# Benchmarks are named after the parsing path they cover, with the fixture
+# size reported alongside. Note that deviantart_post_to_text alters the tag
+# passed, so the note body has to be parsed afresh every call
+benchmarks = {
+    'extract_text': (lambda: devart.extract_text(fixtures['post']),
+                     fixtures['post']),
+    'deviantart_post_to_text': (
+        lambda: devart.deviantart_post_to_text(
+            bs4.BeautifulSoup(fixtures['note'], 'lxml')
+            .select_one('.mcb-body.wrap-text')), fixtures['note']),
+    'parse_note': (lambda: devart.parse_note(fixtures['note'],
+                                             fixtures['note_ID'], '1'),
+                   fixtures['note']),
+    'parse_gallery_page': (
+        lambda: devart.parse_gallery_page(
+            fixtures['gallery_page'], 'replayuser', 0,
+            lambda URL: devart.DeviationFolder(0, URL, '', URL)),
+        fixtures['gallery_page']),
+    'parse_note_folders': (lambda: devart.parse_note_folders(
+        fixtures['notes_page']), fixtures['notes_page'])
+}
+if options.benchmark:
+    unknown_benchmarks = set(options.benchmark) - set(benchmarks)
+    if unknown_benchmarks:
+        print('Unknown benchmark(s) %s - available benchmarks: %s'
+              % (', '.join(sorted(unknown_benchmarks)),
+                 ', '.join(sorted(benchmarks))), file=sys.stderr)
+        sys.exit(1)
+
+results = {'timestamp': datetime.datetime.now().isoformat(),
+           'python': platform.python_version(),
+           'bs4': bs4.__version__,
+           'benchmarks': {}}
+print('%-24s %12s %10s %14s %12s' % ('Benchmark', 'Fixture size', 'Ops/s',
+                                     'Peak allocs', 'Peak RSS'))
+for name, (function, fixture) in sorted(benchmarks.items()):
+    if options.benchmark and name not in options.benchmark:
+        continue
+
+    ops_per_sec, peak_allocated = benchmark(function, options.min_time,
+                                            options.repeat)
+
+    # Peak RSS is of the whole process so far, kilobytes on Linux
+    peak_RSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results['benchmarks'][name] = {'fixture_bytes': len(fixture),
+                                   'ops_per_sec': ops_per_sec,
+                                   'peak_allocated_bytes': peak_allocated,
+                                   'peak_rss_kb': peak_RSS}
+    print('%-24s %12d %10.1f %14d %10dKB'
+          % (name, len(fixture), ops_per_sec, peak_allocated, peak_RSS))
+
+if options.output:
+    try:
+        with io.open(options.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+    except Exception as e:  # pylint: disable=broad-except
+        print('Unable to write results to \'%s\':\n\n%s\n'
+              % (options.output, e), file=sys.stderr)
+        sys.exit(1)
+
+if options.compare:
+    try:
+        with io.open(options.compare, 'r') as baseline_file:
+            baseline = json.load(baseline_file)
+    except Exception as e:  # pylint: disable=broad-except
+        print('Unable to load baseline results from \'%s\':\n\n%s\n'
+              % (options.compare, e), file=sys.stderr)
+        sys.exit(1)
+
+    if compare(results, baseline, options.threshold):
+        sys.exit(1)
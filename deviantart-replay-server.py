@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+'''
+Version 0.1 2017.02.10
+Copyright (c) 2017, OmegaPhil - OmegaPhil@startmail.com
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import argparse
+import os.path
+import sys
+
+import devart_replay
+
+
+# Configuring and parsing passed options
+parser = argparse.ArgumentParser()
+parser.add_argument('corpus_directory', help='directory of recorded responses '
+                    '(see record_directory in the scripts\' configuration)')
+parser.add_argument('-g', '--generate', help='generate a synthetic account\'s '
+                    'responses into the corpus directory first',
+                    action='store_true')
+parser.add_argument('--username', help='synthetic account username',
+                    default='replayuser')
+parser.add_argument('--notes', help='synthetic account notes count', type=int,
+                    default=100)
+parser.add_argument('--note-folders', help='synthetic account custom note '
+                    'folders count', type=int, default=3)
+parser.add_argument('--deviations', help='synthetic account deviations count',
+                    type=int, default=150)
+parser.add_argument('--messages', help='synthetic account count of each type '
+                    'of message', type=int, default=10)
+parser.add_argument('--short-notes', help='fraction of the synthetic '
+                    'account\'s notes that are a short line of plain text, '
+                    'e.g. 0.5', type=float, default=0.0)
+parser.add_argument('-p', '--port', help='port to listen on', type=int,
+                    default=8080)
+parser.add_argument('-l', '--latency', help='seconds to wait before each '
+                    'response', type=float, default=0.0)
+parser.add_argument('--jitter', help='up to this many seconds are randomly '
+                    'added to the latency', type=float, default=0.0)
+parser.add_argument('-e', '--error-rate', help='fraction of requests to fail, '
+                    'e.g. 0.05', type=float, default=0.0)
+parser.add_argument('--error-status', help='HTTP status of failed requests',
+                    type=int, default=503)
+options = parser.parse_args()
+
+if options.generate:
+    account = devart_replay.SyntheticAccount(options.username, options.notes,
+                                             options.note_folders,
+                                             options.deviations,
+                                             options.messages,
+                                             short_notes=options.short_notes)
+    try:
+        responses_count = account.write_corpus(options.corpus_directory)
+    except Exception as e:  # pylint: disable=broad-except
+        print('Unable to generate synthetic corpus in \'%s\':\n\n%s\n'
+              % (options.corpus_directory, e), file=sys.stderr)
+        sys.exit(1)
+    print('Generated %d responses for synthetic account \'%s\''
+          % (responses_count, options.username))
+
+if not os.path.isdir(options.corpus_directory):
+    print('Corpus directory \'%s\' does not exist' % options.corpus_directory,
+          file=sys.stderr)
+    sys.exit(1)
+
+server = devart_replay.ReplayServer(options.corpus_directory,
+                                    ('127.0.0.1', options.port),
+                                    options.latency, options.jitter,
+                                    options.error_rate, options.error_status)
+print('Replaying \'%s\' on %s - set base_url to this in the scripts\' '
+      'configuration' % (options.corpus_directory, server.base_URL))
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    pass
+finally:
+    server.server_close()
+    if server.missing_keys:
+        print('Requests with no recorded response:\n\n%s'
+              % '\n'.join(sorted(set(server.missing_keys))), file=sys.stderr)
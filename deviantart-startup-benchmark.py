@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+'''
+Version 0.1 2017.02.18
+Copyright (c) 2017, OmegaPhil - OmegaPhil@startmail.com
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+# Measures how long the scripts take to start up - running a script with
+# '--help' does all of its imports then exits, so the time over that of a bare
+# interpreter is what every run pays before doing anything useful. Exits with 1
+# when a script goes over the startup budget, or imports Beautiful Soup, lxml
+# or requests before it needs them (see devart.LazyModule)
+
+import argparse
+import io
+import json
+import os.path
+import subprocess
+import sys
+import time
+
+
+# Modules that must only be imported once a page is actually fetched or parsed
+HEAVY_MODULES = ('bs4', 'lxml', 'requests', 'urllib3')
+
+SCRIPTS = ('deviantart-checker.py', 'deviantart-deviations-downloader.py',
+           'deviantart-notes-downloader.py',
+           'deviantart-unread-sent-notes-checker.py')
+
+
+def import_times(arguments):
+    '''Run the interpreter with '-X importtime' and the passed arguments,
+    returning a dictionary of top-level module -> cumulative import time in
+    seconds, and the set of all modules imported'''
+
+    process = subprocess.run([sys.executable, '-X', 'importtime'] + arguments,
+                             stdout=subprocess.DEVNULL,
+                             stderr=subprocess.PIPE, universal_newlines=True,
+                             check=True)
+
+    # Lines are 'import time: self [us] | cumulative | package', with imported
+    # modules indented under what imported them
+    top_level_times = {}
+    modules = set()
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or line.endswith('package'):
+            continue
+        _, cumulative, package = line[len('import time:'):].split('|')
+        modules.add(package.strip())
+        if not package.startswith('  '):
+            top_level_times[package.strip()] = int(cumulative) / 1000000
+    return top_level_times, modules
+
+
+def best_run_time(command, runs):
+    '''Fastest wall time of running the passed command - the scripts are ran
+    enough times for this to be stable, where slower runs are just noise'''
+
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+# Configuring and parsing passed options
+parser = argparse.ArgumentParser()
+parser.add_argument('-s', '--script', help='only measure the named script (may '
+                    'be repeated)', action='append', choices=SCRIPTS)
+parser.add_argument('-b', '--budget-ms', help='milliseconds a script may take '
+                    'to start up over a bare interpreter, default 200',
+                    type=float, default=200.0)
+parser.add_argument('-r', '--runs', help='runs of each script (the fastest '
+                    'is taken), default 10', type=int, default=10)
+parser.add_argument('-o', '--output', help='write results as JSON to this file')
+options = parser.parse_args()
+
+scripts_directory = os.path.dirname(os.path.abspath(__file__))
+interpreter_time = best_run_time([sys.executable, '-c', 'pass'], options.runs)
+
+# Modules the interpreter imports by itself (e.g. site) aren't the scripts'
+# doing
+interpreter_modules = import_times(['-c', 'pass'])[1]
+results = {'budget_ms': options.budget_ms,
+           'interpreter_ms': interpreter_time * 1000, 'scripts': {}}
+failures = []
+print('Bare interpreter: %.1fms\n' % (interpreter_time * 1000))
+print('%-42s %10s %8s  %s' % ('Script', 'Startup', 'Modules',
+                              'Slowest imports'))
+for script_name in options.script or SCRIPTS:
+    script_path = os.path.join(scripts_directory, script_name)
+    try:
+        startup_time = best_run_time([sys.executable, script_path, '--help'],
+                                       options.runs) - interpreter_time
+        top_level_times, modules = import_times([script_path, '--help'])
+        for module in interpreter_modules:
+            top_level_times.pop(module, None)
+    except Exception as e:  # pylint: disable=broad-except
+        print('Unable to measure \'%s\':\n\n%s\n' % (script_name, e),
+              file=sys.stderr)
+        sys.exit(1)
+
+    heavy_modules = sorted(set(HEAVY_MODULES) & modules)
+    slowest_imports = sorted(top_level_times.items(),
+                             key=lambda item: item[1], reverse=True)[:4]
+    results['scripts'][script_name] = {
+        'startup_ms': startup_time * 1000, 'modules': len(modules),
+        'heavy_modules': heavy_modules,
+        'import_ms': {module: import_time * 1000
+                      for module, import_time in top_level_times.items()}}
+    problems = []
+    if startup_time * 1000 > options.budget_ms:
+        problems.append('OVER BUDGET')
+    if heavy_modules:
+        problems.append('IMPORTS %s' % ', '.join(heavy_modules))
+    if problems:
+        failures.append(script_name)
+    print('%-42s %8.1fms %8d  %s%s'
+          % (script_name, startup_time * 1000, len(modules),
+             ', '.join('%s %.1fms' % (module, import_time * 1000)
+                       for module, import_time in slowest_imports),
+             ''.join('  ' + problem for problem in problems)))
+
+if options.output:
+    try:
+        with io.open(options.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+    except Exception as e:  # pylint: disable=broad-except
+        print('Unable to write results to \'%s\':\n\n%s\n'
+              % (options.output, e), file=sys.stderr)
+        sys.exit(1)
+
+if failures:
+    sys.exit(1)
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+
+'''
+Version 0.1 2017.02.14
+Copyright (c) 2017, OmegaPhil - OmegaPhil@startmail.com
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+# Runs the notes and deviations downloaders end to end against a local replay
+# server serving a synthetic account, timing cold (empty database) and
+# incremental runs. The scripts are ran in a subprocess via this script's
+# '--run-script' mode, which times all SQLite calls made
+
+import argparse
+import atexit
+import io
+import json
+import os
+import os.path
+import runpy
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import yaml
+
+
+sqlite_time = 0.0
+sqlite_time_lock = threading.Lock()
+
+
+class TimedConnection(sqlite3.Connection):
+    '''SQLite connection accumulating the time spent in SQLite calls'''
+
+    def commit(self):
+        with SQLiteTimer():
+            return super().commit()
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or TimedCursor)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+    def executescript(self, *args):
+        return self.cursor().executescript(*args)
+
+
+class TimedCursor(sqlite3.Cursor):
+    '''SQLite cursor accumulating the time spent in SQLite calls, including
+    stepping through results'''
+
+    def __next__(self):
+        with SQLiteTimer():
+            return super().__next__()
+
+    def execute(self, *args):
+        with SQLiteTimer():
+            return super().execute(*args)
+
+    def executemany(self, *args):
+        with SQLiteTimer():
+            return super().executemany(*args)
+
+    def executescript(self, *args):
+        with SQLiteTimer():
+            return super().executescript(*args)
+
+    def fetchall(self):
+        with SQLiteTimer():
+            return super().fetchall()
+
+    def fetchone(self):
+        with SQLiteTimer():
+            return super().fetchone()
+
+
+class SQLiteTimer(object):
+    '''Context manager adding the time spent inside it to sqlite_time'''
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *args):
+        global sqlite_time  # pylint: disable=global-statement
+
+        with sqlite_time_lock:
+            sqlite_time += time.perf_counter() - self.start
+
+
+def prepare_home(home_directory, base_URL, username, use_note_previews):
+    '''Write the scripts' configuration into a fresh home directory'''
+
+    config_directory = os.path.join(home_directory, '.config',
+                                    'deviantart-scripts')
+    os.makedirs(config_directory, exist_ok=True)
+    configs = {'credentials.conf': {'username': username,
+                                    'password': 'benchmark',
+                                    'base_url': base_URL},
+               'deviantart-notes-downloader.conf': {
+                   'database_path': os.path.join(home_directory,
+                                                 'notes.sqlite'),
+                   'use_note_previews': use_note_previews},
+               'deviantart-deviations-downloader.conf': {
+                   'database_path': os.path.join(home_directory,
+                                                 'deviations.sqlite'),
+                   'files_directory': os.path.join(home_directory, 'files')}}
+    for file_name, config in configs.items():
+        with io.open(os.path.join(config_directory, file_name), 'w') as f:
+            yaml.dump(config, f, default_flow_style=False)
+
+
+def run_instrumented(stats_path, script_path, script_args):
+    '''Run a script with all SQLite connections timed, writing the SQLite time
+    to stats_path on exit'''
+
+    def write_stats():
+        with io.open(stats_path, 'w') as stats_file:
+            json.dump({'sqlite_time': sqlite_time}, stats_file)
+
+    connect = sqlite3.connect
+    sqlite3.connect = (lambda *args, **kwargs:
+                       connect(*args, factory=TimedConnection, **kwargs))
+    atexit.register(write_stats)
+    sys.argv = [script_path] + script_args
+    sys.path.insert(0, os.path.dirname(os.path.abspath(script_path)))
+    runpy.run_path(script_path, run_name='__main__')
+
+
+def run_scenario(server, home_directory, script_name, script_args):
+    '''Run a script against the replay server, returning its wall time, SQLite
+    time and the number of requests it made'''
+
+    script_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               script_name)
+    stats_path = os.path.join(home_directory, 'stats.json')
+    environment = dict(os.environ, HOME=home_directory)
+
+    server.reset_stats()
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, os.path.abspath(__file__),
+                              '--run-script', stats_path, script_path] +
+                             script_args, env=environment,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             universal_newlines=True)
+    wall_time = time.perf_counter() - start
+    if process.returncode != 0:
+        raise Exception('\'%s %s\' failed with exit status %s:\n\n%s\n'
+                        % (script_name, ' '.join(script_args),
+                           process.returncode, process.stderr[-5000:]))
+
+    with io.open(stats_path, 'r') as stats_file:
+        stats = json.load(stats_file)
+    return wall_time, stats['sqlite_time'], server.requests_served
+
+
+# Instrumented run of a script on behalf of run_scenario
+if len(sys.argv) > 1 and sys.argv[1] == '--run-script':
+    run_instrumented(sys.argv[2], sys.argv[3], sys.argv[4:])
+    sys.exit(0)
+
+import devart_replay  # pylint: disable=wrong-import-position
+
+# Configuring and parsing passed options
+parser = argparse.ArgumentParser()
+parser.add_argument('--notes', help='synthetic account notes count, default '
+                    '1000', type=int, default=1000)
+parser.add_argument('--note-folders', help='synthetic account custom note '
+                    'folders count, default 5', type=int, default=5)
+parser.add_argument('--deviations', help='synthetic account deviations count, '
+                    'default 1000', type=int, default=1000)
+parser.add_argument('--short-notes', help='fraction of the synthetic '
+                    'account\'s notes that are a short line of plain text '
+                    '(shown whole in folder listings, and taken from there '
+                    'with use_note_previews), default 0', type=float,
+                    default=0.0)
+parser.add_argument('--corpus-directory', help='where to keep the synthetic '
+                    'account\'s responses - reused when the account size '
+                    'matches, default is a temporary directory')
+parser.add_argument('-j', '--jobs', help='passed through to the downloaders',
+                    type=int)
+parser.add_argument('-l', '--latency', help='seconds the replay server waits '
+                    'before each response, default 0', type=float, default=0.0)
+parser.add_argument('-d', '--download-files', help='also download deviation '
+                    'files', action='store_true')
+parser.add_argument('-s', '--skip', help='skip the notes or deviations '
+                    'downloader', choices=['notes', 'deviations'],
+                    action='append', default=[])
+parser.add_argument('-o', '--output', help='write results as JSON to this file')
+options = parser.parse_args()
+
+work_directory = tempfile.mkdtemp(prefix='deviantart-sync-benchmark-')
+try:
+
+    # Generating the synthetic account's responses unless a previous run
+    # already has
+    account = devart_replay.SyntheticAccount(
+        'benchmarkuser', options.notes, options.note_folders,
+        options.deviations, messages=0, short_notes=options.short_notes)
+    corpus_directory = (options.corpus_directory or
+                        os.path.join(work_directory, 'corpus'))
+    corpus_marker_path = os.path.join(corpus_directory, 'account.json')
+    account_description = {'version': devart_replay.CORPUS_VERSION,
+                           'notes': options.notes,
+                           'note_folders': options.note_folders,
+                           'deviations': options.deviations,
+                           'short_notes': options.short_notes}
+    corpus_matches = False
+    if os.path.exists(corpus_marker_path):
+        with io.open(corpus_marker_path, 'r') as marker_file:
+            corpus_matches = json.load(marker_file) == account_description
+    if not corpus_matches:
+        print('Generating synthetic account responses in \'%s\'...'
+              % corpus_directory)
+        account.write_corpus(corpus_directory)
+        with io.open(corpus_marker_path, 'w') as marker_file:
+            json.dump(account_description, marker_file)
+
+    server = devart_replay.ReplayServer(corpus_directory,
+                                        latency=options.latency)
+    server.serve_in_background()
+    home_directory = os.path.join(work_directory, 'home')
+    prepare_home(home_directory, server.base_URL, account.username,
+                 options.short_notes > 0)
+
+    jobs_args = ['--jobs', str(options.jobs)] if options.jobs else []
+    scenarios = []
+    if 'notes' not in options.skip:
+        notes_database_path = os.path.join(home_directory, 'notes.sqlite')
+        scenarios += [
+            ('notes cold', 'deviantart-notes-downloader.py', [],
+             options.notes, notes_database_path),
+            ('notes incremental', 'deviantart-notes-downloader.py', [],
+             options.notes, None),
+            ('notes incremental --fsck', 'deviantart-notes-downloader.py',
+             ['--fsck'], options.notes, None),
+            ('notes cold --fsck', 'deviantart-notes-downloader.py', ['--fsck'],
+             options.notes, notes_database_path)]
+    if 'deviations' not in options.skip:
+        deviations_args = ['--download-files'] if options.download_files else []
+        deviations_database_path = os.path.join(home_directory,
+                                                'deviations.sqlite')
+        scenarios += [
+            ('deviations cold', 'deviantart-deviations-downloader.py',
+             deviations_args, options.deviations, deviations_database_path),
+            ('deviations incremental', 'deviantart-deviations-downloader.py',
+             deviations_args, options.deviations, None)]
+
+    results = {'account': account_description, 'jobs': options.jobs,
+               'latency': options.latency, 'scenarios': {}}
+    print('%-26s %10s %10s %12s %10s' % ('Scenario', 'Wall time', 'Requests',
+                                         'Items/s', 'SQLite'))
+    for name, script_name, script_args, items, database_path in scenarios:
+
+        # Cold runs start from nothing
+        if database_path:
+            if os.path.exists(database_path):
+                os.remove(database_path)
+            shutil.rmtree(os.path.join(home_directory, 'files'),
+                          ignore_errors=True)
+
+        wall_time, sqlite_time, requests_count = run_scenario(
+            server, home_directory, script_name, script_args + jobs_args)
+        results['scenarios'][name] = {'wall_time': wall_time,
+                                      'requests': requests_count,
+                                      'items_per_sec': items / wall_time,
+                                      'sqlite_time': sqlite_time,
+                                      'sqlite_share': sqlite_time / wall_time}
+        print('%-26s %9.2fs %10d %12.1f %9.1f%%'
+              % (name, wall_time, requests_count, items / wall_time,
+                 sqlite_time / wall_time * 100))
+
+    server.shutdown()
+    server.server_close()
+
+    if options.output:
+        with io.open(options.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+
+except Exception as e:  # pylint: disable=broad-except
+    print('Benchmark failed:\n\n%s\n' % e, file=sys.stderr)
+    sys.exit(1)
+
+finally:
+    shutil.rmtree(work_directory, ignore_errors=True)
@@ -18,42 +18,35 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
+import argparse
 import datetime
 import fcntl
-import io
 import numbers
-import os
-import os.path
-import subprocess
 import time
 import traceback
-import shlex
 import sys
 
-import yaml
-
 import devart
+import devart_config
+import devart_metrics
+import devart_notify
+import devart_profile
 
 
-config = {}
-
-
-def generate_command_fragments(command, subject, message):
-    '''Prepare command with variable substitution'''
+# The configuration schema (see devart_config)
+CONFIG_SCHEMA = {
+    'update_every_minutes': devart_config.Setting(numbers.Number, 5,
+                                                  minimum=5),
+    'track_sent_notes_days': devart_config.Setting(numbers.Number, 90,
+                                                   minimum=1)}
+CONFIG_SCHEMA.update(devart_notify.CONFIG_SCHEMA)
+CONFIG_SCHEMA.update(devart_metrics.CONFIG_SCHEMA)
 
-    # Substituting values into command to call in the normal way for
-    # the subject since that is essentially fixed - content is not
-    # fixed and can contain quotes and speechmarks. I have tried to
-    # escape such stuff with shlex.quote, but it can't cope in
-    # examples of single quotes, and when a full command is quoted
-    # it doesn't execute correctly. Given that I don't want this going
-    # through a shell, I should be able to give command parameters
-    # straight to the called process without weird escaping - which is
-    # what I am doing here
-    command = command.replace('%s', '[deviantart-unread-sent-notes-checker] '
-                              + subject)
-    return [fragment.replace('%m', message) for fragment in
-            shlex.split(command)]
+config = {}
+config_loader = None
+notifications = None
+notification_sinks = []
+failure_notification_sinks = []
 
 
 def handle_unknown_error(err):
@@ -70,89 +63,82 @@ def handle_unknown_error(err):
     error_message = 'Unhandled error \'%s\'\n\n%s' % (err, traceback.format_exc())
     print(error_message, file=sys.stderr)
 
-    # Running command_to_run_on_failure if specified
-    if config['command_to_run_on_failure']:
-
-        try:
-            command_fragments = generate_command_fragments(config['command_to_run_on_failure'],
-                                                           'Error', error_message)
-
-            # Running command without a shell
-            subprocess.call(command_fragments)
-
-        except Exception as e:  # pylint: disable=broad-except
-            print('Calling the command to run on failure failed:\n\n%s\n'
-                  '\n%s\n' % (config['command_to_run_on_failure'], e),
-                  file=sys.stderr)
+    # Notifying failure_notification_sinks (or command_to_run_on_failure) if
+    # specified - this happens in the background, with failures reported there
+    if notifications:
+        notifications.notify(failure_notification_sinks, 'Error', error_message)
 
 
 def load_config():
     '''Load config'''
 
-    global config  # pylint: disable=global-statement
+    global config, config_loader  # pylint: disable=global-statement
 
-    # Loading configuration if it exists. Credentials has been split out into
-    # its own file so that it can be shared amongst various scripts
-    config_directory = os.path.expanduser('~/.config/deviantart-scripts')
-    config_file_path = os.path.join(config_directory,
-                                    'deviantart-unread-sent-notes-checker.conf')
-    credentials_file_path = os.path.join(config_directory, 'credentials.conf')
-    if (os.path.exists(config_file_path)
-        and os.path.exists(credentials_file_path)):
-
-        # Loading YAML documents - theres no need for them to be genuinely
-        # separate documents, so just sticking them together
-        try:
-            config_text = (io.open(config_file_path, 'r').read() + '\n' +
-                            io.open(credentials_file_path, 'r').read())
-            config = yaml.load(config_text, yaml.CLoader)
-            if config is None:
-                raise Exception('YAML documents empty')
-        except Exception as e:
-            raise Exception('Unable to load config from YAML documents '
-                            '\'%s\' and \'%s\':\n\n%s\n\n%s\n'
-                            % (config_file_path, credentials_file_path, str(e),
-                               traceback.format_exc()))
-
-    # Ensuring required settings exist
-    if 'username' not in config or 'password' not in config:
-        raise Exception('Please ensure a deviantART username and password is '
-                        'configured in \'%s\'' % credentials_file_path)
-    if 'command_to_run' not in config:
-        raise Exception('Please ensure command_to_run is configured in \'%s\'' %
-                        config_file_path)
-
-    # Ensuring sensible defaults
-    # Keep update delay at at least 5 minutes so as not to cause deviantART
-    # unnecessary load
-    if ('update_every_minutes' not in config or
-            not isinstance(config['update_every_minutes'], numbers.Number) or
-            not config['update_every_minutes'] >= 5):
-        config['update_every_minutes'] = 5
+    # Credentials has been split out into its own file so that it can be shared
+    # amongst various scripts - see devart_config
+    config_loader = devart_config.ConfigLoader(
+        'deviantart-unread-sent-notes-checker', CONFIG_SCHEMA, prepare_config)
+    config = config_loader.load()
 
 
 def poll_service():
     '''Main loop'''
 
+    # Metrics are always gathered, but only served when metrics_port is
+    # configured - any errors here will be fatal and are handled in the main
+    # scope
+    metrics = devart_metrics.Metrics({'account': config['username'],
+                                      'script': 'deviantart-unread-sent-notes-'
+                                                'checker'})
+    devart_metrics.define_checker_metrics(metrics)
+    metrics.define('deviantart_unread_sent_notes', 'gauge',
+                   'Sent notes not yet read by their recipient')
+    devart_metrics.start_metrics_server(metrics, config)
+    instrumentation = devart.instrumentation_from_config(config)
+    instrumentation.append(devart_metrics.MetricsInstrumentation(metrics))
+
     # Logging in to deviantART - any errors here will be fatal and are handled
     # in the main scope
-    dA = devart.DeviantArtService(config['username'], config['password'])
+    dA = devart.DeviantArtService(config['username'], config['password'],
+                                  base_URL=config.get('base_url'),
+                                  record_directory=config.get(
+                                      'record_directory'),
+                                  instrumentation=instrumentation)
+
+    # Sent notes still unread are kept between runs, so that notes read while
+    # the checker wasn't running are still reported
+    sent_notes_state = devart.SentNotesState(
+        '~/.cache/deviantart-scripts/deviantart-unread-sent-notes-checker-'
+        'state.txt')
+    metrics.set('deviantart_unread_sent_notes',
+                len(sent_notes_state.unread_notes))
 
     # Looping for regular unread notes fetching
-    current_unread_notes = []
+    polls_count = 0
     while True:
 
+        poll_start = time.perf_counter()
+        poll_result = 'failure'
         try:
 
             # Attempting to log in - errors at this level will be logged and the
             # program will simply wait until the next interval to try again
             if not dA.logged_in:
-                dA.login()
+                try:
+                    dA.login()
+                except Exception:
+                    metrics.increment('deviantart_logins_total',
+                                      result='failure')
+                    raise
+                metrics.increment('deviantart_logins_total', result='success')
 
             try:
 
-                # Getting the current unread sent notes
-                latest_unread_notes = dA.get_unread_sent_notes()
+                # Determining newly-read notes, paging back through the sent
+                # folder as far as needed
+                read_notes = update_unread_sent_notes(
+                    dA, sent_notes_state,
+                    time.time() - config['track_sent_notes_days'] * 86400)
 
             # Currently I'll treat all exceptions here as issues with
             # deviantART or an expired login - invalidate the login and report
@@ -161,42 +147,218 @@ def poll_service():
                 dA.logged_in = False
                 raise
 
-            # Determining newly-read notes
             read_notes_change_summary = []
-            read_notes = set(current_unread_notes) - set(latest_unread_notes)
-            current_unread_notes = latest_unread_notes
+            metrics.increment('deviantart_new_items_total', len(read_notes),
+                              type='read_notes')
+            metrics.set('deviantart_unread_sent_notes',
+                        len(sent_notes_state.unread_notes))
             if read_notes:
                 read_notes_change_summary.append('The following sent notes have'
                                                  ' now been read:')
-                for read_note in read_notes:
-                    timestamp = datetime.datetime.fromtimestamp(read_note.ts)
+                for title, recipient, timestamp in read_notes:
+                    timestamp = datetime.datetime.fromtimestamp(timestamp)
                     # timestamp = timestamp.strftime('%y/%m/%d %H:%M:%S')
                     note_details = ('\'%s\' sent to %s on %s'
-                    % (read_note.title, read_note.recipient, timestamp))
+                    % (title, recipient, timestamp))
                     read_notes_change_summary.append(note_details)
 
-                try:
-                    command_fragments = generate_command_fragments(
-                        config['command_to_run'], 'Freshly-Read Notes',
-                        "\n\n".join(read_notes_change_summary))
-
-                    # Running command without a shell
-                    subprocess.call(command_fragments)
+                # Notifications are delivered in the background so that they
+                # can't delay polling
+                notifications.notify(notification_sinks,
+                                     'Freshly-Read Notes',
+                                     "\n\n".join(read_notes_change_summary))
 
-                except Exception as e:  # pylint: disable=broad-except
-                    raise Exception('Calling the command to run to notify read '
-                                    'notes failed:\n\n%s\n\n%s\n' %
-                                    (config['command_to_run'], e))
+            poll_result = 'success'
+            metrics.set('deviantart_last_success_timestamp_seconds',
+                        time.time())
 
         except Exception as e:  # pylint: disable=broad-except
             handle_unknown_error(e)
 
-        time.sleep(config['update_every_minutes'] * 60)
+        metrics.observe('deviantart_poll_duration_seconds',
+                        time.perf_counter() - poll_start, result=poll_result)
+
+        # When profiling, only the requested number of polls are made
+        polls_count += 1
+        if options.profile and polls_count >= options.profile_polls:
+            return
+
+        # Waiting for the next poll, picking up any changes to the
+        # configuration meanwhile (including to the wait itself)
+        wait_start = time.monotonic()
+        while True:
+            remaining = (wait_start + config['update_every_minutes'] * 60 -
+                         time.monotonic())
+            if remaining <= 0:
+                break
+            time.sleep(min(remaining, devart_config.RELOAD_CHECK_SECONDS))
+            reload_config()
+
+
+def prepare_config(config):  # pylint: disable=redefined-outer-name
+    '''Check a newly-loaded configuration'''
+
+    if not config['command_to_run'] and not config['notification_sinks']:
+        raise Exception('Please ensure command_to_run or notification_sinks is '
+                        'configured in \'%s\''
+                        % config_loader.config_file_path)
 
 
-# Loading config
+def reload_config():
+    '''Pick up any changes to the configuration - an invalid configuration is
+    reported, carrying on with the previous one'''
+
+    # pylint: disable=global-statement
+    global config, notification_sinks, failure_notification_sinks
+
+    try:
+        new_config = config_loader.reload()
+        if new_config is None:
+            return
+        new_notification_sinks = devart_notify.sinks_from_config(
+            '[deviantart-unread-sent-notes-checker] ', new_config,
+            'notification_sinks', 'command_to_run')
+        new_failure_notification_sinks = devart_notify.sinks_from_config(
+            '[deviantart-unread-sent-notes-checker] ', new_config,
+            'failure_notification_sinks', 'command_to_run_on_failure')
+    except Exception as e:  # pylint: disable=broad-except
+        error_message = ('Unable to reload the configuration - carrying on '
+                         'with the previous one:\n\n%s' % e)
+        print(error_message, file=sys.stderr)
+        notifications.notify(failure_notification_sinks, 'Error',
+                             error_message)
+        return
+
+    # Anything already queued for the old sinks is still delivered
+    notifications.retire(notification_sinks + failure_notification_sinks)
+    notifications.retries = new_config['notification_retries']
+    config = new_config
+    notification_sinks = new_notification_sinks
+    failure_notification_sinks = new_failure_notification_sinks
+
+
+def update_unread_sent_notes(dA, sent_notes_state, horizon_timestamp):
+    '''Page back through the sent folder as far as anything can have changed
+    since the last poll, updating and saving sent_notes_state. Returns the
+    (title, recipient, timestamp) of the notes read since then, oldest first.
+    Notes sent before horizon_timestamp aren't tracked'''
+
+    # pylint: disable=too-many-branches,redefined-outer-name
+
+    # Working on a copy so that a failure part way through leaves the state
+    # as it was for the next poll to try again
+    unread_notes = {note_ID: details for note_ID, details
+                    in sent_notes_state.unread_notes.items()
+                    if details[2] >= horizon_timestamp}
+
+    # Notes only go from unread to read, so once the listing is older than
+    # both the oldest note still unread and the newest note seen last time,
+    # there is nothing left to find (tracked notes are all newer than the
+    # horizon). Without previous state, the folder is paged back to the
+    # horizon
+    previous_newest_note_ID = sent_notes_state.newest_note_ID
+    if previous_newest_note_ID is None:
+        cutoff_note_ID = None
+    else:
+        cutoff_note_ID = min([previous_newest_note_ID] + list(unread_notes))
+
+    read_notes = []
+    seen_note_IDs = set()
+    timestamps = {}
+    note_offset = 0
+    while True:
+        note_previews = dA.get_note_previews_in_folder_page('2', note_offset)
+        for note_ID, unread, note in note_previews:
+
+            # A note sent while paging shifts the listing, so the last note of
+            # one page can turn up again on the next
+            if note_ID in seen_note_IDs:
+                continue
+            seen_note_IDs.add(note_ID)
+            if note is not None:
+                timestamps[note_ID] = note.ts
+
+            if note_ID in unread_notes and not unread:
+                read_notes.append(unread_notes.pop(note_ID))
+
+            # Only notes new since last time need fetching (when the preview
+            # isn't the whole note) - older unread notes that aren't tracked
+            # were sent before the horizon
+            elif unread and note_ID not in unread_notes and (
+                    previous_newest_note_ID is None or
+                    note_ID > previous_newest_note_ID):
+                note = note or dA.get_note_in_folder('2', note_ID)
+                timestamps[note_ID] = note.ts
+                if note.ts >= horizon_timestamp:
+                    unread_notes[note_ID] = (note.title, note.recipient,
+                                             note.ts)
+
+        # A short page is the end of the folder
+        if len(note_previews) < devart.NOTES_PAGE_SIZE:
+            oldest_note_ID = 0
+            break
+
+        # Stopping once past the cutoff, or without one, going back no further
+        # than the horizon - fetching the oldest note on the page when its age
+        # isn't already known
+        oldest_note_ID = note_previews[-1][0]
+        if cutoff_note_ID is not None:
+            if oldest_note_ID < cutoff_note_ID:
+                break
+        else:
+            if oldest_note_ID not in timestamps:
+                timestamps[oldest_note_ID] = dA.get_note_in_folder(
+                    '2', oldest_note_ID).ts
+            if timestamps[oldest_note_ID] < horizon_timestamp:
+                break
+        note_offset += devart.NOTES_PAGE_SIZE
+
+    # Unread notes that should have been listed but weren't have probably been
+    # deleted - however a note deleted while paging shifts the listing the
+    # other way, so a note can slip onto a page already read. They are only
+    # dropped when missing from two polls in a row. The state is only saved
+    # when something has changed
+    missing_note_IDs = set()
+    for note_ID in list(unread_notes):
+        if note_ID >= oldest_note_ID and note_ID not in seen_note_IDs:
+            if note_ID in sent_notes_state.missing_note_IDs:
+                del unread_notes[note_ID]
+            else:
+                missing_note_IDs.add(note_ID)
+
+    newest_note_ID = max(seen_note_IDs, default=previous_newest_note_ID)
+    if (newest_note_ID != previous_newest_note_ID or
+            unread_notes.keys() != sent_notes_state.unread_notes.keys() or
+            missing_note_IDs != sent_notes_state.missing_note_IDs):
+        sent_notes_state.newest_note_ID = newest_note_ID
+        sent_notes_state.unread_notes = unread_notes
+        sent_notes_state.missing_note_IDs = missing_note_IDs
+        sent_notes_state.save_state()
+
+    return sorted(read_notes, key=lambda details: details[2])
+
+
+# Configuring and parsing passed options
+parser = argparse.ArgumentParser()
+parser.add_argument('--profile', dest='profile', help='profile the polls made, '
+'writing the stats to this file and a summary of where the time went to stderr '
+'before exiting')
+parser.add_argument('--profile-polls', dest='profile_polls', help='number of '
+'polls to profile (default 1)', type=int, default=1)
+options = parser.parse_args()
+if options.profile_polls < 1:
+    parser.error('--profile-polls must be at least 1')
+devart_profile.start_profiler(options.profile)
+
+# Loading config, and starting notifications
 try:
     load_config()
+    notifications = devart_notify.dispatcher_from_config(config)
+    notification_sinks = devart_notify.sinks_from_config(
+        '[deviantart-unread-sent-notes-checker] ', config, 'notification_sinks', 'command_to_run')
+    failure_notification_sinks = devart_notify.sinks_from_config(
+        '[deviantart-unread-sent-notes-checker] ', config, 'failure_notification_sinks',
+        'command_to_run_on_failure')
 except Exception as e:  # pylint: disable=broad-except
     print('Unable to load or invalid configuration file:\n\n%s' % e,
           file=sys.stderr)
@@ -224,3 +386,7 @@ with open(__file__) as f:
 
         # Release lock
         fcntl.flock(f, fcntl.LOCK_UN | fcntl.LOCK_NB)
+
+        # Giving queued notifications (e.g. of a fatal error) a chance to be
+        # sent
+        notifications.close()